@@ -0,0 +1,518 @@
+#!/usr/bin/env python3
+"""
+Offline benchmark for the downloader core.
+
+Runs scan_media_in_dialogs, download_all_media, StateManager and upload_folder_media against
+FakeTelegramClient, a local stand-in for TelegramClient that serves synthetic dialogs. No
+Telegram account or network access is needed.
+
+Examples:
+    python bench_downloader.py                                   # default workload, JSON to stdout
+    python bench_downloader.py --messages 20000 --latency-ms 2 -o bench_output.txt
+    python bench_downloader.py --save-baseline bench_baseline.json
+    python bench_downloader.py --baseline bench_baseline.json --tolerance 0.15
+    python bench_downloader.py --only scan scan_sharded --latency-ms 20  # one cursor vs --scan-shards cursors
+    python bench_downloader.py --only startup --startup-runs 20         # CLI start-up time + import report
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+from telethon.errors import FloodWaitError
+from telethon.tl import types
+
+import downloader as D
+
+CHUNK = 512 * 1024
+
+
+# ============================ FAKE CLIENT =============================
+
+class FakeTelegramClient:
+    """
+    Implements the parts of TelegramClient that the downloader uses. Delays come from
+    asyncio.sleep, so concurrency behaves as it would against a real server.
+    """
+
+    def __init__(self, dialogs: Dict[int, List[types.Message]], latency: float = 0.0,
+                 flood_rate: float = 0.0, flood_seconds: int = 0, error_rate: float = 0.0, seed: int = 1):
+        self.dialogs = dialogs
+        self.latency = latency
+        self.flood_rate = flood_rate
+        self.flood_seconds = flood_seconds
+        self.error_rate = error_rate
+        self._rng = random.Random(seed)
+        self._payload = bytes(CHUNK)
+        self._next_msg_id = 1
+        self.requests = 0
+        # Needed when cached messages are re-attached via Message._finish_init
+        from telethon._updates import EntityCache
+        self._self_id = 1
+        self._mb_entity_cache = EntityCache()
+
+    async def _request(self):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        roll = self._rng.random()
+        if roll < self.flood_rate:
+            raise FloodWaitError(request=None, capture=self.flood_seconds)
+        if roll < self.flood_rate + self.error_rate:
+            raise RuntimeError("injected failure")
+
+    def is_connected(self) -> bool:
+        return True
+
+    async def is_user_authorized(self) -> bool:
+        return True
+
+    async def get_peer_id(self, entity) -> int:
+        return int(entity)
+
+    async def get_entity(self, peer):
+        return types.Channel(id=abs(int(peer)) if str(peer).lstrip("-").isdigit() else 1, title=str(peer),
+                             photo=types.ChatPhotoEmpty(), date=None, access_hash=1)
+
+    def iter_messages(self, entity, limit=None, min_id=0, max_id=0, **kwargs):
+        messages = [m for m in self.dialogs[int(entity)]
+                    if (not min_id or m.id > min_id) and (not max_id or m.id < max_id)]
+
+        async def gen():
+            # One "request" per page of 100 inside (min_id, max_id), as Telethon does for GetHistory
+            for i, msg in enumerate(messages):
+                if i % 100 == 0:
+                    self.requests += 1
+                    if self.latency:
+                        await asyncio.sleep(self.latency)
+                yield msg
+        return gen()
+
+    async def get_messages(self, entity, limit=None, **kwargs):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self.dialogs[int(entity)][:limit]
+
+    async def iter_download(self, message, **kwargs):
+        await self._request()
+        remaining = D.TelegramDownloader._media_size(message)
+        while remaining > 0:
+            n = min(remaining, CHUNK)
+            yield self._payload[:n]
+            remaining -= n
+
+    async def download_media(self, message, file=None, **kwargs):
+        await self._request()
+        remaining = D.TelegramDownloader._media_size(message)
+        with open(file, "wb") as fh:
+            while remaining > 0:
+                n = min(remaining, CHUNK)
+                fh.write(self._payload[:n])
+                remaining -= n
+        return file
+
+    async def upload_file(self, file, file_size=None, progress_callback=None, **kwargs):
+        await self._request()
+        total = file_size or os.path.getsize(file)
+        done = 0
+        with open(file, "rb") as fh:
+            while True:
+                chunk = fh.read(CHUNK)
+                if not chunk:
+                    break
+                done += len(chunk)
+                if progress_callback:
+                    progress_callback(done, total)
+        self._next_msg_id += 1
+        return types.InputFile(id=self._next_msg_id, parts=max(1, -(-total // CHUNK)),
+                               name=os.path.basename(file), md5_checksum="")
+
+    async def send_file(self, entity, file=None, caption=None, progress_callback=None, **kwargs):
+        await self._request()
+        self._next_msg_id += 1
+        return types.Message(id=self._next_msg_id, peer_id=types.PeerChannel(1), date=None, message=caption or "")
+
+
+def make_dialogs(n_dialogs: int, n_messages: int, media_mix: float, photo_share: float,
+                 min_size: int, max_size: int, seed: int) -> Dict[int, List[types.Message]]:
+    """Synthetic dialogs. media_mix is the share of messages with media; photo_share is the share of those that are photos."""
+    rng = random.Random(seed)
+    base = datetime(2023, 1, 1, tzinfo=timezone.utc)
+    dialogs = {}
+    for d in range(1, n_dialogs + 1):
+        msgs = []
+        for i in range(1, n_messages + 1):
+            date = base + timedelta(minutes=i)
+            media = None
+            if rng.random() < media_mix:
+                size = rng.randint(min_size, max_size)
+                if rng.random() < photo_share:
+                    media = types.MessageMediaPhoto(photo=types.Photo(
+                        id=i, access_hash=1, file_reference=b"", date=date, dc_id=2,
+                        sizes=[types.PhotoSize("y", 1280, 1280, size)]))
+                else:
+                    media = types.MessageMediaDocument(document=types.Document(
+                        id=i, access_hash=1, file_reference=b"", date=date, mime_type="video/mp4",
+                        size=size, dc_id=2, attributes=[]))
+            msgs.append(types.Message(id=i, peer_id=types.PeerChannel(d), date=date, message="", media=media))
+        msgs.reverse()  # newest first, like Telegram
+        dialogs[d] = msgs
+    return dialogs
+
+
+# ============================ MEASUREMENT =============================
+
+def _read_proc_io() -> Dict[str, int]:
+    try:
+        lines = Path("/proc/self/io").read_text().splitlines()
+    except OSError:
+        return {}
+    out = {}
+    for line in lines:
+        key, _, val = line.partition(":")
+        out[key.strip()] = int(val)
+    return out
+
+
+def _reset_peak_rss() -> bool:
+    # Writing 5 to clear_refs resets VmHWM (Linux 4.0+), which gives a per-scenario peak
+    try:
+        Path("/proc/self/clear_refs").write_text("5")
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_kb() -> int:
+    try:
+        for line in Path("/proc/self/status").read_text().splitlines():
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+async def measure(name: str, fn: Callable[[], Any]) -> Dict[str, Any]:
+    """Runs fn (which returns (items, bytes)) and records throughput, peak RSS and syscall counts."""
+    _reset_peak_rss()
+    io_before = _read_proc_io()
+    cpu_before = time.process_time()
+    t0 = time.perf_counter()
+    items, nbytes = await fn()
+    wall = time.perf_counter() - t0
+    cpu = time.process_time() - cpu_before
+    io_after = _read_proc_io()
+
+    def delta(key):
+        return io_after.get(key, 0) - io_before.get(key, 0) if io_after else None
+
+    return {
+        "name": name,
+        "items": items,
+        "bytes": nbytes,
+        "wall_s": round(wall, 4),
+        "cpu_s": round(cpu, 4),
+        "items_per_sec": round(items / wall, 2) if wall > 0 else None,
+        "bytes_per_sec": round(nbytes / wall, 2) if wall > 0 else None,
+        "peak_rss_kb": _peak_rss_kb(),
+        "syscalls_read": delta("syscr"),
+        "syscalls_write": delta("syscw"),
+        "io_read_bytes": delta("rchar"),
+        "io_write_bytes": delta("wchar"),
+    }
+
+
+def _import_report(argv: List[str], cwd: Path, env: Dict[str, str], top: int) -> List[Dict[str, Any]]:
+    """Runs argv under `python -X importtime` and returns the slowest imports (cumulative us)."""
+    proc = subprocess.run([sys.executable, "-X", "importtime", *argv], cwd=cwd, env=env, capture_output=True,
+                          text=True)
+    rows = []
+    for row in proc.stderr.splitlines():
+        parts = row.split("|")
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        name = parts[2]
+        depth = (len(name) - len(name.lstrip())) // 2
+        rows.append({"module": name.strip(), "depth": depth, "self_us": int(parts[0].split(":")[1]),
+                     "cumulative_us": int(parts[1])})
+    rows.sort(key=lambda r: r["cumulative_us"], reverse=True)
+    return rows[:top]
+
+
+def measure_startup(command: List[str], workdir: Path, runs: int, budget_ms: Optional[float],
+                    as_module: bool = False) -> Dict[str, Any]:
+    """
+    Wall time of `python downloader.py <command>` from process start to exit (no-network commands only).
+    as_module=True runs `python -m downloader` instead. downloader.py is a thin launcher for downloader_core,
+    so both forms load the core from __pycache__ and share the same budget.
+    """
+    script = Path(D.__file__).resolve().with_name("downloader.py")  # D is downloader_core once imported
+    argv = (["-m", script.stem] if as_module else [str(script)]) + command
+    env = dict(os.environ, PYTHONPATH=str(script.parent))
+    samples = []
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        subprocess.run([sys.executable, *argv], cwd=workdir, env=env, stdout=subprocess.DEVNULL, check=True)
+        samples.append((time.perf_counter() - t0) * 1000)
+    median = statistics.median(samples)
+    return {
+        "name": "startup_" + "_".join(c.strip("-") for c in command) + ("_module" if as_module else ""),
+        "items": runs,
+        "bytes": 0,
+        "wall_s": round(sum(samples) / 1000, 4),
+        "startup_ms": round(median, 2),
+        "startup_ms_min": round(min(samples), 2),
+        "budget_ms": budget_ms,
+        "imports": _import_report(argv, workdir, env, top=15),
+    }
+
+
+# ============================ SCENARIOS =============================
+
+def _silent_log(message: str, color: Optional[str] = None):
+    pass
+
+
+def _silent_input(prompt: str, default: Optional[str] = None, hide_input: bool = False) -> str:
+    return default or ""
+
+
+def make_downloader(client: FakeTelegramClient, workdir: Path, account_index: int = 9001) -> D.TelegramDownloader:
+    downloader = D.TelegramDownloader(1, "0" * 32, "+10000000000", str(workdir / "downloads"), account_index,
+                                      _silent_log, _silent_input)
+    downloader.client = client
+    return downloader
+
+
+async def run_benchmarks(args) -> Dict[str, Any]:
+    workdir = Path(tempfile.mkdtemp(prefix="tele_bench_"))
+    cwd = os.getcwd()
+    os.chdir(workdir)  # sessions/ and state files are created relative to cwd
+    try:
+        dialogs = make_dialogs(args.dialogs, args.messages, args.media_mix, args.photo_share,
+                               args.min_size, args.max_size, args.seed)
+        client = FakeTelegramClient(dialogs, latency=args.latency_ms / 1000.0, flood_rate=args.flood_rate,
+                                    flood_seconds=args.flood_seconds, error_rate=args.error_rate, seed=args.seed)
+        downloader = make_downloader(client, workdir)
+        downloader.use_scan_cache = False
+        results: List[Dict[str, Any]] = []
+        selected = set(args.only or SCENARIOS)
+        media: List[Dict[str, Any]] = []
+
+        if "scan" in selected or "download" in selected:
+            downloader.scan_shards = 1  # one cursor per dialog, comparable with older baselines
+
+            async def scan():
+                nonlocal media
+                media = await downloader.scan_media_in_dialogs(list(dialogs))
+                return args.dialogs * args.messages, 0
+            r = await measure("scan", scan)
+            r["media_found"] = len(media)
+            if "scan" in selected:
+                results.append(r)
+
+        if "scan_sharded" in selected:
+            # Synthetic dialogs are far smaller than SCAN_SHARD_MIN_SPAN; lower it so every dialog is split
+            min_span = D.SCAN_SHARD_MIN_SPAN
+            D.SCAN_SHARD_MIN_SPAN = min(min_span, args.messages)
+            downloader.scan_shards = args.scan_shards
+
+            sharded: List[Dict[str, Any]] = []
+
+            async def scan_sharded():
+                sharded.extend(await downloader.scan_media_in_dialogs(list(dialogs)))
+                return args.dialogs * args.messages, 0
+            try:
+                r = await measure("scan_sharded", scan_sharded)
+            finally:
+                D.SCAN_SHARD_MIN_SPAN = min_span
+            r["media_found"] = len(sharded)
+            r["shards"] = args.scan_shards
+            results.append(r)
+
+        if "download" in selected:
+            downloader.stream_pipeline = args.stream
+
+            async def download():
+                await downloader.download_all_media(media, lambda: False)
+                return downloader.stats["downloaded"], downloader.stats["total_size"]
+            r = await measure("download", download)
+            r["errors"] = downloader.stats["errors"]
+            results.append(r)
+
+        if "state" in selected:
+            state = D.StateManager(9002)
+
+            async def state_run():
+                n = args.state_ids
+                for mid in range(1, n + 1):
+                    state.mark_completed(mid)
+                hits = sum(1 for mid in range(1, n + 1) if state.is_completed(mid))
+                return n + hits, 0
+            results.append(await measure("state", state_run))
+
+        if "upload" in selected:
+            folder = workdir / "upload_src"
+            folder.mkdir()
+            rng = random.Random(args.seed)
+            total = 0
+            for i in range(args.upload_files):
+                size = rng.randint(args.min_size, args.max_size)
+                (folder / f"file_{i:05d}.jpg").write_bytes(bytes(size))
+                total += size
+
+            async def upload():
+                await downloader.upload_folder_media(1, folder)
+                return args.upload_files, total
+            results.append(await measure("upload", upload))
+
+        if "startup" in selected:
+            Path(".env").write_text(f"CURRENT_ACCOUNT={downloader.account_index}\n"
+                                    f"ACCOUNT_{downloader.account_index}_PHONE=+10000000000\n"
+                                    f"ACCOUNT_{downloader.account_index}_API_ID=1\n"
+                                    f"ACCOUNT_{downloader.account_index}_API_HASH={'0' * 32}\n"
+                                    f"ACCOUNT_{downloader.account_index}_DOWNLOAD_DIR=downloads\n", encoding="utf-8")
+            downloader.state.save()
+            for command in (["status"], ["--help"]):
+                results.append(measure_startup(command, workdir, args.startup_runs, args.startup_budget_ms))
+            results.append(measure_startup(["status"], workdir, args.startup_runs, args.startup_budget_ms,
+                                           as_module=True))
+
+        downloader.scan_cache.close()
+        downloader.catalog.close()
+        return {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "python": sys.version.split()[0],
+            "params": {k: v for k, v in vars(args).items() if k not in ("output", "baseline", "save_baseline")},
+            "fake_requests": client.requests,
+            "results": results,
+        }
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+# ============================ BASELINE =============================
+
+# Metric -> True if higher is better
+COMPARED_METRICS = {
+    "items_per_sec": True,
+    "bytes_per_sec": True,
+    "peak_rss_kb": False,
+    "syscalls_read": False,
+    "syscalls_write": False,
+    "startup_ms": False,
+}
+
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    """Returns one line per metric that got worse than baseline by more than tolerance (a fraction)."""
+    base_by_name = {r["name"]: r for r in baseline.get("results", [])}
+    regressions = []
+    for r in current["results"]:
+        base = base_by_name.get(r["name"])
+        if not base:
+            continue
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            now, before = r.get(metric), base.get(metric)
+            if not now or not before:
+                continue
+            change = (now - before) / before
+            worse = -change if higher_is_better else change
+            r.setdefault("vs_baseline", {})[metric] = round(change, 4)
+            if worse > tolerance:
+                regressions.append(f"{r['name']}.{metric}: {before} -> {now} ({change:+.1%})")
+    return regressions
+
+
+def over_budget(current: Dict[str, Any]) -> List[str]:
+    return [f"{r['name']}.startup_ms: {r['startup_ms']} > budget {r['budget_ms']}"
+            for r in current["results"] if r.get("budget_ms") and r["startup_ms"] > r["budget_ms"]]
+
+
+SCENARIOS = ("scan", "scan_sharded", "download", "state", "upload", "startup")
+
+
+def build_parser() -> argparse.ArgumentParser:
+    p = argparse.ArgumentParser(description="Offline benchmark for Tele-Downloader-Toolkit (no Telegram account needed).")
+    p.add_argument("--only", nargs="*", choices=SCENARIOS, help="Scenarios to run (default: all).")
+    p.add_argument("--dialogs", type=int, default=4, help="Number of synthetic dialogs.")
+    p.add_argument("--messages", type=int, default=2000, help="Messages per dialog.")
+    p.add_argument("--media-mix", type=float, default=0.6, help="Share of messages carrying media (0-1).")
+    p.add_argument("--photo-share", type=float, default=0.7, help="Share of media that are photos (0-1).")
+    p.add_argument("--min-size", type=D.parse_size, default="20KB", help="Smallest synthetic file.")
+    p.add_argument("--max-size", type=D.parse_size, default="400KB", help="Largest synthetic file.")
+    p.add_argument("--latency-ms", type=float, default=0.0, help="Simulated latency per request.")
+    p.add_argument("--flood-rate", type=float, default=0.0,
+                   help="Share of file requests failing with FloodWait (each costs the downloader's back-off sleep).")
+    p.add_argument("--flood-seconds", type=int, default=0, help="FloodWait duration reported by injected errors.")
+    p.add_argument("--error-rate", type=float, default=0.0, help="Share of file requests failing with an error.")
+    p.add_argument("--scan-shards", type=int, default=D.SCAN_SHARDS,
+                   help="Cursors per dialog in the scan_sharded scenario.")
+    p.add_argument("--stream", action="store_true", help="Download through the chunk pipeline (download --stream).")
+    p.add_argument("--state-ids", type=int, default=5000, help="Message IDs marked/checked in the state scenario.")
+    p.add_argument("--upload-files", type=int, default=200, help="Files in the upload scenario.")
+    p.add_argument("--startup-runs", type=int, default=10, help="Process launches per command in the startup scenario.")
+    p.add_argument("--startup-budget-ms", type=float, default=100.0,
+                   help="Median start-up time allowed for non-network commands (exit 1 if exceeded).")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("-o", "--output", help="Write JSON results to this file (default: stdout).")
+    p.add_argument("--baseline", help="Compare against a saved results file; exit 1 on regressions.")
+    p.add_argument("--tolerance", type=float, default=0.10, help="Allowed regression vs baseline (fraction).")
+    p.add_argument("--save-baseline", help="Also save these results as a baseline file.")
+    return p
+
+
+def main():
+    args = build_parser().parse_args()
+    report = asyncio.run(run_benchmarks(args))
+
+    regressions = []
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text(encoding="utf-8"))
+        regressions = compare(report, baseline, args.tolerance)
+        report["regressions"] = regressions
+    regressions += over_budget(report)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(text + "\n", encoding="utf-8")
+    else:
+        print(text)
+    if args.save_baseline:
+        Path(args.save_baseline).write_text(text + "\n", encoding="utf-8")
+
+    for r in report["results"]:
+        if "startup_ms" in r:
+            slowest = ", ".join(f"{m['module']} {m['cumulative_us'] / 1000:.1f}ms"
+                                for m in r["imports"][:8] if m["depth"] == 0)
+            budget = f"budget {r['budget_ms']:.0f} ms" if r["budget_ms"] else "no budget"
+            print(f"{r['name']:<22} median {r['startup_ms']:>7.1f} ms  min {r['startup_ms_min']:>7.1f} ms  "
+                  f"({budget})  imports: {slowest}", file=sys.stderr)
+            continue
+        print(f"{r['name']:<12} {r['items']:>8} items  {r['wall_s']:>8.3f}s  "
+              f"{r['items_per_sec'] or 0:>10.1f} items/s  {(r['bytes_per_sec'] or 0) / 1e6:>8.1f} MB/s  "
+              f"peak {r['peak_rss_kb'] / 1024:.1f} MiB", file=sys.stderr)
+    if regressions:
+        print("Regressions vs baseline / budget:", file=sys.stderr)
+        for line in regressions:
+            print(f"  {line}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,5276 @@
+#!/usr/bin/env python3
+
+from __future__ import annotations
+
+import os
+import sys
+import time
+import re
+import json
+import signal
+import queue
+import threading
+import argparse  # For CLI
+import bisect
+import mmap
+import importlib
+import importlib.util
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from typing import List, Dict, Any, Optional, Tuple, Callable, Union, Iterable, Iterator
+from pathlib import Path, PurePosixPath
+
+
+class _LazyModule:
+    """
+    Module chỉ được import ở lần truy cập thuộc tính đầu tiên, sau đó tự thay mình trong globals().
+    asyncio, Telethon, tqdm, boto3 tốn hàng trăm ms để import; lệnh như `status` không cần đến chúng.
+    """
+
+    def __init__(self, name: str, alias: Optional[str] = None):
+        self._name = name
+        self._alias = alias or name
+
+    def __getattr__(self, attr: str):
+        module = importlib.import_module(self._name)
+        globals()[self._alias] = module
+        return getattr(module, attr)
+
+
+asyncio = _LazyModule("asyncio")
+hashlib = _LazyModule("hashlib")
+sqlite3 = _LazyModule("sqlite3")
+urlparse = _LazyModule("urllib.parse", "urlparse")
+
+# Telethon được nạp bởi _load_telethon() khi cần client (TelegramDownloader, ScanCache).
+TelegramClient = events = telethon_utils = None
+SessionPasswordNeededError = PhoneCodeInvalidError = PhoneCodeExpiredError = None
+PasswordHashInvalidError = FloodWaitError = PeerFloodError = FileReferenceExpiredError = None
+MessageMediaPhoto = MessageMediaDocument = User = Chat = Channel = BinaryReader = None
+_telethon_loaded = False
+
+
+def _load_telethon():
+    global TelegramClient, events, telethon_utils, SessionPasswordNeededError, PhoneCodeInvalidError, PhoneCodeExpiredError
+    global PasswordHashInvalidError, FloodWaitError, PeerFloodError, FileReferenceExpiredError
+    global MessageMediaPhoto, MessageMediaDocument, User, Chat, Channel, BinaryReader, resize_photo_if_needed
+    global _telethon_loaded
+    if _telethon_loaded:
+        return
+    try:
+        from telethon import TelegramClient, events, utils as telethon_utils
+        from telethon.errors import (
+            SessionPasswordNeededError,
+            PhoneCodeInvalidError,
+            PhoneCodeExpiredError,
+            PasswordHashInvalidError,
+            FloodWaitError,
+            PeerFloodError,
+            FileReferenceExpiredError
+        )
+        from telethon.tl.types import MessageMediaPhoto, MessageMediaDocument, User, Chat, Channel
+        from telethon.extensions import BinaryReader
+    except ImportError as e:
+        print(f"Missing package: {e}")
+        print("Install: pip install telethon")
+        sys.exit(1)
+    try:
+        # Bước thu nhỏ ảnh (> 2560px hoặc > 10 MB, cần Pillow) mà send_file(path) làm trước upload_file.
+        # Hàm private của Telethon: bản nào đổi tên thì upload file gốc (xem _upload_fan_out)
+        from telethon.client.uploads import _resize_photo_if_needed as resize_photo_if_needed
+    except ImportError:
+        resize_photo_if_needed = None
+    _telethon_loaded = True
+
+try:
+    from colorama import Fore, Style
+    import colorama
+except ImportError:
+    class NoColor:
+        def __getattr__(self, name):
+            return ''
+
+
+    Fore = NoColor()
+    Style = NoColor()
+    colorama = None
+
+
+def _tqdm() -> Optional[type]:
+    """tqdm (nếu đã cài) — chỉ import khi CLI thật sự vẽ thanh tiến độ."""
+    try:
+        from tqdm import tqdm
+    except ImportError:
+        return None
+    return tqdm
+
+
+try:
+    import humanize
+except ImportError as e:
+    print(f"Missing package: {e}")
+    print("Install: pip install humanize")
+    sys.exit(1)
+
+try:
+    import fcntl  # POSIX: khoá file .env khi ghi
+except ImportError:
+    fcntl = None
+
+try:
+    import msvcrt  # Windows
+except ImportError:
+    msvcrt = None
+
+# Optional: only needed for the S3-compatible storage backend
+boto3 = _LazyModule("boto3") if importlib.util.find_spec("boto3") else None
+
+import getpass  # For sensitive input in CLI
+
+# ============================ CẤU HÌNH UI (Console-specific, for default behavior) =============================
+
+WIDTH = 78
+USE_COLOR = True
+BAR_CHAR = "─"
+
+if colorama:
+    colorama.init(autoreset=True)
+
+
+def c(text: str, color: str) -> str:
+    if not USE_COLOR:
+        return text
+    return f"{color}{text}{Style.RESET_ALL}"
+
+
+def pad(text: str, width: int = WIDTH, align: str = "left") -> str:
+    text = text if text is not None else ""
+    if len(text) > width:
+        text = text[: width - 3] + "..."
+    if align == "left":
+        return text.ljust(width)
+    elif align == "right":
+        return text.rjust(width)
+    else:
+        return text.center(width)
+
+
+def line(char: str = BAR_CHAR, width: int = WIDTH) -> str:
+    return char * width
+
+
+def box(lines: List[str], width: int = WIDTH) -> str:
+    top = "┌" + ("─" * (width - 2)) + "┐"
+    bottom = "└" + ("─" * (width - 2)) + "┘"
+    inner = "\n".join("│" + s[: width - 2].ljust(width - 2) + "│" for s in lines)
+    return f"{top}\n{inner}\n{bottom}"
+
+
+_SIZE_UNITS = {"": 1, "B": 1, "K": 1024, "KB": 1024, "M": 1024 ** 2, "MB": 1024 ** 2,
+               "G": 1024 ** 3, "GB": 1024 ** 3, "T": 1024 ** 4, "TB": 1024 ** 4}
+
+
+def parse_size(text: str) -> int:
+    """'100MB' -> 104857600. Dùng cho các tham số kích thước trên CLI."""
+    m = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([A-Za-z]*)\s*", str(text))
+    if not m or m.group(2).upper() not in _SIZE_UNITS:
+        raise argparse.ArgumentTypeError(f"Invalid size '{text}' (examples: 500K, 100MB, 2GB)")
+    return int(float(m.group(1)) * _SIZE_UNITS[m.group(2).upper()])
+
+
+def parse_date(text: str) -> datetime:
+    """'2023-05-01' (hoặc ISO đầy đủ) -> datetime UTC."""
+    try:
+        dt = datetime.fromisoformat(str(text).strip())
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid date '{text}' (expected YYYY-MM-DD)")
+    return dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
+
+
+def scan_window_from_params(params: Dict[str, Any]) -> Dict[str, Any]:
+    """since/until/min_size/max_size từ tham số job hoặc body API -> kwargs cho set_scan_window."""
+    return {
+        "since": parse_date(params["since"]) if params.get("since") else None,
+        "until": parse_date(params["until"]) if params.get("until") else None,
+        "min_size": parse_size(params["min_size"]) if params.get("min_size") not in (None, "") else None,
+        "max_size": parse_size(params["max_size"]) if params.get("max_size") not in (None, "") else None,
+    }
+
+
+# Simple console logger
+def console_log_func(message: str, color_tag: Optional[str] = None):
+    color_map = {
+        "red": Fore.RED,
+        "green": Fore.GREEN,
+        "yellow": Fore.YELLOW,
+        "blue": Fore.BLUE,
+        "cyan": Fore.CYAN,
+        "reset": Style.RESET_ALL  # Not used directly but for completeness
+    }
+    prefix = color_map.get(color_tag, "")
+    suffix = Style.RESET_ALL if color_tag else ""
+    print(f"{prefix}{message}{suffix}")
+
+
+# Simple console input
+async def _maybe_await(value):
+    """input_func/confirm_callback trả giá trị hoặc awaitable (GUI chờ hộp thoại mà không chặn event loop)."""
+    return await value if hasattr(value, "__await__") else value
+
+
+def console_input_func(prompt: str, default: Optional[str] = None, hide_input: bool = False) -> str:
+    if hide_input:
+        try:
+            return getpass.getpass(prompt + ": ")
+        except Exception:
+            # Fallback if getpass fails (e.g., non-interactive console)
+            console_log_func("Warning: getpass failed, input will be echoed.", "yellow")
+            return input(prompt + ": ")
+
+    full_prompt = prompt
+    if default is not None:
+        full_prompt += f" (default: {default})"
+
+    user_input = input(full_prompt + ": ")
+    return user_input.strip() or (default or "")
+
+
+# ============================ QUẢN LÝ .ENV =============================
+
+ENV_TEMPLATE = """# Multi-account Telegram Tool
+CURRENT_ACCOUNT=0
+# Example:
+# ACCOUNT_1_PHONE=+84123456789
+# ACCOUNT_1_API_ID=123456
+# ACCOUNT_1_API_HASH=xxxxxxxxxxxxxxxxxxxxxxxxxxxx
+# ACCOUNT_1_DOWNLOAD_DIR=/absolute/path/to/downloads
+"""
+
+
+def ensure_env_exists(env_path: Path) -> None:
+    if not env_path.exists():
+        env_path.write_text(ENV_TEMPLATE, encoding="utf-8")
+
+
+_ENV_LINE = re.compile(r"^\s*(?:export\s+)?([A-Za-z_][A-Za-z0-9_.]*)\s*=\s*(.*?)\s*$")
+_ENV_CACHE: Dict[str, Tuple[Tuple[int, int], Dict[str, str]]] = {}  # path -> ((mtime_ns, size), values)
+
+
+class EnvConfig(dict):
+    """
+    Nội dung .env đã parse, kèm danh sách khoá bị đặt/xoá kể từ lần đọc (`dirty`, None = xoá).
+    save_env chỉ áp các thay đổi này lên bản mới nhất của file, nên GUI và CLI chạy song song
+    không ghi đè thay đổi của nhau.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.dirty: Dict[str, Optional[str]] = {}
+
+    def __setitem__(self, key: str, value: str):
+        super().__setitem__(key, value)
+        self.dirty[key] = value
+
+    def __delitem__(self, key: str):
+        super().__delitem__(key)
+        self.dirty[key] = None
+
+    def pop(self, key: str, *default):
+        if key in self:
+            self.dirty[key] = None
+        return super().pop(key, *default)
+
+    def popitem(self):
+        key, value = super().popitem()
+        self.dirty[key] = None
+        return key, value
+
+    def setdefault(self, key: str, default: Optional[str] = None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self):
+        for key in list(self):
+            del self[key]
+
+    def copy(self) -> "EnvConfig":
+        clone = EnvConfig(self)
+        clone.dirty = dict(self.dirty)
+        return clone
+
+    def _reset(self, values: Dict[str, str]):
+        super().clear()
+        super().update(values)
+        self.dirty = {}
+
+
+def _parse_env_value(raw: str) -> str:
+    if raw[:1] == "'":
+        m = re.match(r"'((?:\\.|[^'\\])*)'", raw)
+        if m:
+            return re.sub(r"\\([\\'])", r"\1", m.group(1))
+    elif raw[:1] == '"':
+        m = re.match(r'"((?:\\.|[^"\\])*)"', raw)
+        if m:
+            escapes = {"n": "\n", "t": "\t", "r": "\r"}
+            return re.sub(r"\\(.)", lambda e: escapes.get(e.group(1), e.group(1)), m.group(1))
+    return re.split(r"\s+#", raw, maxsplit=1)[0].strip()
+
+
+def _parse_env_lines(lines: List[str]) -> Dict[str, str]:
+    values: Dict[str, str] = {}
+    for raw_line in lines:
+        m = _ENV_LINE.match(raw_line)
+        if m and not raw_line.lstrip().startswith("#"):
+            values[m.group(1)] = _parse_env_value(m.group(2))
+    return values
+
+
+def _format_env_line(key: str, value: str) -> str:
+    escaped = str(value).replace("\\", "\\\\").replace("'", "\\'")
+    return f"{key}='{escaped}'\n"
+
+
+class _EnvFileLock:
+    """
+    Khoá độc quyền liên tiến trình quanh việc đọc-sửa-ghi .env. Khoá đặt trên file `<.env>.lock`
+    vì chính .env bị thay bằng rename. Người đọc không cần khoá: rename là nguyên tử.
+    """
+
+    def __init__(self, env_path: Path):
+        self.lock_path = env_path.with_name(env_path.name + ".lock")
+        self._fh = None
+
+    def __enter__(self):
+        self._fh = open(self.lock_path, "a+b")
+        if fcntl is not None:
+            fcntl.flock(self._fh.fileno(), fcntl.LOCK_EX)
+        elif msvcrt is not None:
+            self._fh.seek(0)
+            msvcrt.locking(self._fh.fileno(), msvcrt.LK_LOCK, 1)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if fcntl is not None:
+                fcntl.flock(self._fh.fileno(), fcntl.LOCK_UN)
+            elif msvcrt is not None:
+                self._fh.seek(0)
+                msvcrt.locking(self._fh.fileno(), msvcrt.LK_UNLCK, 1)
+        finally:
+            self._fh.close()
+
+
+def _atomic_write_text(path: Path, text: str):
+    """Ghi file tạm cùng thư mục, fsync rồi os.replace — người đọc thấy bản cũ hoặc bản mới, không bao giờ nửa vời."""
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    try:
+        with open(tmp, "w", encoding="utf-8", newline="") as fh:
+            fh.write(text)
+            fh.flush()
+            os.fsync(fh.fileno())
+        if path.exists():
+            os.chmod(tmp, path.stat().st_mode & 0o7777)
+        os.replace(tmp, path)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+
+
+def load_env(env_path: Path) -> EnvConfig:
+    """Đọc .env (parse lại chỉ khi mtime/kích thước đổi). Không đẩy giá trị vào os.environ."""
+    try:
+        st = env_path.stat()
+    except FileNotFoundError:
+        return EnvConfig()
+    key = str(env_path.resolve())
+    stamp = (st.st_mtime_ns, st.st_size)
+    cached = _ENV_CACHE.get(key)
+    if cached is None or cached[0] != stamp:
+        values = _parse_env_lines(env_path.read_text(encoding="utf-8").splitlines(keepends=True))
+        _ENV_CACHE[key] = cached = (stamp, values)
+    return EnvConfig(cached[1])
+
+
+def save_env(env_path: Path, data: Dict[str, str]) -> None:
+    """
+    Ghi các thay đổi của `data` vào .env trong một lần (file tạm + rename), dưới khoá file.
+    Với EnvConfig chỉ các khoá dirty được áp (kể cả xoá) lên nội dung mới nhất trên đĩa, sau đó `data`
+    được đồng bộ với file. Dict thường được coi là danh sách khoá cần đặt (như trước).
+    """
+    changes = data.dirty if isinstance(data, EnvConfig) else dict(data)
+    with _EnvFileLock(env_path):
+        lines = env_path.read_text(encoding="utf-8").splitlines(keepends=True) if env_path.exists() else []
+        if changes:
+            out, seen = [], set()
+            for raw_line in lines:
+                m = _ENV_LINE.match(raw_line)
+                key = m.group(1) if m and not raw_line.lstrip().startswith("#") else None
+                if key in changes:
+                    if changes[key] is not None and key not in seen:
+                        out.append(_format_env_line(key, changes[key]))
+                    seen.add(key)
+                    continue
+                out.append(raw_line)
+            if out and not out[-1].endswith("\n"):
+                out[-1] += "\n"
+            out.extend(_format_env_line(k, v) for k, v in changes.items() if v is not None and k not in seen)
+            if out != lines:
+                _atomic_write_text(env_path, "".join(out))
+            lines = out
+        values = _parse_env_lines(lines)
+        if env_path.exists():
+            st = env_path.stat()
+            _ENV_CACHE[str(env_path.resolve())] = ((st.st_mtime_ns, st.st_size), values)
+    if isinstance(data, EnvConfig):
+        data._reset(values)
+
+
+def get_current_account_index(data: Dict[str, str]) -> int:
+    try:
+        return int(str(data.get("CURRENT_ACCOUNT", "0")).strip())
+    except Exception:
+        return 0
+
+
+def get_account_config(data: Dict[str, str], idx: int) -> Dict[str, str]:
+    # Prioritize account-specific config, fallback to global defaults if idx=0 or not found
+    phone = data.get(f"ACCOUNT_{idx}_PHONE")
+    api_id = data.get(f"ACCOUNT_{idx}_API_ID")
+    api_hash = data.get(f"ACCOUNT_{idx}_API_HASH")
+    download_dir = data.get(f"ACCOUNT_{idx}_DOWNLOAD_DIR")
+
+    # If account-specific config is incomplete, try to use global defaults for 0
+    if not (phone and api_id and api_hash) and idx == 0:
+        phone = data.get("API_PHONE", phone)  # Fallback to a global API_PHONE if you have one
+        api_id = data.get("API_ID", api_id)
+        api_hash = data.get("API_HASH", api_hash)
+        download_dir = data.get("DOWNLOAD_DIR", download_dir)
+
+    return {
+        "PHONE": phone if phone else "",
+        "API_ID": api_id if api_id else "",
+        "API_HASH": api_hash if api_hash else "",
+        "DOWNLOAD_DIR": download_dir if download_dir else "downloads",
+        "STORAGE": data.get(f"ACCOUNT_{idx}_STORAGE", "local") or "local",
+        "S3_BUCKET": data.get(f"ACCOUNT_{idx}_S3_BUCKET", ""),
+        "S3_PREFIX": data.get(f"ACCOUNT_{idx}_S3_PREFIX", ""),
+        "S3_ENDPOINT": data.get(f"ACCOUNT_{idx}_S3_ENDPOINT", ""),
+    }
+
+
+def set_current_account_index(envd: Dict[str, str], idx: int) -> Dict[str, str]:
+    envd["CURRENT_ACCOUNT"] = str(idx)
+    return envd
+
+
+def find_next_account_index(envd: Dict[str, str]) -> int:
+    existing_idxs = {
+        int(k.split("_")[1])
+        for k in envd.keys()
+        if k.startswith("ACCOUNT_") and k.endswith("_PHONE") and k.split("_")[1].isdigit()
+    }
+    return 1 if not existing_idxs else max(existing_idxs) + 1
+
+
+async def do_login_flow(
+        envd: Dict[str, str],
+        log_func: Callable[[str, Optional[str]], None],
+        input_func: Callable[[str, Optional[str], bool], str],
+        phone: Optional[str] = None,
+        api_id: Optional[int] = None,
+        api_hash: Optional[str] = None,
+        download_dir: Optional[str] = None,
+        account_idx_to_use: Optional[int] = None,  # For explicitly selecting an existing index
+        on_connected: Optional[Callable[["TelegramDownloader"], None]] = None
+        # If given, receives the authorized downloader instead of it being disconnected (GUI keeps it alive)
+) -> Tuple[Dict[str, str], int]:
+    """Handles the interactive login flow for CLI/GUI."""
+
+    # If account_idx_to_use is not provided, try to pick one (CLI interactive) or use next available (GUI new account)
+    if account_idx_to_use is None:
+        accounts = []
+        idxs = sorted({
+            int(k.split("_")[1])
+            for k in envd.keys()
+            if k.startswith("ACCOUNT_") and k.endswith("_PHONE") and k.split("_")[1].isdigit()
+        })
+        for idx in idxs:
+            accounts.append({'id': idx, 'phone': envd[f"ACCOUNT_{idx}_PHONE"]})
+
+        if accounts:
+            log_func(pad("Existing accounts:", WIDTH, "left"), "blue")
+            for acc in accounts:
+                log_func(pad(f"  {acc['id']}: {acc['phone']}", WIDTH, "left"))
+
+            while True:
+                choice = await _maybe_await(
+                    input_func("Enter account index to use or 'new' to add a new account", hide_input=False))
+                if choice.lower() == 'new':
+                    account_idx_to_use = find_next_account_index(envd)
+                    break
+                try:
+                    chosen_idx = int(choice)
+                    if chosen_idx in idxs:
+                        account_idx_to_use = chosen_idx
+                        break
+                    else:
+                        log_func("Invalid index. Please try again.", "red")
+                except ValueError:
+                    log_func("Invalid input. Enter an index or 'new'.", "red")
+        else:
+            log_func("No existing accounts. Creating a new one.", "yellow")
+            account_idx_to_use = find_next_account_index(envd)
+
+    current_cfg = get_account_config(envd, account_idx_to_use)
+
+    # Prompt for missing info, or use provided args/env values
+    resolved_phone = phone or (current_cfg["PHONE"] if current_cfg["PHONE"] else None) or await _maybe_await(
+        input_func("Enter phone number (e.g., +84123456789)", hide_input=False))
+    resolved_api_id_str = str(api_id) if api_id else (current_cfg["API_ID"] if current_cfg["API_ID"] else None)
+    if resolved_api_id_str is None:
+        while True:
+            try:
+                resolved_api_id_str = await _maybe_await(
+                    input_func("Enter API ID (from my.telegram.org)", hide_input=False))
+                int(resolved_api_id_str)  # Validate it's an int
+                break
+            except ValueError:
+                log_func("API ID must be a number.", "red")
+    resolved_api_hash = api_hash or (current_cfg["API_HASH"] if current_cfg["API_HASH"] else None) or await _maybe_await(
+        input_func("Enter API Hash (from my.telegram.org)", hide_input=False))
+    resolved_download_dir = download_dir or (
+        current_cfg["DOWNLOAD_DIR"] if current_cfg["DOWNLOAD_DIR"] else None) or await _maybe_await(
+        input_func("Enter download directory", default="downloads", hide_input=False))
+
+    # Update envd with resolved details for the selected index
+    envd[f"ACCOUNT_{account_idx_to_use}_PHONE"] = resolved_phone
+    envd[f"ACCOUNT_{account_idx_to_use}_API_ID"] = resolved_api_id_str
+    envd[f"ACCOUNT_{account_idx_to_use}_API_HASH"] = resolved_api_hash
+    envd[f"ACCOUNT_{account_idx_to_use}_DOWNLOAD_DIR"] = resolved_download_dir
+    envd = set_current_account_index(envd, account_idx_to_use)
+
+    # Initialize and connect downloader to verify credentials
+    downloader = TelegramDownloader(
+        api_id=int(resolved_api_id_str),
+        api_hash=resolved_api_hash,
+        phone=resolved_phone,
+        download_dir=resolved_download_dir,
+        account_index=account_idx_to_use,
+        log_func=log_func,
+        input_func=input_func
+    )
+
+    log_func(pad(f"Attempting to connect with account #{account_idx_to_use} ({resolved_phone})...", WIDTH, "left"),
+             "blue")
+    try:
+        if await downloader.connect_client():
+            log_func(pad(f"Successfully logged in with account #{account_idx_to_use}.", WIDTH, "left"), "green")
+            if on_connected:
+                on_connected(downloader)  # Caller takes ownership of the live connection
+            else:
+                await downloader.client.disconnect()  # Disconnect after successful auth
+            return envd, account_idx_to_use
+        else:
+            log_func(pad("Login verification failed. Please check your credentials.", WIDTH, "left"), "red")
+            return envd, 0  # Return 0 for failure
+    except Exception as e:
+        log_func(pad(f"An error occurred during login verification: {e}", WIDTH, "left"), "red")
+        return envd, 0
+
+
+async def do_logout_flow(
+        envd: Dict[str, str],
+        log_func: Callable[[str, Optional[str]], None],
+        account_index: Optional[int] = None
+) -> Dict[str, str]:
+    """Handles logout for a specific or current account."""
+    idx_to_logout = account_index if account_index is not None else get_current_account_index(envd)
+
+    if idx_to_logout == 0:
+        log_func(pad("No account is currently logged in or specified for logout.", WIDTH, "left"), "yellow")
+        return envd
+
+    log_func(pad(f"Logging out account #{idx_to_logout}...", WIDTH, "left"), "blue")
+
+    # Clear relevant env vars
+    envd.pop(f"ACCOUNT_{idx_to_logout}_PHONE", None)
+    envd.pop(f"ACCOUNT_{idx_to_logout}_API_ID", None)
+    envd.pop(f"ACCOUNT_{idx_to_logout}_API_HASH", None)
+    envd.pop(f"ACCOUNT_{idx_to_logout}_DOWNLOAD_DIR", None)
+    for key in ("STORAGE", "S3_BUCKET", "S3_PREFIX", "S3_ENDPOINT"):
+        envd.pop(f"ACCOUNT_{idx_to_logout}_{key}", None)
+
+    # If the current active account is being logged out, reset CURRENT_ACCOUNT
+    if get_current_account_index(envd) == idx_to_logout:
+        envd["CURRENT_ACCOUNT"] = "0"
+        log_func(pad("Current active account reset.", WIDTH, "left"), "yellow")
+
+    # Purge session file for this account
+    try:
+        session_file = Path("sessions") / f"session_{idx_to_logout}.session"
+        scan_cache_file = Path("sessions") / f"session_{idx_to_logout}_scan.sqlite"
+        state_file = Path(f"session_{idx_to_logout}_state.json")  # State file might be directly in base dir
+        if session_file.exists():
+            session_file.unlink()
+            log_func(pad(f"Deleted session file: {session_file}", WIDTH, "left"), "blue")
+        if scan_cache_file.exists():
+            scan_cache_file.unlink()
+            log_func(pad(f"Deleted scan cache: {scan_cache_file}", WIDTH, "left"), "blue")
+        if state_file.exists():
+            state_file.unlink()
+            log_func(pad(f"Deleted state file: {state_file}", WIDTH, "left"), "blue")
+
+    except Exception as e:
+        log_func(pad(f"Error purging session/state files for account #{idx_to_logout}: {e}", WIDTH, "left"), "red")
+
+    log_func(pad(f"Account #{idx_to_logout} logged out successfully.", WIDTH, "left"), "green")
+    return envd
+
+
+async def do_reset_flow(
+        envd: Dict[str, str],
+        log_func: Callable[[str, Optional[str]], None],
+        confirm: bool = False  # Added confirm parameter for GUI/CLI direct calls
+) -> Dict[str, str]:
+    """Resets all configurations and deletes all session files."""
+    if not confirm:
+        log_func(pad("Reset cancelled.", WIDTH, "left"), "yellow")
+        return envd
+
+    log_func(pad("Resetting all configurations and deleting all session files...", WIDTH, "left"), "red")
+
+    # Clear all account-specific entries and global API keys (if any)
+    keys_to_delete = [k for k in envd.keys() if k.startswith("ACCOUNT_") or k in ["API_ID", "API_HASH", "DOWNLOAD_DIR"]]
+    for key in keys_to_delete:
+        envd.pop(key, None)
+
+    envd["CURRENT_ACCOUNT"] = "0"  # Reset current account to 0
+
+    # Purge all session files
+    try:
+        session_dir = Path("sessions")
+        base_dir = Path(".")
+        if session_dir.exists():
+            for f in session_dir.iterdir():
+                if f.is_file() and f.name.startswith("session_"):
+                    f.unlink()
+            log_func(pad(f"Deleted all files in {session_dir}", WIDTH, "left"), "blue")
+
+        # Also check base directory for state files (e.g., session_1_state.json)
+        for f in base_dir.iterdir():
+            if f.is_file() and f.name.startswith("session_") and f.name.endswith("_state.json"):
+                f.unlink()
+        log_func(pad("Deleted all state files.", WIDTH, "left"), "blue")
+
+    except Exception as e:
+        log_func(pad(f"Error purging session/state files: {e}", WIDTH, "left"), "red")
+
+    log_func(pad("All configurations and session files have been reset.", WIDTH, "left"), "green")
+    return envd
+
+
+# ============================ STATE (RESUME) =============================
+
+class IdRangeSet:
+    """
+    Tập message ID lưu dưới dạng các đoạn [lo, hi] rời nhau, đã sắp xếp. ID trong một dialog gần như
+    liên tục nên một triệu ID thường chỉ là vài đoạn. Kiểm tra/thêm: bisect, O(log số đoạn).
+    Dạng chuỗi (trong file state): "1-5000,5002,5004-9000".
+    """
+
+    __slots__ = ("_lo", "_hi", "_count")
+
+    def __init__(self, ids: Iterable[int] = ()):
+        self._lo: List[int] = []
+        self._hi: List[int] = []
+        self._count = 0
+        for i in sorted(set(int(x) for x in ids)):
+            if self._hi and self._hi[-1] == i - 1:
+                self._hi[-1] = i
+            else:
+                self._lo.append(i)
+                self._hi.append(i)
+            self._count += 1
+
+    def __contains__(self, message_id: int) -> bool:
+        i = bisect.bisect_right(self._lo, message_id) - 1
+        return i >= 0 and message_id <= self._hi[i]
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __iter__(self) -> Iterator[int]:
+        for lo, hi in zip(self._lo, self._hi):
+            yield from range(lo, hi + 1)
+
+    def add(self, message_id: int) -> bool:
+        """Thêm một ID; trả về False nếu đã có."""
+        i = bisect.bisect_right(self._lo, message_id) - 1
+        if i >= 0 and message_id <= self._hi[i]:
+            return False
+        joins_left = i >= 0 and self._hi[i] == message_id - 1
+        joins_right = i + 1 < len(self._lo) and self._lo[i + 1] == message_id + 1
+        if joins_left and joins_right:
+            self._hi[i] = self._hi[i + 1]
+            del self._lo[i + 1], self._hi[i + 1]
+        elif joins_left:
+            self._hi[i] = message_id
+        elif joins_right:
+            self._lo[i + 1] = message_id
+        else:
+            self._lo.insert(i + 1, message_id)
+            self._hi.insert(i + 1, message_id)
+        self._count += 1
+        return True
+
+    def discard_range(self, lo: int, hi: int) -> int:
+        """Bỏ mọi ID trong [lo, hi]; trả về số ID đã bỏ."""
+        removed = 0
+        i = bisect.bisect_right(self._lo, hi) - 1
+        while i >= 0 and self._hi[i] >= lo:
+            r_lo, r_hi = self._lo[i], self._hi[i]
+            removed += min(r_hi, hi) - max(r_lo, lo) + 1
+            pieces = ([(r_lo, lo - 1)] if r_lo < lo else []) + ([(hi + 1, r_hi)] if r_hi > hi else [])
+            self._lo[i:i + 1] = [p[0] for p in pieces]
+            self._hi[i:i + 1] = [p[1] for p in pieces]
+            i -= 1
+        self._count -= removed
+        return removed
+
+    def runs(self) -> List[Tuple[int, int]]:
+        return list(zip(self._lo, self._hi))
+
+    def to_string(self) -> str:
+        return ",".join(str(lo) if lo == hi else f"{lo}-{hi}" for lo, hi in zip(self._lo, self._hi))
+
+    @classmethod
+    def from_string(cls, text: str) -> "IdRangeSet":
+        ranges = cls()
+        parts = [part.partition("-") for part in text.split(",") if part]
+        ranges._lo = [int(lo) for lo, _, _ in parts]
+        ranges._hi = [int(hi or lo) for lo, _, hi in parts]
+        ranges._count = sum(ranges._hi) - sum(ranges._lo) + len(parts)
+        return ranges
+
+
+DIGEST_BLOCK = 1000  # số message ID (theo giá trị) mỗi lá của cây digest
+DIGEST_VERSION = 2  # 2: lá hash cặp (message ID, media ID) để bắt cả media bị sửa
+
+
+def media_digests(entries_by_dialog: Dict[str, Iterable[Tuple[int, int]]], block: int = DIGEST_BLOCK,
+                  upto: Optional[Dict[str, int]] = None) -> Dict[str, Dict[str, Any]]:
+    """
+    Digest hai tầng (kiểu Merkle) cho danh sách media (message ID, media ID): mỗi dialog có một hash cho từng
+    khối ID [k*block, (k+1)*block) và một root trên các hash khối. Root bằng nhau -> dialog không đổi;
+    khác -> so từng khối để biết chính xác khoảng ID nào mất media hoặc có media bị sửa.
+    upto: bỏ các ID lớn hơn mốc này (theo dialog), để so với digest cũ mà không tính tin mới đến.
+    """
+    digests = {}
+    for dialog, entries in entries_by_dialog.items():
+        limit = (upto or {}).get(str(dialog))
+        blocks: Dict[int, List[str]] = {}
+        top = 0
+        for message_id, media_id in sorted(set((int(i), int(m)) for i, m in entries)):
+            if limit is not None and message_id > limit:
+                continue
+            top = message_id
+            blocks.setdefault(message_id // block, []).append(f"{message_id}:{media_id}")
+        leaves = {str(k): hashlib.sha256(",".join(v).encode("ascii")).hexdigest()[:16] for k, v in blocks.items()}
+        root = hashlib.sha256("".join(f"{k}:{h};" for k, h in leaves.items()).encode("ascii")).hexdigest()
+        digests[str(dialog)] = {"v": DIGEST_VERSION, "root": root, "top": top, "blocks": leaves}
+    return digests
+
+
+def changed_ranges(previous: Dict[str, Dict[str, Any]], current: Dict[str, Dict[str, Any]],
+                   block: int = DIGEST_BLOCK) -> Dict[str, List[Tuple[int, int]]]:
+    """
+    Các khoảng ID [lo, hi] mà khối digest lần trước khác lần này, theo dialog (chỉ dialog có ở cả hai lần quét,
+    cùng DIGEST_VERSION). Khối chưa có ở lần trước là media mới, không tính là thay đổi; current nên được
+    dựng với upto = top của lần trước để khối cuối không đổi chỉ vì có tin mới.
+    """
+    changes = {}
+    for dialog, now in current.items():
+        before = previous.get(dialog)
+        if not before or before.get("v") != now.get("v") or before.get("root") == now["root"]:
+            continue
+        ranges = [(int(k) * block, int(k) * block + block - 1) for k in sorted(before.get("blocks", {}), key=int)
+                  if before["blocks"][k] != now["blocks"].get(k)]
+        if ranges:
+            changes[dialog] = ranges
+    return changes
+
+
+class StateManager:
+
+    def __init__(self, account_index: int):  # Removed download_dir from __init__
+        self.account_index = int(account_index)
+        # State file now in base directory, named with account index
+        self.state_file = Path(f"session_{self.account_index}_state.json")
+        self.state = {
+            "account_index": self.account_index,
+            "source": {},  # {"type": "saved|dialogs|all", "dialog_ids": []}
+            # message.id đã tải xong theo dialog: {"<dialog_id>": "1-5000,5002"}; "*" = dialog không rõ (state cũ)
+            "completed": {},
+            "total_found": 0,
+            "digests": {},  # media_digests() của lần quét gần nhất, theo dialog
+            "last_filter": "3",  # 1=photos, 2=videos, 3=both
+            "last_updated": None,
+        }
+        self._completed: Dict[str, IdRangeSet] = {}
+        self._load()
+
+    def _load(self):
+        try:
+            if self.state_file.exists():
+                data = json.loads(self.state_file.read_text(encoding="utf-8"))
+                # chỉ đọc nếu cùng account_index
+                if int(data.get("account_index", -1)) == self.account_index:
+                    legacy = data.pop("completed_ids", None)  # định dạng cũ: mảng JSON, không theo dialog
+                    data.pop("ids_hash", None)  # hash toàn cục cũ, thay bằng digests
+                    self.state.update(data)
+                    self._completed = {k: IdRangeSet.from_string(v)
+                                       for k, v in self.state.get("completed", {}).items()}
+                    if legacy:
+                        self._completed["*"] = IdRangeSet(list(self._completed.get("*", ())) + legacy)
+        except Exception:
+            pass
+
+    def save(self):
+        self.state["last_updated"] = datetime.utcnow().isoformat() + "Z"
+        self.state["completed"] = {k: v.to_string() for k, v in self._completed.items() if len(v)}
+        try:
+            # Ensure the directory for the state file exists (current directory)
+            self.state_file.parent.mkdir(parents=True, exist_ok=True)
+            # Ghi nguyên tử: crash giữa chừng vẫn giữ bản cũ, không làm cụt danh sách ID đã tải
+            _atomic_write_text(self.state_file, json.dumps(self.state, ensure_ascii=False, indent=2))
+        except Exception:
+            pass
+
+    # -- API tiện dụng --
+    def set_source(self, source_type: str, dialog_ids: list[int] | list[str], total_found: int = 0,
+                   digests: Optional[Dict[str, Dict[str, Any]]] = None, last_filter: Optional[str] = None):
+        self.state["source"] = {"type": source_type, "dialog_ids": dialog_ids}
+        if total_found:
+            self.state["total_found"] = int(total_found)
+        if digests:
+            self.state.setdefault("digests", {}).update(digests)  # dialog không quét lần này giữ digest cũ
+        if last_filter is not None:
+            self.state["last_filter"] = str(last_filter)
+        self.save()
+
+    def mark_completed(self, message_id: int, dialog: Optional[Union[int, str]] = None):
+        """message.id chỉ duy nhất trong một dialog, nên ghi theo dialog (None -> "*")."""
+        key = "*" if dialog is None else str(dialog)
+        if self._completed.setdefault(key, IdRangeSet()).add(int(message_id)):
+            self.save()
+
+    def is_completed(self, message_id: int, dialog: Optional[Union[int, str]] = None) -> bool:
+        message_id = int(message_id)
+        if dialog is not None and message_id in self._completed.get(str(dialog), ()):
+            return True
+        return message_id in self._completed.get("*", ())
+
+    def get_digests(self) -> Dict[str, Dict[str, Any]]:
+        return self.state.get("digests", {})
+
+    def media_root(self) -> str:
+        """Một hash trên root của mọi dialog (hiển thị trong status)."""
+        roots = sorted(f"{k}:{v['root']}" for k, v in self.get_digests().items())
+        return hashlib.sha256(";".join(roots).encode("ascii")).hexdigest() if roots else ""
+
+    def forget_completed(self, dialog: Union[int, str], lo: int, hi: int, save: bool = True) -> int:
+        """Bỏ đánh dấu hoàn tất trong [lo, hi] để lần tải sau kiểm tra lại (file đã lưu vẫn được bỏ qua)."""
+        removed = sum(ids.discard_range(lo, hi) for key, ids in self._completed.items() if key in (str(dialog), "*"))
+        if removed and save:
+            self.save()
+        return removed
+
+    def add_found(self, count: int = 1):
+        """Cộng thêm media mới phát hiện (chế độ watch) vào tổng."""
+        self.state["total_found"] = int(self.state.get("total_found", 0)) + int(count)
+        self.save()
+
+    def completed_count(self) -> int:
+        return sum(len(ids) for ids in self._completed.values())
+
+    def total_found(self) -> int:
+        return int(self.state.get("total_found", 0))
+
+    def source_label(self) -> str:
+        s = self.state.get("source", {})
+        typ = s.get("type", "unknown")
+        ids = s.get("dialog_ids", [])
+        if typ == "saved":
+            return "Saved Messages (me)"
+        if typ == "all":
+            return f"Tất cả dialogs/channels ({len(ids)} nguồn)"
+        if typ == "dialogs":
+            return f"Dialogs chọn lọc ({len(ids)} nguồn)"
+        return "unknown"
+
+    def get_status_lines(self, download_dir: Path) -> list[str]:  # Added download_dir param
+        return [
+            f"Tài khoản: #{self.account_index}",
+            f"Nguồn: {self.source_label()}",
+            f"Tiến độ: {self.completed_count()}/{self.total_found()}",
+            f"Download dir: {download_dir}",
+            f"Media digest: {self.media_root()[:16] or '-'} ({len(self.get_digests())} dialog)",
+            f"Bộ lọc cuối: {self.state.get('last_filter', '3')}",
+            f"Lần cập nhật: {self.state.get('last_updated') or '-'}",
+        ]
+
+    def get_source(self) -> Dict[str, Any]:
+        return self.state.get("source", {})
+
+    def get_last_filter(self) -> str:
+        return str(self.state.get("last_filter", "3"))
+
+    def clear_progress(self):
+        self._completed = {}
+        self.state["total_found"] = 0
+        self.state["digests"] = {}
+        self.save()
+
+
+class MirrorManifest:
+    """
+    Manifest resume của lệnh mirror: message ID đã chuyển sang từng đích, theo dialog nguồn, lưu dạng
+    ID runs như StateManager. File session_<n>_mirror.json cạnh file state.
+    """
+
+    def __init__(self, account_index: int):
+        self.account_index = int(account_index)
+        self.manifest_file = Path(f"session_{self.account_index}_mirror.json")
+        self._sent: Dict[str, Dict[str, IdRangeSet]] = {}
+        try:
+            data = json.loads(self.manifest_file.read_text(encoding="utf-8"))
+            if int(data.get("account_index", -1)) == self.account_index:
+                self._sent = {dest: {src: IdRangeSet.from_string(runs) for src, runs in sources.items()}
+                              for dest, sources in data.get("destinations", {}).items()}
+        except (OSError, ValueError):
+            pass
+
+    def is_mirrored(self, destination: str, dialog: Union[int, str], message_id: int) -> bool:
+        ids = self._sent.get(str(destination), {}).get(str(dialog))
+        return ids is not None and int(message_id) in ids
+
+    def mark_mirrored(self, destination: str, dialog: Union[int, str], message_ids: Iterable[int]):
+        ids = self._sent.setdefault(str(destination), {}).setdefault(str(dialog), IdRangeSet())
+        for message_id in message_ids:
+            ids.add(int(message_id))
+
+    def count(self, destination: str) -> int:
+        return sum(len(ids) for ids in self._sent.get(str(destination), {}).values())
+
+    def save(self):
+        data = {"account_index": self.account_index,
+                "last_updated": datetime.utcnow().isoformat() + "Z",
+                "destinations": {dest: {src: ids.to_string() for src, ids in sources.items() if len(ids)}
+                                 for dest, sources in self._sent.items()}}
+        _atomic_write_text(self.manifest_file, json.dumps(data, ensure_ascii=False, indent=2))
+
+
+# ============================ SCAN CACHE =============================
+
+SCAN_CHECKPOINT_PAGES = 10  # ghi tiến độ quét vào cache sau mỗi N trang (100 tin/trang)
+SCAN_SHARDS = 4  # số cursor iter_messages chạy song song trên một dialog lớn
+SCAN_SHARD_MIN_SPAN = 20000  # khoảng ID chưa quét nhỏ hơn mức này vẫn quét bằng một cursor
+
+
+def shard_id_range(min_id: int, max_id: int, top: int, shards: int) -> List[Tuple[int, int]]:
+    """
+    Chia khoảng (min_id, max_id) loại trừ hai đầu (max_id = 0: không giới hạn, top = ID mới nhất)
+    thành tối đa `shards` khoảng con cùng dạng, sắp từ mới đến cũ. Khoảng trên cùng giữ max_id gốc.
+    """
+    span = top - min_id
+    if shards <= 1 or span < SCAN_SHARD_MIN_SPAN:
+        return [(min_id, max_id)]
+    cuts = list(range(min_id, top, -(-span // shards)))
+    ranges = [(lo, nxt + 1) for lo, nxt in zip(cuts, cuts[1:])] + [(cuts[-1], max_id)]
+    return list(reversed(ranges))
+
+
+class ScanCache:
+    """
+    Cache cục bộ (SQLite, mỗi tài khoản một file) các media đã quét.
+    Lưu theo dialog: các khoảng message ID [lo, hi] đã duyệt trọn vẹn và message
+    (dạng TL bytes) của những tin có media nằm trong các khoảng đó.
+    """
+
+    def __init__(self, account_index: int):
+        self.account_index = int(account_index)
+        # Nằm trong sessions/ với tiền tố session_ để reset/logout dọn cùng session
+        self.db_file = Path("sessions") / f"session_{self.account_index}_scan.sqlite"
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self.db_file.parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(str(self.db_file), check_same_thread=False)
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS ranges (
+                    dialog TEXT NOT NULL, lo INTEGER NOT NULL, hi INTEGER NOT NULL,
+                    PRIMARY KEY (dialog, lo));
+                CREATE TABLE IF NOT EXISTS media (
+                    dialog TEXT NOT NULL, msg_id INTEGER NOT NULL, type TEXT NOT NULL, raw BLOB NOT NULL,
+                    PRIMARY KEY (dialog, msg_id));
+                CREATE TABLE IF NOT EXISTS entities (
+                    dialog TEXT NOT NULL, peer_id INTEGER NOT NULL, raw BLOB NOT NULL,
+                    PRIMARY KEY (dialog, peer_id));
+            """)
+        return self._conn
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def covered(self, dialog: str) -> List[Tuple[int, int]]:
+        rows = self._db().execute("SELECT lo, hi FROM ranges WHERE dialog = ? ORDER BY lo", (dialog,))
+        return [(int(lo), int(hi)) for lo, hi in rows]
+
+    def gaps(self, dialog: str) -> List[Tuple[int, int]]:
+        """
+        Các khoảng chưa quét, dạng (min_id, max_id) loại trừ hai đầu như iter_messages;
+        max_id = 0 nghĩa là không giới hạn trên. Sắp xếp từ mới đến cũ.
+        """
+        gaps = []
+        prev_hi = 0
+        for lo, hi in self.covered(dialog):
+            if lo > prev_hi + 1:
+                gaps.append((prev_hi, lo))
+            prev_hi = max(prev_hi, hi)
+        gaps.append((prev_hi, 0))
+        return list(reversed(gaps))
+
+    @staticmethod
+    def _merge_range(db: sqlite3.Connection, dialog: str, lo: int, hi: int):
+        if hi < lo:
+            return
+        rows = db.execute(
+            "SELECT lo, hi FROM ranges WHERE dialog = ? AND hi >= ? AND lo <= ?",
+            (dialog, lo - 1, hi + 1)).fetchall()
+        for r_lo, r_hi in rows:
+            lo, hi = min(lo, r_lo), max(hi, r_hi)
+        db.execute("DELETE FROM ranges WHERE dialog = ? AND lo >= ? AND hi <= ?", (dialog, lo, hi))
+        db.execute("INSERT INTO ranges (dialog, lo, hi) VALUES (?, ?, ?)", (dialog, lo, hi))
+
+    @staticmethod
+    def _insert_media(db: sqlite3.Connection, dialog: str, entries: List[Tuple[Any, str]]):
+        if entries:
+            db.executemany(
+                "INSERT OR REPLACE INTO media (dialog, msg_id, type, raw) VALUES (?, ?, ?, ?)",
+                [(dialog, int(m.id), t, bytes(m)) for m, t in entries])
+            # Người gửi (User/Channel) đi kèm, để message dựng lại từ cache vẫn có sender cho catalog
+            senders = {int(m.sender_id): m.sender for m, _t in entries
+                       if getattr(m, "sender", None) is not None and getattr(m, "sender_id", None) is not None}
+            db.executemany(
+                "INSERT OR REPLACE INTO entities (dialog, peer_id, raw) VALUES (?, ?, ?)",
+                [(dialog, peer_id, bytes(sender)) for peer_id, sender in senders.items()])
+
+    def add_range(self, dialog: str, lo: int, hi: int):
+        """Ghi nhận [lo, hi] đã quét trọn, gộp với các khoảng chồng lấn hoặc liền kề."""
+        db = self._db()
+        with db:
+            self._merge_range(db, dialog, lo, hi)
+
+    def add_media(self, dialog: str, entries: List[Tuple[Any, str]]):
+        """entries: danh sách (message, type)."""
+        db = self._db()
+        with db:
+            self._insert_media(db, dialog, entries)
+
+    def checkpoint(self, dialog: str, entries: List[Tuple[Any, str]], lo: int, hi: int):
+        """Ghi media vừa quét và khoảng [lo, hi] trong cùng một transaction (không bao giờ có khoảng thiếu media)."""
+        db = self._db()
+        with db:
+            self._insert_media(db, dialog, entries)
+            self._merge_range(db, dialog, lo, hi)
+
+    def drop_media(self, dialog: str, message_ids: List[int]):
+        """Bỏ các media không còn (tin bị xoá hoặc không còn ảnh/video); khoảng đã quét giữ nguyên."""
+        if not message_ids:
+            return
+        db = self._db()
+        with db:
+            db.executemany("DELETE FROM media WHERE dialog = ? AND msg_id = ?",
+                           [(dialog, int(mid)) for mid in message_ids])
+
+    def load_media(self, dialog: str) -> List[Tuple[Any, str]]:
+        rows = self._db().execute(
+            "SELECT type, raw FROM media WHERE dialog = ? ORDER BY msg_id DESC", (dialog,))
+        _load_telethon()
+        return [(BinaryReader(raw).tgread_object(), t) for t, raw in rows]
+
+    def load_entities(self, dialog: str) -> Dict[int, Any]:
+        """peer_id (dạng marked) -> entity người gửi đã lưu cùng media của dialog."""
+        rows = self._db().execute("SELECT peer_id, raw FROM entities WHERE dialog = ?", (dialog,))
+        _load_telethon()
+        return {int(peer_id): BinaryReader(raw).tgread_object() for peer_id, raw in rows}
+
+    def clear(self, dialog: Optional[str] = None):
+        db = self._db()
+        with db:
+            if dialog is None:
+                db.execute("DELETE FROM ranges")
+                db.execute("DELETE FROM media")
+                db.execute("DELETE FROM entities")
+            else:
+                db.execute("DELETE FROM ranges WHERE dialog = ?", (dialog,))
+                db.execute("DELETE FROM media WHERE dialog = ?", (dialog,))
+                db.execute("DELETE FROM entities WHERE dialog = ?", (dialog,))
+
+
+UPLOAD_HANDLE_TTL = 20 * 3600  # giây; Telegram giữ phần file đã upload "chưa tới một ngày"
+
+
+class UploadCache:
+    """
+    Cache (SQLite, mỗi tài khoản một file) handle InputFile/InputFileBig của các file đã upload, theo SHA-256
+    nội dung. Trong thời hạn UPLOAD_HANDLE_TTL, gửi lại cùng nội dung (đích khác, job sau) không phải upload lại.
+    """
+
+    def __init__(self, account_index: int):
+        self.account_index = int(account_index)
+        self.db_file = Path("sessions") / f"session_{self.account_index}_uploads.sqlite"
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self.db_file.parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(str(self.db_file), check_same_thread=False)
+            with self._conn:
+                self._conn.execute("""
+                    CREATE TABLE IF NOT EXISTS handles (
+                        sha256 TEXT PRIMARY KEY, raw BLOB NOT NULL, size INTEGER NOT NULL,
+                        uploaded_at REAL NOT NULL)""")
+                self._conn.execute("DELETE FROM handles WHERE uploaded_at < ?", (time.time() - UPLOAD_HANDLE_TTL,))
+        return self._conn
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def get(self, sha256: str) -> Optional[Any]:
+        row = self._db().execute("SELECT raw FROM handles WHERE sha256 = ? AND uploaded_at >= ?",
+                                 (sha256, time.time() - UPLOAD_HANDLE_TTL)).fetchone()
+        if row is None:
+            return None
+        _load_telethon()
+        return BinaryReader(row[0]).tgread_object()
+
+    def put(self, sha256: str, handle: Any, size: int):
+        db = self._db()
+        with db:
+            db.execute("INSERT OR REPLACE INTO handles (sha256, raw, size, uploaded_at) VALUES (?, ?, ?, ?)",
+                       (sha256, bytes(handle), int(size), time.time()))
+
+    def drop(self, sha256: str):
+        db = self._db()
+        with db:
+            db.execute("DELETE FROM handles WHERE sha256 = ?", (sha256,))
+
+
+# ============================ CATALOG (MEDIA ĐÃ TẢI) =============================
+
+class MediaCatalog:
+    """
+    Catalog SQLite của media đã tải, đặt tại <download_dir>/catalog.sqlite.
+    Mỗi dòng là một file: dialog, message ID, ngày, loại, MIME, kích thước, đường dẫn, người gửi, caption.
+    """
+
+    COLUMNS = ("dialog_id", "dialog_title", "message_id", "date", "type", "mime", "size",
+               "path", "sender_id", "sender_name", "caption", "downloaded_at", "sha256")
+
+    def __init__(self, download_dir: Path):
+        self.db_file = Path(download_dir) / "catalog.sqlite"
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self.db_file.parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(str(self.db_file), check_same_thread=False)
+            self._conn.row_factory = sqlite3.Row
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS media (
+                    dialog_id INTEGER NOT NULL, dialog_title TEXT, message_id INTEGER NOT NULL,
+                    date INTEGER NOT NULL, type TEXT NOT NULL, mime TEXT, size INTEGER NOT NULL DEFAULT 0,
+                    path TEXT NOT NULL, sender_id INTEGER, sender_name TEXT, caption TEXT,
+                    downloaded_at INTEGER, sha256 TEXT,
+                    PRIMARY KEY (dialog_id, message_id));
+                CREATE INDEX IF NOT EXISTS idx_media_date ON media (date);
+                CREATE INDEX IF NOT EXISTS idx_media_dialog_date ON media (dialog_id, date);
+                CREATE INDEX IF NOT EXISTS idx_media_size ON media (size);
+            """)
+            # Catalog tạo trước khi có cột sha256
+            cols = {r[1] for r in self._conn.execute("PRAGMA table_info(media)")}
+            if "sha256" not in cols:
+                with self._conn:
+                    self._conn.execute("ALTER TABLE media ADD COLUMN sha256 TEXT")
+        return self._conn
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def record(self, row: Dict[str, Any], replace: bool = True):
+        """Ghi một dòng; replace=False giữ nguyên dòng đã có (dùng khi chỉ bổ sung file bị bỏ qua)."""
+        verb = "INSERT OR REPLACE" if replace else "INSERT OR IGNORE"
+        cols = ", ".join(self.COLUMNS)
+        marks = ", ".join("?" for _ in self.COLUMNS)
+        db = self._db()
+        with db:
+            db.execute(f"{verb} INTO media ({cols}) VALUES ({marks})", [row.get(k) for k in self.COLUMNS])
+
+    def _resolve_dialog_ids(self, dialog: str) -> List[int]:
+        """Dialog theo ID (số) hoặc theo tên (khớp một phần, không phân biệt hoa thường)."""
+        if re.fullmatch(r"-?\d+", dialog.strip()):
+            n = int(dialog)
+            # Cho phép cả ID thô (12345) lẫn ID có dấu của Telethon (-12345, -1000000012345)
+            return [n] if n < 0 else [n, -n, -(1000000000000 + n)]
+        rows = self._db().execute(
+            "SELECT DISTINCT dialog_id FROM media WHERE dialog_title LIKE ? COLLATE NOCASE",
+            (f"%{dialog.strip().lstrip('@')}%",))
+        return [int(r[0]) for r in rows]
+
+    def query(self, dialog: Optional[str] = None, media_type: Optional[str] = None,
+              since: Optional[datetime] = None, until: Optional[datetime] = None,
+              min_size: Optional[int] = None, max_size: Optional[int] = None,
+              limit: Optional[int] = None, order: str = "date"):
+        """Trả về iterator các sqlite3.Row khớp bộ lọc, dùng các index date/dialog/size."""
+        where, params = [], []
+        if dialog:
+            ids = self._resolve_dialog_ids(dialog)
+            if not ids:
+                return iter(())
+            where.append(f"dialog_id IN ({', '.join('?' for _ in ids)})")
+            params.extend(ids)
+        if media_type:
+            where.append("type = ?")
+            params.append(media_type)
+        if since:
+            where.append("date >= ?")
+            params.append(int(since.timestamp()))
+        if until:
+            where.append("date < ?")
+            params.append(int(until.timestamp()))
+        if min_size is not None:
+            where.append("size >= ?")
+            params.append(int(min_size))
+        if max_size is not None:
+            where.append("size <= ?")
+            params.append(int(max_size))
+        sql = "SELECT * FROM media"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY size DESC" if order == "size" else " ORDER BY date"
+        if limit:
+            sql += f" LIMIT {int(limit)}"
+        return self._db().execute(sql, params)
+
+
+VERIFY_CHUNK = 8 * 1024 * 1024  # bytes mỗi lần đưa vào hashlib khi kiểm tra
+
+
+def sha256_file(path: Union[str, Path], chunk_size: int = VERIFY_CHUNK) -> str:
+    """SHA-256 của file đọc qua mmap: không copy vào bộ nhớ Python, và hashlib nhả GIL nên nhiều thread hash song song."""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size:  # mmap không nhận file rỗng
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+                for start in range(0, len(view), chunk_size):
+                    with view[start:start + chunk_size] as part:
+                        h.update(part)
+    return h.hexdigest()
+
+
+def _verify_file(path: str, size: Optional[int], sha256: Optional[str], check_hash: bool) -> Tuple[str, str]:
+    try:
+        actual = os.path.getsize(path)
+    except OSError:
+        return "missing", ""
+    if size and actual != size:
+        return "corrupt", f"size {actual} != {size}"
+    if check_hash and sha256:
+        digest = sha256_file(path)
+        if digest != sha256:
+            return "corrupt", f"sha256 {digest[:12]} != {sha256[:12]}"
+    return "ok", ""
+
+
+def verify_catalog(catalog: MediaCatalog, workers: int = 4, check_hash: bool = True,
+                   **filters) -> Iterator[Tuple[str, Any, str]]:
+    """
+    Kiểm tra các file trong catalog với kích thước và SHA-256 đã ghi (nếu có), sinh (status, row, chi tiết)
+    với status là ok / missing / corrupt / remote. Dòng được đọc dần từ SQLite và tối đa 2*workers file
+    đang được kiểm tra cùng lúc, nên bộ nhớ không phụ thuộc kích thước kho.
+    """
+    from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+    workers = max(1, int(workers))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        in_flight: Dict[Any, Any] = {}
+        for row in catalog.query(**filters):
+            if str(row["path"]).startswith("s3://"):
+                yield "remote", row, ""
+                continue
+            in_flight[pool.submit(_verify_file, row["path"], row["size"], row["sha256"], check_hash)] = row
+            if len(in_flight) < workers * 2:
+                continue
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for fut in done:
+                status, detail = fut.result()
+                yield status, in_flight.pop(fut), detail
+        for fut in list(in_flight):
+            status, detail = fut.result()
+            yield status, in_flight.pop(fut), detail
+
+
+# ============================ STORAGE BACKENDS =============================
+
+PARTIAL_SUFFIX = ".part"  # file đang tải dở; chỉ được đổi tên thành tên thật khi đã đủ byte
+PARTIAL_MAX_AGE = 3600  # giây; file .part không đổi lâu hơn mức này được coi là mồ côi
+LOCAL_WRITE_BATCH = 4 * 1024 * 1024  # bytes gom lại trước mỗi lần ghi đĩa ở thread phụ
+
+
+def partial_path(path: Path) -> Path:
+    return path.with_name(path.name + PARTIAL_SUFFIX)
+
+
+class StorageWriter:
+    """Nhận dữ liệu theo từng chunk; commit() trả về vị trí cuối cùng, abort() dọn phần dở dang."""
+
+    async def write(self, chunk: bytes) -> None:
+        raise NotImplementedError
+
+    async def commit(self) -> str:
+        raise NotImplementedError
+
+    async def abort(self) -> None:
+        raise NotImplementedError
+
+
+class StorageBackend:
+    """
+    Nơi lưu media đã tải. Mọi backend nhận khoá tương đối (vd. 2023/05/photo_123.jpg)
+    do TelegramDownloader._relative_path_for sinh ra.
+    """
+    name = "base"
+
+    def locate(self, rel: PurePosixPath) -> str:
+        raise NotImplementedError
+
+    def local_path(self, rel: PurePosixPath) -> Optional[Path]:
+        """Đường dẫn trên đĩa nếu backend là local (cho phép Telethon ghi thẳng), None nếu không."""
+        return None
+
+    def stat_size(self, rel: PurePosixPath) -> Optional[int]:
+        """Kích thước object đã lưu, None nếu chưa có."""
+        raise NotImplementedError
+
+    def open_writer(self, rel: PurePosixPath) -> StorageWriter:
+        raise NotImplementedError
+
+    def sweep_partials(self, max_age: float = PARTIAL_MAX_AGE) -> int:
+        """Xoá phần tải dở bị bỏ lại (tiến trình chết giữa chừng); trả về số mục đã xoá."""
+        return 0
+
+    def describe(self) -> str:
+        return self.name
+
+
+class _LocalFileWriter(StorageWriter):
+    """Ghi vào <tên>.part rồi os.replace sang tên thật khi commit, nên file dở dang không bao giờ mang tên thật."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.tmp = partial_path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._fh = open(self.tmp, "wb")
+        self._buf = bytearray()
+
+    async def write(self, chunk: bytes) -> None:
+        # Gom chunk rồi ghi theo lô ở thread phụ (như backend S3), để đĩa chậm không chặn event loop
+        self._buf += chunk
+        if len(self._buf) >= LOCAL_WRITE_BATCH:
+            await self._flush()
+
+    async def _flush(self) -> None:
+        if self._buf:
+            data, self._buf = self._buf, bytearray()
+            await asyncio.to_thread(self._fh.write, data)
+
+    def _finalize(self) -> None:
+        self._fh.flush()
+        os.fsync(self._fh.fileno())
+        self._fh.close()
+        os.replace(self.tmp, self.path)
+
+    def _discard(self) -> None:
+        self._fh.close()
+        try:
+            self.tmp.unlink()
+        except FileNotFoundError:
+            pass
+
+    async def commit(self) -> str:
+        await self._flush()
+        await asyncio.to_thread(self._finalize)
+        return str(self.path)
+
+    async def abort(self) -> None:
+        self._buf = bytearray()
+        await asyncio.to_thread(self._discard)
+
+
+class LocalStorage(StorageBackend):
+    """Cây thư mục năm/tháng ngay trong download_dir (bố cục mặc định)."""
+    name = "local"
+
+    def __init__(self, root: Path):
+        self.root = Path(root)
+
+    def local_path(self, rel: PurePosixPath) -> Optional[Path]:
+        return self.root.joinpath(*rel.parts)
+
+    def locate(self, rel: PurePosixPath) -> str:
+        return str(self.local_path(rel))
+
+    def stat_size(self, rel: PurePosixPath) -> Optional[int]:
+        try:
+            return os.path.getsize(self.local_path(rel))
+        except OSError:
+            return None
+
+    def open_writer(self, rel: PurePosixPath) -> StorageWriter:
+        return _LocalFileWriter(self.local_path(rel))
+
+    def sweep_partials(self, max_age: float = PARTIAL_MAX_AGE) -> int:
+        # Chỉ xoá file cũ: tiến trình khác (tài khoản khác cùng thư mục) có thể đang ghi file .part mới
+        cutoff = time.time() - max_age
+        removed = 0
+        for dirpath, _dirs, files in os.walk(self.root):
+            for name in files:
+                if not name.endswith(PARTIAL_SUFFIX):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    if os.path.getmtime(path) < cutoff:
+                        os.remove(path)
+                        removed += 1
+                except OSError:
+                    pass
+        return removed
+
+    def describe(self) -> str:
+        return f"local:{self.root}"
+
+
+class ShardedLocalStorage(LocalStorage):
+    """
+    Bố cục phân mảnh: root/ab/cd/<tên file>, với ab/cd lấy từ sha1 của khoá tương đối,
+    để không thư mục nào phình tới hàng trăm nghìn file.
+    """
+    name = "sharded"
+
+    def __init__(self, root: Path, depth: int = 2):
+        super().__init__(root)
+        self.depth = max(1, int(depth))
+
+    def local_path(self, rel: PurePosixPath) -> Optional[Path]:
+        h = hashlib.sha1(str(rel).encode("utf-8")).hexdigest()
+        shards = [h[i * 2:i * 2 + 2] for i in range(self.depth)]
+        return self.root.joinpath(*shards, rel.name)
+
+    def describe(self) -> str:
+        return f"sharded:{self.root}"
+
+
+class _S3MultipartWriter(StorageWriter):
+    """
+    Ghi stream vào multipart upload. Dữ liệu được gom vào một bộ đệm cố định (part_size)
+    dùng lại cho mọi part, nên không file nào được lưu tạm trên đĩa.
+    """
+
+    def __init__(self, storage: "S3Storage", key: str):
+        self.storage = storage
+        self.key = key
+        self._buf = bytearray(storage.part_size)
+        self._view = memoryview(self._buf)
+        self._fill = 0
+        self._size = 0
+        self._upload_id: Optional[str] = None
+        self._parts: List[Dict[str, Any]] = []
+
+    async def write(self, chunk: bytes) -> None:
+        mv = memoryview(chunk)
+        while mv:
+            n = min(len(mv), len(self._buf) - self._fill)
+            self._view[self._fill:self._fill + n] = mv[:n]
+            self._fill += n
+            mv = mv[n:]
+            if self._fill == len(self._buf):
+                await self._flush_part()
+
+    async def _flush_part(self):
+        s3 = self.storage.client
+        if self._upload_id is None:
+            resp = await asyncio.to_thread(s3.create_multipart_upload, Bucket=self.storage.bucket, Key=self.key)
+            self._upload_id = resp["UploadId"]
+        body = self._buf if self._fill == len(self._buf) else bytes(self._view[:self._fill])
+        part_no = len(self._parts) + 1
+        resp = await asyncio.to_thread(s3.upload_part, Bucket=self.storage.bucket, Key=self.key,
+                                       UploadId=self._upload_id, PartNumber=part_no, Body=body)
+        self._parts.append({"ETag": resp["ETag"], "PartNumber": part_no})
+        self._size += self._fill
+        self._fill = 0
+
+    async def commit(self) -> str:
+        s3 = self.storage.client
+        if self._upload_id is None:
+            # File nhỏ hơn một part: một PUT là đủ
+            await asyncio.to_thread(s3.put_object, Bucket=self.storage.bucket, Key=self.key,
+                                    Body=bytes(self._view[:self._fill]))
+            self._size = self._fill
+        else:
+            if self._fill:
+                await self._flush_part()
+            await asyncio.to_thread(s3.complete_multipart_upload, Bucket=self.storage.bucket, Key=self.key,
+                                    UploadId=self._upload_id, MultipartUpload={"Parts": self._parts})
+        self.storage.remember(self.key, self._size)
+        return f"s3://{self.storage.bucket}/{self.key}"
+
+    async def abort(self) -> None:
+        if self._upload_id is not None:
+            try:
+                await asyncio.to_thread(self.storage.client.abort_multipart_upload, Bucket=self.storage.bucket,
+                                        Key=self.key, UploadId=self._upload_id)
+            except Exception:
+                pass
+
+
+class S3Storage(StorageBackend):
+    """
+    Object store tương thích S3 (AWS, MinIO, ...). Thông tin đăng nhập lấy theo chuẩn boto3
+    (AWS_ACCESS_KEY_ID / AWS_SECRET_ACCESS_KEY / ~/.aws); endpoint_url cho MinIO hoặc bản cục bộ.
+    """
+    name = "s3"
+
+    def __init__(self, bucket: str, prefix: str = "", endpoint_url: Optional[str] = None,
+                 part_size: int = 8 * 1024 * 1024, client: Any = None):
+        if client is None:
+            if boto3 is None:
+                raise RuntimeError("Missing package: boto3. Install: pip install boto3")
+            client = boto3.client("s3", endpoint_url=endpoint_url or None)
+        if not bucket:
+            raise ValueError("S3 storage requires a bucket name.")
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        self.part_size = max(int(part_size), 5 * 1024 * 1024)  # S3 yêu cầu part >= 5 MiB
+        self._known: Optional[Dict[str, int]] = None
+
+    def _key(self, rel: PurePosixPath) -> str:
+        return f"{self.prefix}/{rel}" if self.prefix else str(rel)
+
+    def locate(self, rel: PurePosixPath) -> str:
+        return f"s3://{self.bucket}/{self._key(rel)}"
+
+    def _load_listing(self) -> Dict[str, int]:
+        # Liệt kê một lần thay vì HEAD từng object khi kiểm tra resume
+        known: Dict[str, int] = {}
+        paginator = self.client.get_paginator("list_objects_v2")
+        kwargs = {"Bucket": self.bucket}
+        if self.prefix:
+            kwargs["Prefix"] = self.prefix + "/"
+        for page in paginator.paginate(**kwargs):
+            for obj in page.get("Contents", []) or []:
+                known[obj["Key"]] = int(obj["Size"])
+        return known
+
+    def stat_size(self, rel: PurePosixPath) -> Optional[int]:
+        if self._known is None:
+            self._known = self._load_listing()
+        return self._known.get(self._key(rel))
+
+    def remember(self, key: str, size: int):
+        if self._known is not None:
+            self._known[key] = int(size)
+
+    def open_writer(self, rel: PurePosixPath) -> StorageWriter:
+        return _S3MultipartWriter(self, self._key(rel))
+
+    def describe(self) -> str:
+        return self.locate(PurePosixPath(""))
+
+
+STORAGE_CHOICES = ("local", "sharded", "s3")
+
+
+def make_storage(kind: Optional[str], download_dir: Union[str, Path], bucket: Optional[str] = None,
+                 prefix: Optional[str] = None, endpoint_url: Optional[str] = None) -> StorageBackend:
+    kind = (kind or "local").lower()
+    if kind == "local":
+        return LocalStorage(Path(download_dir))
+    if kind == "sharded":
+        return ShardedLocalStorage(Path(download_dir))
+    if kind == "s3":
+        return S3Storage(bucket or "", prefix or "", endpoint_url)
+    raise ValueError(f"Unknown storage backend '{kind}'. Choose one of: {', '.join(STORAGE_CHOICES)}")
+
+
+# ============================ CHUNK PIPELINE =============================
+
+class ChunkProcessor:
+    """
+    Một khâu xử lý trong pipeline: nhận từng chunk (memoryview, không sao chép) khi media
+    đang được tải. finish() trả về dict kết quả được gộp vào kết quả chung của pipeline.
+    """
+
+    async def feed(self, view: memoryview) -> None:
+        raise NotImplementedError
+
+    async def finish(self) -> Dict[str, Any]:
+        return {}
+
+    async def abort(self) -> None:
+        pass
+
+
+class Sha256Processor(ChunkProcessor):
+    def __init__(self):
+        self._h = hashlib.sha256()
+
+    async def feed(self, view: memoryview) -> None:
+        self._h.update(view)
+
+    async def finish(self) -> Dict[str, Any]:
+        return {"sha256": self._h.hexdigest()}
+
+
+class SizeCheckProcessor(ChunkProcessor):
+    """Đếm byte; báo lỗi nếu tổng khác kích thước Telegram báo (khi biết trước)."""
+
+    def __init__(self, expected: Optional[int] = None):
+        self.expected = expected or None
+        self.size = 0
+
+    async def feed(self, view: memoryview) -> None:
+        self.size += view.nbytes
+
+    async def finish(self) -> Dict[str, Any]:
+        if self.expected is not None and self.size != self.expected:
+            raise ValueError(f"Size mismatch: got {self.size} bytes, expected {self.expected}")
+        return {"size": self.size}
+
+
+class FormatSniffer(ChunkProcessor):
+    """Nhận diện định dạng thật từ các byte đầu (magic number), không phụ thuộc MIME khai báo."""
+
+    HEAD = 16
+    SIGNATURES = (
+        (0, b"\xff\xd8\xff", "image/jpeg"),
+        (0, b"\x89PNG\r\n\x1a\n", "image/png"),
+        (0, b"GIF8", "image/gif"),
+        (8, b"WEBP", "image/webp"),
+        (8, b"AVI ", "video/x-msvideo"),
+        (4, b"ftypqt", "video/quicktime"),
+        (4, b"ftyp", "video/mp4"),
+        (0, b"\x1a\x45\xdf\xa3", "video/x-matroska"),
+    )
+
+    def __init__(self):
+        self._head = bytearray()
+
+    async def feed(self, view: memoryview) -> None:
+        if len(self._head) < self.HEAD:
+            self._head += view[:self.HEAD - len(self._head)]
+
+    @classmethod
+    def sniff(cls, head: bytes) -> Optional[str]:
+        for offset, magic, mime in cls.SIGNATURES:
+            if head[offset:offset + len(magic)] == magic:
+                return mime
+        return None
+
+    async def finish(self) -> Dict[str, Any]:
+        return {"sniffed_mime": self.sniff(bytes(self._head))}
+
+
+class StorageSink(ChunkProcessor):
+    """Khâu ghi (tuỳ chọn): đẩy chunk vào StorageWriter của backend lưu trữ."""
+
+    def __init__(self, storage: StorageBackend, rel: PurePosixPath):
+        self._writer = storage.open_writer(rel)
+
+    async def feed(self, view: memoryview) -> None:
+        await self._writer.write(view)
+
+    async def finish(self) -> Dict[str, Any]:
+        return {"location": await self._writer.commit()}
+
+    async def abort(self) -> None:
+        await self._writer.abort()
+
+
+class ChunkPipeline:
+    """Chạy một chuỗi ChunkProcessor trên một nguồn chunk (async iterator), mỗi file đọc đúng một lần."""
+
+    def __init__(self, processors: List[ChunkProcessor]):
+        self.processors = processors
+
+    async def run(self, chunks) -> Dict[str, Any]:
+        result: Dict[str, Any] = {}
+        try:
+            async for chunk in chunks:
+                view = memoryview(chunk)
+                for proc in self.processors:
+                    await proc.feed(view)
+            for proc in self.processors:
+                result.update(await proc.finish())
+        except BaseException:
+            for proc in self.processors:
+                try:
+                    await proc.abort()
+                except Exception:
+                    pass
+            raise
+        return result
+
+
+# ============================ METRICS =============================
+
+def _fmt_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    body = ",".join(f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+                    for k, v in labels.items())
+    return "{" + body + "}"
+
+
+def _fmt_value(v: float) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) and not v.is_integer() else str(int(v))
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str):
+        self.name, self.help = name, help_text
+        self.value = 0.0
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+    def samples(self):
+        yield self.name, {}, self.value
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def dec(self, amount: float = 1) -> None:
+        self.value -= amount
+
+
+class Histogram:
+    kind = "histogram"
+    DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+    def __init__(self, name: str, help_text: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name, self.help = name, help_text
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def samples(self):
+        cumulative = 0
+        for bound, n in zip(self.buckets, self.counts):
+            cumulative += n
+            yield f"{self.name}_bucket", {"le": _fmt_value(bound)}, cumulative
+        yield f"{self.name}_sum", {}, self.sum
+        yield f"{self.name}_count", {}, self.count
+
+
+class MetricsRegistry:
+    """Registry tối giản theo định dạng text của Prometheus; mọi metric mang chung const_labels."""
+
+    def __init__(self, const_labels: Optional[Dict[str, str]] = None):
+        self.const_labels = dict(const_labels or {})
+        self._metrics: Dict[str, Any] = {}
+
+    def _add(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help_text: str) -> Counter:
+        return self._add(Counter(name, help_text))
+
+    def gauge(self, name: str, help_text: str) -> Gauge:
+        return self._add(Gauge(name, help_text))
+
+    def histogram(self, name: str, help_text: str, buckets: Tuple[float, ...] = Histogram.DEFAULT_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help_text, buckets))
+
+    def render(self) -> str:
+        return render_metrics([self])
+
+
+def render_metrics(registries: List[MetricsRegistry]) -> str:
+    """
+    Gộp nhiều registry (vd. mỗi tài khoản một registry) thành một trang /metrics: mỗi metric chỉ một dòng
+    HELP/TYPE, theo sau là sample của mọi registry, phân biệt bằng const_labels.
+    """
+    families: Dict[str, Tuple[Any, List[str]]] = {}
+    for registry in registries:
+        for metric in registry._metrics.values():
+            _, lines = families.setdefault(metric.name, (metric, []))
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{_fmt_labels({**registry.const_labels, **labels})} {_fmt_value(value)}")
+    out = []
+    for name, (metric, lines) in families.items():
+        out.append(f"# HELP {name} {metric.help}")
+        out.append(f"# TYPE {name} {metric.kind}")
+        out.extend(lines)
+    return "\n".join(out) + "\n" if out else ""
+
+
+class DownloaderMetrics(MetricsRegistry):
+    """Các metric của một TelegramDownloader (nhãn account=<index>)."""
+
+    def __init__(self, account_index: int):
+        super().__init__({"account": str(account_index)})
+        self.messages_scanned = self.counter("tele_messages_scanned_total", "Messages walked while scanning dialogs.")
+        self.media_found = self.counter("tele_media_found_total", "Media messages found by scans.")
+        self.files_downloaded = self.counter("tele_files_downloaded_total", "Files downloaded successfully.")
+        self.bytes_downloaded = self.counter("tele_bytes_downloaded_total", "Bytes downloaded.")
+        self.files_uploaded = self.counter("tele_files_uploaded_total", "Files uploaded successfully.")
+        self.bytes_uploaded = self.counter("tele_bytes_uploaded_total", "Bytes uploaded.")
+        self.errors = self.counter("tele_errors_total", "Failed downloads or uploads.")
+        self.retries = self.counter("tele_retries_total", "Transfers retried after a transient failure.")
+        self.flood_wait_seconds = self.counter("tele_flood_wait_seconds_total", "Seconds spent in FloodWait back-off.")
+        self.download_seconds = self.histogram("tele_download_seconds", "Per-file download latency.")
+        self.upload_seconds = self.histogram("tele_upload_seconds", "Per-file upload latency.")
+        self.queue_depth = self.gauge("tele_queue_depth", "Files still waiting in the current job.")
+        self.in_flight = self.gauge("tele_in_flight_workers", "Transfers currently in progress.")
+        self.last_progress = self.gauge("tele_last_progress_timestamp_seconds",
+                                        "Unix time of the last completed file or scanned page (stall detection).")
+
+    def touch(self):
+        self.last_progress.set(time.time())
+
+
+class MetricsServer:
+    """Endpoint HTTP cục bộ (GET /metrics) chạy trên event loop hiện tại, không cần thread riêng."""
+
+    def __init__(self, render: Callable[[], str], host: str = "127.0.0.1", port: int = 9464):
+        self.render = render
+        self.host, self.port = host, port
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = (await reader.readline()).decode("latin-1").split()
+            while (await reader.readline()).strip():
+                pass  # bỏ qua header
+            if len(request_line) >= 2 and request_line[0] == "GET" and request_line[1].split("?")[0] in ("/", "/metrics"):
+                status, body = "200 OK", self.render().encode("utf-8")
+                ctype = "text/plain; version=0.0.4; charset=utf-8"
+            else:
+                status, body, ctype = "404 Not Found", b"not found\n", "text/plain"
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {ctype}\r\nContent-Length: {len(body)}\r\n"
+                         f"Connection: close\r\n\r\n".encode("latin-1") + body)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+
+# ============================ EVENT LOG =============================
+
+class JsonLinesWriter:
+    """Ghi event ra file JSON lines trên thread riêng; emit() chỉ đẩy vào hàng đợi nên không chặn vòng tải."""
+
+    _STOP = object()
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._queue: "queue.SimpleQueue[Any]" = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run, name="event-writer", daemon=True)
+        self._thread.start()
+
+    def put(self, event: Dict[str, Any]):
+        self._queue.put(event)
+
+    def _run(self):
+        with open(self.path, "a", encoding="utf-8") as fh:
+            while True:
+                item = self._queue.get()
+                if item is self._STOP:
+                    break
+                fh.write(json.dumps(item, ensure_ascii=False, default=str) + "\n")
+                if self._queue.empty():
+                    fh.flush()
+
+    def close(self, timeout: float = 5.0):
+        self._queue.put(self._STOP)
+        self._thread.join(timeout)
+
+
+class EventLog:
+    """
+    Luồng event có cấu trúc của một TelegramDownloader: scan_page, scan_dialog, file_start,
+    file_finish, file_skip, file_fail, flood_wait, retry. Mỗi event mang `t` (time.monotonic) và
+    `ts` (unix time); event kết thúc một thao tác có thêm `duration` (giây).
+    Các subscriber (vd. renderer ra console) được gọi đồng bộ; file JSON lines được ghi bất đồng bộ.
+    """
+
+    def __init__(self, account_index: int):
+        self.account_index = account_index
+        self._writer: Optional[JsonLinesWriter] = None
+        self._subscribers: List[Callable[[Dict[str, Any]], None]] = []
+
+    def open_file(self, path: Union[str, Path]):
+        self.close()
+        self._writer = JsonLinesWriter(path)
+
+    def subscribe(self, callback: Callable[[Dict[str, Any]], None]):
+        self._subscribers.append(callback)
+
+    def emit(self, event: str, **fields) -> Dict[str, Any]:
+        record = {"event": event, "t": time.monotonic(), "ts": time.time(), "account": self.account_index}
+        record.update(fields)
+        if self._writer is not None:
+            self._writer.put(record)
+        for callback in self._subscribers:
+            callback(record)
+        return record
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+
+# ============================ PROFILER =============================
+
+class _TimedAwaitable:
+    """Bọc một coroutine, đo thời gian CPU thực sự chạy trong từng bước (không tính lúc chờ I/O)."""
+
+    def __init__(self, coro, stat: Dict[str, float]):
+        self._coro = coro
+        self._stat = stat
+
+    def __await__(self):
+        it = self._coro.__await__()
+        value, exc = None, None
+        while True:
+            t0 = time.perf_counter()
+            try:
+                yielded = it.throw(exc) if exc is not None else it.send(value)
+            except StopIteration as stop:
+                self._stat["busy"] += time.perf_counter() - t0
+                return stop.value
+            except BaseException:
+                self._stat["busy"] += time.perf_counter() - t0
+                raise
+            self._stat["busy"] += time.perf_counter() - t0
+            self._stat["steps"] += 1
+            try:
+                value, exc = (yield yielded), None
+            except BaseException as e:  # CancelledError... chuyển tiếp vào coroutine
+                value, exc = None, e
+
+
+class RunProfiler:
+    """
+    Profiler cho một lần chạy scan/download/upload:
+      - phase(name): thời gian wall + CPU theo phase (scan, resume_check, transfer, state_persist, ...), lồng nhau được
+      - task factory: số lượng, thời gian sống và thời gian chạy (busy) của các asyncio task theo tên coroutine
+      - sampling (tuỳ chọn): thread lấy mẫu stack của mọi thread (kể cả Tk) mỗi sample_interval giây
+    write_folded() ghi file "folded stacks" dùng được với flamegraph.pl / speedscope.
+    """
+
+    def __init__(self, sample_interval: float = 0.0):
+        self.sample_interval = sample_interval
+        self.phases: Dict[Tuple[str, ...], Dict[str, float]] = {}
+        self.tasks: Dict[str, Dict[str, float]] = {}
+        self.samples: Dict[str, int] = {}
+        self._stack: List[str] = []
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._prev_factory = None
+        self._sampler: Optional[threading.Thread] = None
+        self._sampling = threading.Event()
+        self._started_wall = 0.0
+        self._started_cpu = 0.0
+        self.total_wall = 0.0
+        self.total_cpu = 0.0
+
+    # -- phases --
+    def phase(self, name: str) -> "_Phase":
+        return _Phase(self, name)
+
+    def _record_phase(self, path: Tuple[str, ...], wall: float, cpu: float):
+        st = self.phases.get(path)
+        if st is None:
+            st = self.phases[path] = {"calls": 0, "wall": 0.0, "cpu": 0.0}
+        st["calls"] += 1
+        st["wall"] += wall
+        st["cpu"] += cpu
+
+    # -- asyncio tasks --
+    def _task_factory(self, loop, coro, **kwargs):
+        name = getattr(coro, "__qualname__", None) or type(coro).__name__
+        stat = self.tasks.get(name)
+        if stat is None:
+            stat = self.tasks[name] = {"count": 0, "busy": 0.0, "steps": 0, "lifetime": 0.0}
+        stat["count"] += 1
+        created = time.perf_counter()
+
+        async def timed():
+            try:
+                return await _TimedAwaitable(coro, stat)
+            finally:
+                stat["lifetime"] += time.perf_counter() - created
+
+        if self._prev_factory is not None:
+            return self._prev_factory(loop, timed(), **kwargs)
+        return asyncio.Task(timed(), loop=loop, **kwargs)
+
+    # -- sampling --
+    def _sample_loop(self):
+        import traceback
+        me = threading.get_ident()
+        while not self._sampling.wait(self.sample_interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = [f"{Path(fs.filename).name}:{fs.name}" for fs in traceback.extract_stack(frame)]
+                key = ";".join([names.get(ident, str(ident))] + stack)
+                self.samples[key] = self.samples.get(key, 0) + 1
+
+    def start(self):
+        """Gọi từ bên trong event loop cần đo; start() lại sau stop() đo tiếp và cộng dồn tổng thời gian."""
+        self._loop = asyncio.get_running_loop()
+        self._prev_factory = self._loop.get_task_factory()
+        self._loop.set_task_factory(self._task_factory)
+        if self.sample_interval > 0:
+            self._sampling.clear()
+            self._sampler = threading.Thread(target=self._sample_loop, name="profiler-sampler", daemon=True)
+            self._sampler.start()
+        self._started_wall = time.perf_counter()
+        self._started_cpu = time.process_time()
+
+    def stop(self):
+        self.total_wall += time.perf_counter() - self._started_wall
+        self.total_cpu += time.process_time() - self._started_cpu
+        if self._loop is not None:
+            self._loop.set_task_factory(self._prev_factory)
+            self._loop = None
+        if self._sampler is not None:
+            self._sampling.set()
+            self._sampler.join()
+            self._sampler = None
+
+    # -- output --
+    def report_lines(self) -> List[str]:
+        total = self.total_wall or 1e-9
+        out = [f"{'Phase':<34}{'calls':>8}{'wall s':>10}{'cpu s':>10}{'% wall':>8}"]
+        for path in sorted(self.phases):
+            st = self.phases[path]
+            label = ("  " * (len(path) - 1) + path[-1])[:33]
+            out.append(f"{label:<34}{int(st['calls']):>8}{st['wall']:>10.3f}{st['cpu']:>10.3f}"
+                       f"{st['wall'] / total * 100:>7.1f}%")
+        out.append(f"{'(total)':<34}{'':>8}{self.total_wall:>10.3f}{self.total_cpu:>10.3f}{100.0:>7.1f}%")
+        if self.tasks:
+            out.append("")
+            out.append(f"{'Asyncio task':<34}{'count':>8}{'busy s':>10}{'alive s':>10}{'steps':>8}")
+            for name, st in sorted(self.tasks.items(), key=lambda kv: -kv[1]["busy"])[:15]:
+                out.append(f"{name[-33:]:<34}{int(st['count']):>8}{st['busy']:>10.3f}{st['lifetime']:>10.3f}"
+                           f"{int(st['steps']):>8}")
+        if self.samples:
+            out.append("")
+            out.append(f"{sum(self.samples.values())} stack samples every {self.sample_interval * 1000:.0f} ms")
+        return out
+
+    def write_folded(self, path: Union[str, Path]) -> Path:
+        """
+        Ghi folded stacks: mẫu sampling nếu có, nếu không thì cây phase (trọng số = micro giây wall,
+        phần tự thân của phase cha = wall của nó trừ đi các phase con).
+        """
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        lines = []
+        if self.samples:
+            lines = [f"{stack} {n}" for stack, n in sorted(self.samples.items())]
+        else:
+            for p, st in sorted(self.phases.items()):
+                children = sum(c["wall"] for cp, c in self.phases.items() if len(cp) == len(p) + 1 and cp[:-1] == p)
+                self_us = int(max(st["wall"] - children, 0) * 1e6)
+                if self_us:
+                    lines.append(f"{';'.join(p)} {self_us}")
+        path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+        return path
+
+
+class _Phase:
+    __slots__ = ("profiler", "name", "_wall", "_cpu")
+
+    def __init__(self, profiler: RunProfiler, name: str):
+        self.profiler, self.name = profiler, name
+
+    def __enter__(self):
+        self.profiler._stack.append(self.name)
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+        return self
+
+    def __exit__(self, *exc):
+        prof = self.profiler
+        prof._record_phase(tuple(prof._stack), time.perf_counter() - self._wall, time.process_time() - self._cpu)
+        prof._stack.pop()
+        return False
+
+
+class _NoPhase:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_PHASE = _NoPhase()
+
+
+# ============================ DOWNLOADER LÕI =============================
+
+REFRESH_BATCH = 100  # tối đa số message ID mỗi lần get_messages làm mới file reference
+MIRROR_BATCH = 100  # tối đa số message mỗi ForwardMessagesRequest (giới hạn của Telegram)
+
+# Thứ tự hàng đợi tải (xem TelegramDownloader.order_media)
+DOWNLOAD_ORDERS = ("scan", "smallest", "largest", "newest", "oldest", "fair")
+
+
+class TelegramDownloader:
+    def __init__(self, api_id: int, api_hash: str, phone: str, download_dir: str, account_index: int,
+                 log_func: Callable[[str, Optional[str]], None],
+                 input_func: Callable[[str, Optional[str], bool], str],  # Added hide_input to input_func type hint
+                 storage: Optional[StorageBackend] = None):
+
+        self.api_id = api_id
+        self.api_hash = api_hash
+        self.phone = phone
+        self.download_dir = Path(download_dir)
+        self.pic_dir = self.download_dir / "PIC"
+        self.vid_dir = self.download_dir / "VID"
+
+        _load_telethon()
+        session_dir = Path("sessions")
+        session_dir.mkdir(exist_ok=True)
+        session_path = session_dir / f"session_{account_index}"
+        self.client = TelegramClient(str(session_path), api_id, api_hash)
+
+        self.download_dir.mkdir(parents=True, exist_ok=True)
+        self.pic_dir.mkdir(exist_ok=True)
+        self.vid_dir.mkdir(exist_ok=True)
+
+        # UI interaction functions
+        self._log_output = log_func
+        self._get_input = input_func
+
+        # State per-account
+        self.account_index = account_index
+        self.state = StateManager(self.account_index)  # StateManager now takes only account_index
+        self.scan_cache = ScanCache(self.account_index)
+        self.upload_cache = UploadCache(self.account_index)
+        self.catalog = MediaCatalog(self.download_dir)
+        self.storage = storage or LocalStorage(self.download_dir)  # Nơi lưu media; mặc định là download_dir
+        # True -> mọi file đi qua ChunkPipeline (SHA-256, kiểm tra kích thước, nhận diện định dạng, ghi)
+        self.stream_pipeline = False
+        # Khâu xử lý bổ sung: mỗi factory nhận media_info và trả về một ChunkProcessor
+        self.extra_processors: List[Callable[[Dict[str, Any]], ChunkProcessor]] = []
+        self.metrics = DownloaderMetrics(self.account_index)
+        self.events = EventLog(self.account_index)
+        self.profiler: Optional[RunProfiler] = None  # Gán RunProfiler để đo thời gian theo phase
+        # Dòng log cho người đọc được dựng từ event; trên console chỉ khi có TTY, sau API thì không
+        if self._log_output is not _quiet_log and (self._log_output != console_log_func or sys.stdout.isatty()):
+            self.events.subscribe(self._render_event)
+        self.use_scan_cache = True  # False -> bỏ cache, quét lại toàn bộ lịch sử
+        self.scan_checkpoint_pages = SCAN_CHECKPOINT_PAGES  # 0 -> chỉ ghi cache khi quét xong một khoảng
+        self.scan_shards = SCAN_SHARDS  # 1 -> một cursor mỗi dialog
+        self.revalidate_scan_cache = False  # True -> tải lại theo ID media lấy từ cache (phát hiện xoá/sửa)
+        self._resize_warned = False  # đã báo thiếu resize_photo_if_needed (Telethon đổi hàm private)
+        self._top_message_ids: Dict[str, int] = {}  # peer_id -> top_message từ list_dialogs, để chia shard không tốn request
+        self.download_order = "scan"  # Một trong DOWNLOAD_ORDERS
+        # Cửa sổ quét: ngày [since, until) được đẩy xuống iter_messages, kích thước kiểm tra trước khi xếp hàng
+        self.scan_since: Optional[datetime] = None
+        self.scan_until: Optional[datetime] = None
+        self.scan_min_size: Optional[int] = None
+        self.scan_max_size: Optional[int] = None
+        self._promoted: set = set()  # message.id được đẩy lên đầu lượt tải đang chạy (promote)
+
+        self.stats = {
+            'total_found': 0,
+            'images_found': 0,
+            'videos_found': 0,
+            'downloaded': 0,
+            'skipped': 0,
+            'errors': 0,
+            'total_size': 0,
+        }
+
+    def print_banner(self) -> None:
+        lines = [
+            pad("TELEGRAM MEDIA TOOL", WIDTH - 2),  # Updated title
+            pad("UI-flexible · Multi-account · Download · Upload · Login/Logout/Reset · Resume", WIDTH - 2),
+            # Updated subtitle
+            pad(f"Download dir: {self.download_dir}", WIDTH - 2),
+        ]
+        self._log_output(c(box(lines), Fore.CYAN))
+        self._log_output(line())
+
+    # --- Telethon Callbacks for input ---
+    def _code_callback(self) -> str:
+        """Callback for Telethon to get OTP code."""
+        return self._get_input("Enter the code from Telegram", hide_input=False)  # Pass hide_input=False
+
+    def _password_callback(self) -> str:
+        """Callback for Telethon to get 2FA password."""
+        return self._get_input("Enter your 2FA password", hide_input=True)  # Pass hide_input=True for password masking
+
+    async def connect_client(self) -> bool:
+        try:
+            await self.client.connect()
+            if not await self.client.is_user_authorized():
+                self._log_output(pad("Authorization required. Signing in...", WIDTH, "left"))
+                try:
+                    # In thông tin tài khoản đang đăng nhập (mask số điện thoại)
+                    masked_phone = self.phone[:3] + "****" + self.phone[-4:]
+                    self._log_output(
+                        c(pad(f"Attempting to login account #{self.account_index} ({masked_phone}) → sending code...",
+                              WIDTH,
+                              "left"), Fore.YELLOW))
+                    await self.client.send_code_request(self.phone)
+                except FloodWaitError as e:
+                    self._log_output(
+                        c(pad(f"Too many attempts. Please wait {e.seconds} seconds.", WIDTH, "left"), Fore.RED))
+                    return False
+
+                # Handle sign-in after code request
+                try:
+                    await self.client.sign_in(self.phone, code=await _maybe_await(self._code_callback()))
+                except SessionPasswordNeededError:
+                    await self.client.sign_in(password=await _maybe_await(self._password_callback()))
+                except PhoneCodeInvalidError:
+                    self._log_output(c(pad(" Wrong OTP, please try again", WIDTH, "left"), Fore.RED))
+                    # Allow a retry for OTP, but not handled automatically here (caller should decide)
+                    return False
+                except PhoneCodeExpiredError:
+                    self._log_output(
+                        c(pad(" The OTP code has expired. Please resend the code", WIDTH, "left"), Fore.YELLOW))
+                    return False
+                except PasswordHashInvalidError:
+                    self._log_output(c(pad(" Incorrect 2FA password. Please try again.", WIDTH, "left"), Fore.RED))
+                    return False
+                except Exception as e:
+                    self._log_output(c(pad(f"Login error: {e}", WIDTH, "left"), Fore.RED))
+                    return False
+
+            me = await self.client.get_me()
+            display = f"{(me.first_name or '').strip()} {(me.last_name or '').strip()}".strip()
+            username = f"@{me.username}" if getattr(me, 'username', None) else ""
+            ok = f"Connected: {display} {username}".strip()
+            self._log_output(c(pad(ok, WIDTH, "left"), Fore.GREEN))
+            self._log_output(line("-"))
+            return True
+        except Exception as e:
+            self._log_output(c(pad(f"Connection error: {e}", WIDTH, "left"), Fore.RED))
+            self._log_output(line("-"))
+            return False
+
+    # ========== LIỆT KÊ & QUÉT ==========
+
+    async def list_dialogs(self, print_to_cli: bool = True) -> List[dict]:  # Added print_to_cli flag
+        self._log_output(pad("Fetching dialogs (chats/channels)...", WIDTH, "left"))
+        rows = []
+        idx = 0
+        async for d in self.client.iter_dialogs():
+            entity = d.entity
+            etype = entity.__class__.__name__
+            title = (getattr(d, "name", None) or getattr(entity, "title", None)
+                     or getattr(entity, "first_name", None) or "Unknown").strip()
+            uname = f"@{getattr(entity, 'username', '')}" if getattr(entity, 'username', None) else ""
+            idx += 1
+            top_message = getattr(getattr(d, "dialog", None), "top_message", None)
+            if top_message and getattr(d, "id", None) is not None:
+                self._top_message_ids[str(d.id)] = int(top_message)
+            rows.append({
+                "index": idx,
+                "dialog": d,
+                "entity": entity,
+                "title": title,
+                "username": uname,
+                "etype": etype,
+                "id": getattr(entity, 'id', None)  # Explicitly add entity's ID for safer access
+            })
+        # Only print box for CLI if print_to_cli is True
+        if print_to_cli and self._log_output == console_log_func:
+            lines = [pad("LIST OF DIALOGS", WIDTH - 2), pad("", WIDTH - 2)]
+            for r in rows:
+                label = f"[{r['index']:>3}] {r['title']} {r['username']}  ({r['etype']})"
+                lines.append(pad(label, WIDTH - 2))
+            self._log_output(c(box(lines), Fore.CYAN))
+        return rows
+
+    def _reset_stats(self):
+        self.stats = {
+            'total_found': 0, 'images_found': 0, 'videos_found': 0,
+            'downloaded': 0, 'skipped': 0, 'errors': 0, 'total_size': 0,
+        }
+
+    @staticmethod
+    def _classify_media(message) -> Optional[str]:
+        """'photo' | 'video' | None cho một message."""
+        media = getattr(message, "media", None)
+        if not media:
+            return None
+        if isinstance(media, MessageMediaPhoto):
+            return 'photo'
+        if isinstance(media, MessageMediaDocument):
+            mime = getattr(media.document, "mime_type", "") or ""
+            if mime.startswith("video/"):
+                return 'video'
+            if mime.startswith("image/"):
+                return 'photo'
+        return None
+
+    def set_scan_window(self, since: Optional[datetime] = None, until: Optional[datetime] = None,
+                        min_size: Optional[int] = None, max_size: Optional[int] = None):
+        """Giới hạn các lần quét sau: ngày đăng trong [since, until), kích thước trong [min_size, max_size]."""
+        self.scan_since, self.scan_until = since, until
+        self.scan_min_size, self.scan_max_size = min_size, max_size
+
+    def _scan_windowed(self) -> bool:
+        """Lần quét bị giới hạn bởi cửa sổ ngày/kích thước (danh sách không đầy đủ, không dựng digest)."""
+        return any(v is not None for v in (self.scan_since, self.scan_until, self.scan_min_size, self.scan_max_size))
+
+    def in_scan_window(self, message) -> bool:
+        if self.scan_since is not None and message.date < self.scan_since:
+            return False
+        if self.scan_until is not None and message.date >= self.scan_until:
+            return False
+        if self.scan_min_size is not None or self.scan_max_size is not None:
+            size = self._media_size(message)
+            if self.scan_min_size is not None and size < self.scan_min_size:
+                return False
+            if self.scan_max_size is not None and size > self.scan_max_size:
+                return False
+        return True
+
+    async def _newest_message_id(self, entity: Any, key: str, fetch: bool = True) -> int:
+        """
+        ID tin mới nhất của dialog: lấy top_message đã có từ list_dialogs, nếu không thì hỏi Telegram
+        (một request) khi fetch, ngược lại trả 0.
+        """
+        if key in self._top_message_ids:
+            return self._top_message_ids[key]
+        if not fetch:
+            return 0
+        latest = await self.client.get_messages(entity, limit=1)
+        return int(latest[0].id) if latest else 0
+
+    async def _scan_range(self, entity: Any, key: str, min_id: int, max_id: int, by_id: Dict[int, Tuple[Any, str]],
+                          tally: Dict[str, int],
+                          progress_callback: Optional[Callable[[int, Optional[int]], None]] = None) -> bool:
+        """
+        Duyệt một khoảng (min_id, max_id) bằng một cursor iter_messages, thêm media vào by_id và checkpoint
+        vào scan cache. Trả về False nếu dừng sớm vì gặp tin cũ hơn since.
+        """
+        checkpoint_every = max(0, int(self.scan_checkpoint_pages)) * 100
+        fresh: List[Tuple[Any, str]] = []
+        highest, lowest, exhausted, seen = 0, 0, True, 0
+        # until -> offset_date: Telegram bắt đầu ngay trước mốc đó; since -> dừng ở tin đầu tiên cũ hơn
+        try:
+            async for message in self.client.iter_messages(entity, min_id=min_id, max_id=max_id,
+                                                           offset_date=self.scan_until):
+                tally["messages"] += 1
+                seen += 1
+                self.metrics.messages_scanned.inc()
+                if (tally["messages"] - tally["before"]) % 100 == 0:  # Telegram trả 100 tin mỗi trang
+                    self.events.emit("scan_page", dialog=key, messages=tally["messages"] - tally["before"],
+                                     media=len(by_id))
+                if progress_callback:
+                    # Pass total found media, total messages is hard to get upfront
+                    progress_callback(tally["messages"], None)
+                mtype = self._classify_media(message)
+                if mtype:
+                    fresh.append((message, mtype))
+                    by_id[int(message.id)] = (message, mtype)
+                highest = max(highest, int(message.id))
+                lowest = int(message.id)
+                if self.scan_since is not None and message.date < self.scan_since:
+                    exhausted = False
+                    break
+                if checkpoint_every and seen % checkpoint_every == 0:
+                    # Tin đi từ mới -> cũ nên [lowest, đỉnh khoảng] đã duyệt liên tục
+                    self.scan_cache.checkpoint(
+                        key, fresh, lowest, (max_id - 1) if max_id and self.scan_until is None else highest)
+                    fresh = []
+                    self.events.emit("scan_checkpoint", dialog=key, offset_id=lowest, media=len(by_id))
+        except BaseException:
+            # Mất mạng, FloodWait quá lâu, Ctrl+C: giữ phần đã duyệt để lần sau quét tiếp từ lowest
+            if highest:
+                self.scan_cache.checkpoint(
+                    key, fresh, lowest, (max_id - 1) if max_id and self.scan_until is None else highest)
+            raise
+
+        # Chỉ ghi vào cache phần đã thực sự duyệt liên tục, để lần sau bỏ qua
+        self.metrics.touch()
+        if self.scan_until is None and exhausted:
+            self.scan_cache.checkpoint(key, fresh, min_id + 1, (max_id - 1) if max_id else highest)
+        elif highest:
+            self.scan_cache.checkpoint(key, fresh, min_id + 1 if exhausted else lowest,
+                                       (max_id - 1) if max_id and self.scan_until is None else highest)
+        return exhausted
+
+    async def _revalidate_cached(self, entity: Any, key: str, by_id: Dict[int, Tuple[Any, str]]) -> None:
+        """
+        Tải lại theo ID (mỗi request REFRESH_BATCH tin) các media lấy từ scan cache, vì khoảng đã cache không
+        được duyệt lại: tin đã xoá hoặc không còn ảnh/video bị bỏ khỏi by_id và cache, tin còn lại thay bản cũ
+        (media đã sửa, file reference mới). Nhờ đó digest phản ánh cả những khoảng đã cache.
+        """
+        cached_ids = sorted(by_id, reverse=True)
+        for start in range(0, len(cached_ids), REFRESH_BATCH):
+            batch = cached_ids[start:start + REFRESH_BATCH]
+            fetched = await self.client.get_messages(entity, ids=batch)
+            gone, fresh = [], []
+            for message_id, message in zip(batch, fetched):
+                mtype = self._classify_media(message) if message is not None else None
+                if mtype is None:
+                    gone.append(message_id)
+                    del by_id[message_id]
+                    continue
+                if self._media_key(message) != self._media_key(by_id[message_id][0]):
+                    fresh.append((message, mtype))
+                by_id[message_id] = (message, mtype)
+            self.scan_cache.drop_media(key, gone)
+            self.scan_cache.add_media(key, fresh)
+            if gone or fresh:
+                self.events.emit("scan_revalidate", dialog=key, removed=len(gone), edited=len(fresh))
+
+    async def _scan_dialog(self, entity: Any, found: List[Dict[str, Any]], message_count: int,
+                           progress_callback: Optional[Callable[[int, Optional[int]], None]] = None) -> int:
+        """
+        Quét một dialog, gộp media đã có trong scan cache với các khoảng ID chưa quét.
+        Thêm media vào `found` (mới -> cũ) và trả về message_count đã cộng dồn.
+        """
+        key = str(await self.client.get_peer_id(entity))
+        started = time.monotonic()
+        scanned_before = message_count
+        found_before = len(found)
+        if not self.use_scan_cache:
+            self.scan_cache.clear(key)
+
+        by_id: Dict[int, Tuple[Any, str]] = {}
+        # Gắn lại chat (entity của dialog) và người gửi để catalog có dialog_title/sender_name như khi quét mới
+        entities = self.scan_cache.load_entities(key)
+        if not isinstance(entity, (str, int)):
+            entities[int(key)] = entity
+        for message, mtype in self.scan_cache.load_media(key):
+            message._finish_init(self.client, entities, None)
+            by_id[int(message.id)] = (message, mtype)
+        if self.revalidate_scan_cache and by_id and not self._scan_windowed():
+            await self._revalidate_cached(entity, key, by_id)
+
+        tally = {"messages": message_count, "before": scanned_before}
+        for min_id, max_id in self.scan_cache.gaps(key):
+            shards = [(min_id, max_id)]
+            if self.scan_shards > 1 and self.scan_since is None and self.scan_until is None:
+                # Biết ID mới nhất thì mới chia được khoảng không giới hạn trên. Lần quét lại (min_id > 0) chỉ
+                # chia khi list_dialogs đã cho top_message, để dialog nhỏ không tốn thêm request mỗi lần
+                top = max_id - 1 if max_id else await self._newest_message_id(entity, key, fetch=not min_id)
+                shards = shard_id_range(min_id, max_id, top, self.scan_shards)
+            if len(shards) == 1:
+                exhausted = await self._scan_range(entity, key, min_id, max_id, by_id, tally, progress_callback)
+            else:
+                self.events.emit("scan_shards", dialog=key, shards=len(shards))
+                results = await asyncio.gather(
+                    *(self._scan_range(entity, key, lo, hi, by_id, tally, progress_callback) for lo, hi in shards),
+                    return_exceptions=True)
+                # Mỗi shard đã tự checkpoint phần đã duyệt; lỗi được ném lại sau khi mọi shard dừng
+                for r in results:
+                    if isinstance(r, BaseException):
+                        raise r
+                exhausted = all(results)
+            if not exhausted:
+                break  # ID tăng theo thời gian: các khoảng còn lại (ID nhỏ hơn) đều cũ hơn since
+        message_count = tally["messages"]
+
+        for mid in sorted(by_id, reverse=True):
+            message, mtype = by_id[mid]
+            if not self.in_scan_window(message):
+                continue
+            self.stats['images_found' if mtype == 'photo' else 'videos_found'] += 1
+            found.append({'message': message, 'type': mtype, 'date': message.date})
+        in_window = len(found) - found_before
+        self.metrics.media_found.inc(in_window)
+        self.events.emit("scan_dialog", dialog=key, messages=message_count - scanned_before, media=in_window,
+                         duration=time.monotonic() - started)
+        return message_count
+
+    async def scan_media_in_dialogs(self, dialogs: List[Any],
+                                    progress_callback: Optional[Callable[[int, Optional[int]], None]] = None) -> List[
+        Dict[str, Any]]:
+        self._log_output(pad(f"Scanning {len(dialogs)} dialog(s) for media...", WIDTH, "left"))
+        media_messages: List[Dict[str, Any]] = []
+        message_count = 0
+        self._reset_stats()
+
+        # Use tqdm only if in CLI mode and tqdm is available
+        iterable_dialogs = dialogs
+        tqdm = _tqdm() if self._log_output == console_log_func else None
+        if tqdm is not None:
+            iterable_dialogs = tqdm(dialogs, desc="Scanning Dialogs", ncols=WIDTH, ascii=True,
+                                    bar_format="{desc}: {n_fmt}/{total_fmt} |{bar}| {rate_fmt}")
+
+        for d in iterable_dialogs:
+            with self._phase("scan"):
+                message_count = await self._scan_dialog(d, media_messages, message_count, progress_callback)
+
+        self.stats['total_found'] = len(media_messages)
+        # Final update for CLI progress if it was counting messages scanned
+        if progress_callback:
+            progress_callback(message_count, message_count)
+
+        self._log_output(
+            pad(f"Found {len(media_messages)} media ({message_count} new messages scanned) "
+                f"across {len(dialogs)} dialog(s).", WIDTH, "left"))
+        self._log_output(line("-"))
+        return media_messages
+
+    async def scan_saved_messages(self, progress_callback: Optional[Callable[[int, Optional[int]], None]] = None) -> \
+            List[Dict[str, Any]]:
+        self._log_output(pad("Scanning Saved Messages...", WIDTH, "left"))
+        media_messages: List[Dict[str, Any]] = []
+        self._reset_stats()
+
+        with self._phase("scan"):
+            message_count = await self._scan_dialog('me', media_messages, 0, progress_callback)
+
+        self.stats['total_found'] = len(media_messages)
+        if progress_callback:
+            progress_callback(message_count, message_count)  # Final count with total messages scanned
+
+        self._log_output(pad(f"Found {len(media_messages)} media ({message_count} new messages scanned).", WIDTH,
+                             "left"))
+        self._log_output(line("-"))
+        return media_messages
+
+    # ===================== FILE NAMING & HASH =======================
+
+    def _ext_from_mime_or_name(self, mime: str, name: Optional[str]) -> str:
+        if name and "." in name:
+            return "." + name.split(".")[-1]
+        if mime.startswith("video/"):
+            return ".mp4"
+        if mime.startswith("image/"):
+            # Common image formats. telethon downloads photos as .jpg by default.
+            if 'png' in mime: return '.png'
+            if 'gif' in mime: return '.gif'
+            return ".jpg"
+        return ""
+
+    def _relative_path_for(self, media_info: Dict[str, Any]) -> PurePosixPath:
+        """Khoá lưu trữ tương đối (năm/tháng/tên file), độc lập với backend."""
+        message = media_info['message']
+        file_type = media_info['type']
+
+        # Year/month subfolders
+        month_folder = PurePosixPath(str(message.date.year), f"{message.date.month:02d}")
+
+        if file_type == 'photo':
+            return month_folder / f"photo_{message.id}.jpg"
+        else:  # video
+            doc = message.media.document
+            mime = getattr(doc, "mime_type", "") or ""
+            orig_name = None
+            for attr in getattr(doc, "attributes", []):
+                if hasattr(attr, 'file_name') and getattr(attr, 'file_name'):
+                    orig_name = attr.file_name
+                    break
+            ext = self._ext_from_mime_or_name(mime, orig_name)
+            return month_folder / f"video_{message.id}{ext}"
+
+    def _target_path_for(self, media_info: Dict[str, Any]) -> str:
+        """Vị trí cuối cùng của media trong backend lưu trữ (đường dẫn file hoặc s3://...)."""
+        return self.storage.locate(self._relative_path_for(media_info))
+
+    def _build_pipeline(self, media_info: Dict[str, Any], rel: PurePosixPath) -> ChunkPipeline:
+        expected = self._expected_size(media_info['message'])
+        processors: List[ChunkProcessor] = [Sha256Processor(), SizeCheckProcessor(expected), FormatSniffer()]
+        processors.extend(factory(media_info) for factory in self.extra_processors)
+        processors.append(StorageSink(self.storage, rel))
+        return ChunkPipeline(processors)
+
+    async def _store_media(self, media_info: Dict[str, Any], rel: PurePosixPath) -> Tuple[str, int, Dict[str, Any]]:
+        """
+        Tải một media vào backend lưu trữ. Ở chế độ pipeline, chunk đi qua các khâu xử lý rồi mới
+        được ghi. Nếu không, backend local để Telethon ghi thẳng ra file; backend khác nhận stream
+        từng chunk nên không cần file tạm trên đĩa.
+        """
+        msg = media_info['message']
+        if self.stream_pipeline:
+            result = await self._build_pipeline(media_info, rel).run(self.client.iter_download(msg))
+            return result["location"], result["size"], result
+
+        expected = self._expected_size(msg)
+        local = self.storage.local_path(rel)
+        if local is not None:
+            # Telethon ghi vào <tên>.part; chỉ đổi sang tên thật khi đủ kích thước
+            local.parent.mkdir(parents=True, exist_ok=True)
+            tmp = partial_path(local)
+            try:
+                path = await self.client.download_media(msg, file=str(tmp))
+                if not path or not Path(path).exists():
+                    raise Exception("Downloaded file path is invalid or file not found.")
+                size = os.path.getsize(path)
+                if expected is not None and size != expected:
+                    raise ValueError(f"Size mismatch: got {size} bytes, expected {expected}")
+                os.replace(path, local)
+            except BaseException:
+                try:
+                    tmp.unlink()
+                except FileNotFoundError:
+                    pass
+                raise
+            return str(local), size, {}
+
+        writer = self.storage.open_writer(rel)
+        size = 0
+        try:
+            async for chunk in self.client.iter_download(msg):
+                await writer.write(chunk)
+                size += len(chunk)
+            if expected is not None and size != expected:
+                raise ValueError(f"Size mismatch: got {size} bytes, expected {expected}")
+            location = await writer.commit()
+        except BaseException:
+            await writer.abort()
+            raise
+        return location, size, {}
+
+    @classmethod
+    def _expected_size(cls, message) -> Optional[int]:
+        # Document: size của file. Ảnh: bản lớn nhất (PhotoSize/PhotoSizeProgressive), đúng bản Telethon tải về
+        if isinstance(message.media, (MessageMediaDocument, MessageMediaPhoto)):
+            return cls._media_size(message) or None
+        return None
+
+    def _stored_intact(self, item: Dict[str, Any], rel: PurePosixPath) -> Tuple[bool, Optional[int]]:
+        """
+        (đã xong?, kích thước đang lưu). File có trong backend chỉ tính là xong khi khớp kích thước Telegram báo;
+        file cụt (tải dở từ trước khi ghi qua .part) bị tải lại dù đã đánh dấu hoàn tất.
+        """
+        msg = item['message']
+        stored_size = self.storage.stat_size(rel)
+        if stored_size is None:
+            return self.state.is_completed(int(msg.id), self._dialog_id_of(msg)), None
+        expected = self._expected_size(msg)
+        return stored_size > 0 and (expected is None or stored_size == expected), stored_size
+
+    @staticmethod
+    def _media_size(message) -> int:
+        """Kích thước (bytes) Telegram báo cho media; với ảnh là bản lớn nhất."""
+        media = getattr(message, "media", None)
+        if isinstance(media, MessageMediaDocument):
+            return int(getattr(media.document, "size", 0) or 0)
+        if isinstance(media, MessageMediaPhoto) and getattr(media, "photo", None):
+            sizes = []
+            for s in getattr(media.photo, "sizes", []) or []:
+                if hasattr(s, "size"):
+                    sizes.append(int(s.size or 0))
+                elif hasattr(s, "sizes") and s.sizes:  # PhotoSizeProgressive
+                    sizes.append(int(max(s.sizes)))
+            return max(sizes) if sizes else 0
+        return 0
+
+    def _catalog_row(self, media_info: Dict[str, Any], path: Union[str, Path], size: int,
+                     sha256: Optional[str] = None) -> Dict[str, Any]:
+        msg = media_info['message']
+        chat = getattr(msg, "chat", None)
+        sender = getattr(msg, "sender", None)
+        if media_info['type'] == 'photo' and isinstance(msg.media, MessageMediaPhoto):
+            mime = "image/jpeg"
+        else:
+            mime = getattr(getattr(msg.media, "document", None), "mime_type", None)
+        return {
+            "dialog_id": getattr(msg, "chat_id", None) or 0,
+            "dialog_title": (getattr(chat, "title", None) or getattr(chat, "first_name", None)
+                             or getattr(chat, "username", None)),
+            "message_id": int(msg.id),
+            "date": int(msg.date.timestamp()),
+            "type": media_info['type'],
+            "mime": mime,
+            "size": int(size),
+            "path": str(path),
+            "sender_id": getattr(msg, "sender_id", None),
+            "sender_name": (" ".join(x for x in (getattr(sender, "first_name", None),
+                                                  getattr(sender, "last_name", None)) if x)
+                            or getattr(sender, "title", None) or getattr(sender, "username", None)),
+            "caption": getattr(msg, "message", None) or None,
+            "downloaded_at": int(time.time()),
+            "sha256": sha256,
+        }
+
+    @staticmethod
+    def _media_key(message) -> int:
+        """ID của photo/document trong message; đổi khi media bị sửa (thay file) dù message.id giữ nguyên."""
+        media = getattr(message, "media", None)
+        item = getattr(media, "photo", None) or getattr(media, "document", None)
+        return int(getattr(item, "id", 0) or 0)
+
+    def _media_changes(self, media_list: List[Dict[str, Any]]
+                       ) -> Tuple[Optional[Dict[str, Dict[str, Any]]], Dict[str, List[Tuple[int, int]]]]:
+        """
+        (digest để lưu, các khoảng ID đã đổi so với digest trong state) của danh sách vừa quét;
+        (None, {}) nếu quét bị giới hạn (cửa sổ ngày/kích thước).
+        """
+        if self._scan_windowed():
+            return None, {}
+        entries: Dict[str, List[Tuple[int, int]]] = {}
+        for m in media_list:
+            msg = m['message']
+            entries.setdefault(str(self._dialog_id_of(msg)), []).append((int(msg.id), self._media_key(msg)))
+        previous = self.state.get_digests()
+        # Chỉ so phần ID đã có ở lần trước: tin mới đến không làm khối cuối bị coi là đổi
+        upto = {d: int(p["top"]) for d, p in previous.items() if "top" in p}
+        return media_digests(entries), changed_ranges(previous, media_digests(entries, upto=upto))
+
+    def _sweep_partials(self) -> int:
+        """Dọn file .part mồ côi của lần chạy trước trước khi bắt đầu tải."""
+        removed = self.storage.sweep_partials()
+        if removed:
+            self.events.emit("partials_swept", count=removed)
+            self._log_output(pad(f"Removed {removed} unfinished download(s) left by an earlier run.",
+                                 WIDTH, "left"), "yellow")
+        return removed
+
+    def _recheck_changed(self, changes: Dict[str, List[Tuple[int, int]]]) -> int:
+        """Bỏ đánh dấu hoàn tất trong các khoảng đã đổi; trả về số ID sẽ được kiểm tra lại."""
+        forgotten = 0
+        for dialog, ranges in changes.items():
+            for lo, hi in ranges:
+                forgotten += self.state.forget_completed(dialog, lo, hi)
+            self.events.emit("media_changed", dialog=dialog, ranges=ranges)
+        return forgotten
+
+    # ===================== DOWNLOAD CORE =======================
+
+    def print_stats(self) -> None:
+        lines = [
+            pad("CURRENT STATS", WIDTH - 2),
+            pad(f"Photos found: {self.stats['images_found']}", WIDTH - 2),
+            pad(f"Videos found: {self.stats['videos_found']}", WIDTH - 2),
+            pad(f"Total media: {self.stats['total_found']}", WIDTH - 2),
+            pad(f"Downloaded: {self.stats['downloaded']}", WIDTH - 2),
+            pad(f"Skipped: {self.stats['skipped']}", WIDTH - 2),
+            pad(f"Errors: {self.stats['errors']}", WIDTH - 2),
+            pad(f"Total size: {humanize.naturalsize(self.stats['total_size'])}", WIDTH - 2),
+        ]
+        self._log_output(c(box(lines), Fore.CYAN))
+
+    def prompt_download_choice(self, default: Optional[str] = None) -> str:
+        lines = [
+            pad("Select what to download (1/2/3, other to cancel):", WIDTH - 2),
+            pad("1) Photos only   -> PIC", WIDTH - 2),
+            pad("2) Videos only   -> VID", WIDTH - 2),
+            pad("3) Photos & Videos (both)", WIDTH - 2),
+        ]
+        self._log_output(c(box(lines), Fore.YELLOW))
+        p = "Your choice"
+        choice = self._get_input(p, default, hide_input=False).strip()
+        self._log_output(line("-"))
+        return choice
+
+    def _phase(self, name: str):
+        """Context manager đo một phase khi đang profile; không làm gì nếu không."""
+        return self.profiler.phase(name) if self.profiler is not None else _NO_PHASE
+
+    def _render_event(self, ev: Dict[str, Any]):
+        """Dựng dòng log cho người đọc từ event (cùng nội dung với log cũ)."""
+        kind, op = ev["event"], ev.get("op")
+        if kind == "file_start":
+            if op == "download":
+                self._log_output(pad(f"Downloading Message ID {ev['msg_id']} to {ev['name']}...", WIDTH, "left"),
+                                 "blue")
+            else:
+                self._log_output(pad(f"Attempting to upload '{ev['name']}' to '{ev['peer']}'...", WIDTH, "left"),
+                                 "blue")
+        elif kind == "file_finish":
+            if op == "download":
+                self._log_output(pad(f"Successfully downloaded: {ev['name']}", WIDTH, "left"), "green")
+            else:
+                self._log_output(pad(f"Successfully uploaded '{ev['name']}' to '{ev['peer']}'. "
+                                     f"Message ID: {ev['msg_id']}", WIDTH, "left"), "green")
+        elif kind == "flood_wait":
+            self._log_output(pad(f"Flood wait error while {op}ing: Waiting {ev['seconds']} seconds...",
+                                 WIDTH, "left"), "yellow")
+        elif kind == "retry":
+            self._log_output(pad(f"Retrying {ev.get('name') or ev.get('msg_id')} ({ev.get('reason', '')})...",
+                                 WIDTH, "left"), "yellow")
+        elif kind == "file_fail":
+            if ev.get("reason") == "peer_flood":
+                self._log_output(pad("Peer flood error. Too many requests to this peer. Skipping for now.",
+                                     WIDTH, "left"), "yellow")
+            elif ev.get("reason") != "flood_wait":  # flood_wait đã có dòng riêng
+                if op == "download":
+                    self._log_output(pad(f"Error downloading message ID {ev['msg_id']}: {ev['error']}",
+                                         WIDTH, "left"), "red")
+                else:
+                    self._log_output(pad(f"Error uploading '{ev['name']}' to '{ev['peer']}': {ev['error']}",
+                                         WIDTH, "left"), "red")
+        # scan_page / scan_dialog / file_skip: chỉ ghi vào file event
+
+    async def _download_item(self, item: Dict[str, Any]) -> str:
+        """
+        Tải (hoặc bỏ qua) một media; trả về 'downloaded', 'skipped', 'failed', hoặc 'stale' khi file
+        reference đã hết hạn (chưa tính là lỗi: người gọi làm mới message rồi xếp lại hàng, xem _refresh_references).
+        """
+        msg = item["message"]
+        rel_path = self._relative_path_for(item)
+
+        dialog_id = self._dialog_id_of(msg)
+
+        # Check if already completed from state or file exists
+        with self._phase("resume_check"):
+            already_done, stored_size = self._stored_intact(item, rel_path)
+        if already_done:
+            self.stats['skipped'] += 1
+            with self._phase("state_persist"):
+                self.state.mark_completed(int(msg.id), dialog_id)  # Ensure marked as completed
+            if stored_size is not None:  # Bổ sung vào catalog các file tải từ trước khi có catalog
+                with self._phase("catalog"):
+                    self.catalog.record(self._catalog_row(item, self.storage.locate(rel_path), stored_size),
+                                        replace=False)
+            self.events.emit("file_skip", op="download", msg_id=int(msg.id), dialog=dialog_id, name=rel_path.name)
+            return "skipped"
+        else:
+            started = time.monotonic()
+            try:
+                self.events.emit("file_start", op="download", msg_id=int(msg.id), dialog=dialog_id,
+                                 name=rel_path.name, type=item['type'])
+                self.metrics.in_flight.inc()
+                try:
+                    with self._phase("transfer"):
+                        location, size, info = await self._store_media(item, rel_path)
+                finally:
+                    self.metrics.in_flight.dec()
+
+                self.metrics.download_seconds.observe(time.monotonic() - started)
+                self.metrics.files_downloaded.inc()
+                self.metrics.bytes_downloaded.inc(size)
+                self.stats['downloaded'] += 1
+                self.stats['total_size'] += size
+                with self._phase("state_persist"):
+                    self.state.mark_completed(int(msg.id), dialog_id)
+                with self._phase("catalog"):
+                    self.catalog.record(self._catalog_row(item, location, size, info.get("sha256")))
+                sniffed = info.get("sniffed_mime")
+                if sniffed and sniffed.split("/")[0] != item['type'].replace("photo", "image"):
+                    self._log_output(pad(f"Warning: {rel_path.name} looks like {sniffed}.", WIDTH, "left"),
+                                     "yellow")
+                self.events.emit("file_finish", op="download", msg_id=int(msg.id), dialog=dialog_id,
+                                 name=rel_path.name, size=size, location=location, sha256=info.get("sha256"),
+                                 duration=time.monotonic() - started)
+                return "downloaded"
+
+            except FloodWaitError as e:
+                self.events.emit("flood_wait", op="download", msg_id=int(msg.id), seconds=e.seconds + 5)
+                self.metrics.flood_wait_seconds.inc(e.seconds + 5)
+                await asyncio.sleep(e.seconds + 5)
+                self.stats['errors'] += 1
+                self.metrics.errors.inc()
+                self.events.emit("file_fail", op="download", msg_id=int(msg.id), dialog=dialog_id,
+                                 name=rel_path.name, reason="flood_wait", error=str(e),
+                                 duration=time.monotonic() - started)
+            except PeerFloodError as e:
+                self.stats['errors'] += 1
+                self.metrics.errors.inc()
+                self.events.emit("file_fail", op="download", msg_id=int(msg.id), dialog=dialog_id,
+                                 name=rel_path.name, reason="peer_flood", error=str(e),
+                                 duration=time.monotonic() - started)
+            except Exception as e:
+                if isinstance(e, FileReferenceExpiredError) and not item.get("refreshed"):
+                    return "stale"
+                self.stats['errors'] += 1
+                self.metrics.errors.inc()
+                self.events.emit("file_fail", op="download", msg_id=int(msg.id), dialog=dialog_id,
+                                 name=rel_path.name, reason="error", error=str(e),
+                                 duration=time.monotonic() - started)
+        return "failed"
+
+    async def _refresh_references(self, items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Lấy lại các message có file reference hết hạn, theo dialog, mỗi request tối đa REFRESH_BATCH ID.
+        Trả về item mới (đánh dấu 'refreshed' để chỉ thử lại một lần) theo thứ tự cũ; message đã bị xoá
+        hoặc không còn media được tính là lỗi. Scan cache cũng được cập nhật để lần resume sau dùng bản mới.
+        """
+        by_dialog: Dict[int, List[Dict[str, Any]]] = {}
+        for item in items:
+            by_dialog.setdefault(self._dialog_id_of(item['message']), []).append(item)
+
+        refreshed: Dict[Tuple[int, int], Dict[str, Any]] = {}
+        for dialog_id, group in by_dialog.items():
+            peer = group[0]['message'].peer_id
+            for start in range(0, len(group), REFRESH_BATCH):
+                batch = group[start:start + REFRESH_BATCH]
+                try:
+                    messages = await self.client.get_messages(peer, ids=[int(i['message'].id) for i in batch])
+                except Exception as e:
+                    messages = [None] * len(batch)
+                    self._log_output(pad(f"Could not refresh file references in dialog {dialog_id}: {e}",
+                                         WIDTH, "left"), "red")
+                fresh_entries = []
+                for item, message in zip(batch, messages):
+                    msg_id = int(item['message'].id)
+                    mtype = self._classify_media(message) if message is not None else None
+                    if mtype is None:
+                        self.stats['errors'] += 1
+                        self.metrics.errors.inc()
+                        self.events.emit("file_fail", op="download", msg_id=msg_id, dialog=dialog_id,
+                                         name=self._relative_path_for(item).name, reason="error",
+                                         error="file reference expired and message is no longer available")
+                        continue
+                    fresh_entries.append((message, mtype))
+                    refreshed[(dialog_id, msg_id)] = {**item, 'message': message, 'type': mtype, 'refreshed': True}
+                    self.metrics.retries.inc()
+                    self.events.emit("retry", op="download", msg_id=msg_id, dialog=dialog_id,
+                                     name=self._relative_path_for(item).name, reason="file reference expired")
+                if fresh_entries:
+                    self.scan_cache.add_media(str(await self.client.get_peer_id(peer)), fresh_entries)
+        return [refreshed[key] for key in ((self._dialog_id_of(i['message']), int(i['message'].id)) for i in items)
+                if key in refreshed]
+
+    async def download_all_media(self, media_list: List[Dict[str, Any]], stop_flag: Callable[[], bool],
+                                 progress_callback: Optional[
+                                     Callable[[float, int, int, Dict[str, Any]], None]] = None) -> None:
+        """
+        Downloads media files from the given list.
+        stop_flag: a callable that returns True if the download should stop.
+        progress_callback: a callable (progress, current_processed, total_items, stats) for UI updates.
+        """
+        self._sweep_partials()
+        total_items = len(media_list)
+        current_processed = 0
+        self.metrics.queue_depth.set(total_items)
+        pending = deque(self.order_media(media_list))
+        stale: Dict[int, List[Dict[str, Any]]] = {}  # item có file reference hết hạn, chờ làm mới theo dialog
+
+        # Use tqdm only if in CLI mode and tqdm is available
+        progress_bar = None
+        tqdm = _tqdm() if self._log_output == console_log_func else None
+        if tqdm is not None:
+            progress_bar = tqdm(total=total_items, desc="Downloading", unit="file", ncols=WIDTH, ascii=True,
+                                bar_format="{desc}: {n_fmt}/{total_fmt} |{bar}| {rate_fmt}")
+
+        while pending or stale:
+            if stop_flag():
+                self._log_output(pad("Download stopped by user.", WIDTH, "left"), "red")
+                break
+
+            # Làm mới theo lô: khi một dialog gom đủ REFRESH_BATCH item, hoặc khi hàng đợi đã cạn
+            full = [d for d, group in stale.items() if len(group) >= REFRESH_BATCH or not pending]
+            if full:
+                fresh = await self._refresh_references([i for d in full for i in stale.pop(d)])
+                pending.extendleft(reversed(fresh))
+                current_processed = total_items - len(pending) - sum(len(g) for g in stale.values())
+                if progress_bar is not None: progress_bar.n = current_processed; progress_bar.refresh()
+                if not pending:
+                    continue
+
+            item = self._take_promoted(pending) or pending.popleft()
+            if await self._download_item(item) == "stale":
+                stale.setdefault(self._dialog_id_of(item['message']), []).append(item)
+                continue
+            if progress_bar is not None: progress_bar.update(1)
+
+            current_processed += 1
+            self.metrics.queue_depth.set(total_items - current_processed)
+            self.metrics.touch()
+            progress = current_processed / total_items if total_items > 0 else 0
+            if progress_callback:
+                # progress, current_items_processed, total_items_to_process, current_stats
+                progress_callback(progress, current_processed, total_items, self.stats.copy())
+
+        if progress_bar is not None:
+            progress_bar.close()
+        # Ensure final progress update
+        if progress_callback:
+            progress_callback(1.0, total_items, total_items, self.stats.copy())
+
+        self._log_output(pad("All media download attempts processed.", WIDTH, "left"), "blue")
+
+    # ===================== THỨ TỰ TẢI =====================
+
+    @staticmethod
+    def _dialog_id_of(msg) -> int:
+        # Use message.peer_id to get dialog ID for StateManager
+        dialog_id = getattr(msg.peer_id, 'user_id',
+                            getattr(msg.peer_id, 'channel_id', getattr(msg.peer_id, 'chat_id', None)))
+        if dialog_id is None:  # For 'Saved Messages' (msg.peer_id might be None for older versions)
+            dialog_id = msg.sender_id  # Fallback to sender_id
+        if dialog_id is None: dialog_id = -1  # A generic ID for 'me' or if sender also None
+        return dialog_id
+
+    def order_media(self, media_list: List[Dict[str, Any]], order: Optional[str] = None) -> List[Dict[str, Any]]:
+        """
+        Sắp xếp hàng đợi tải theo chính sách (mặc định self.download_order):
+          scan              giữ thứ tự quét
+          smallest/largest  theo kích thước Telegram báo trong Message (ảnh nhỏ xong trước video nhiều GB)
+          newest/oldest     theo ngày đăng
+          fair              xoay vòng giữa các dialog, trong mỗi dialog giữ thứ tự quét
+        Media có cờ 'interactive' (người dùng chọn) luôn ở làn đầu; trong mỗi làn vẫn theo cùng chính sách.
+        """
+        order = order or self.download_order
+        if order not in DOWNLOAD_ORDERS:
+            raise ValueError(f"Unknown download order '{order}' (expected one of {', '.join(DOWNLOAD_ORDERS)})")
+        interactive = [m for m in media_list if m.get("interactive")]
+        rest = [m for m in media_list if not m.get("interactive")]
+        return self._order_lane(interactive, order) + self._order_lane(rest, order)
+
+    def _order_lane(self, items: List[Dict[str, Any]], order: str) -> List[Dict[str, Any]]:
+        if order in ("smallest", "largest"):
+            return sorted(items, key=lambda m: self._media_size(m["message"]), reverse=order == "largest")
+        if order in ("newest", "oldest"):
+            return sorted(items, key=lambda m: (m["message"].date, m["message"].id), reverse=order == "newest")
+        if order == "fair":
+            # Khoá (hạng trong dialog, thứ tự xuất hiện của dialog): vòng 1 lấy mục đầu của mọi dialog, rồi vòng 2...
+            ranks: Dict[int, int] = {}
+            positions: Dict[int, int] = {}
+            keyed = []
+            for m in items:
+                dialog_id = self._dialog_id_of(m["message"])
+                rank = ranks.get(dialog_id, 0)
+                ranks[dialog_id] = rank + 1
+                keyed.append(((rank, positions.setdefault(dialog_id, len(positions))), m))
+            return [m for _, m in sorted(keyed, key=lambda km: km[0])]
+        return list(items)
+
+    def promote(self, message_ids: List[int]):
+        """Đưa các message lên đầu lượt tải đang chạy (làn interactive), vd. khi người dùng chọn qua API."""
+        self._promoted.update(int(i) for i in message_ids)
+
+    def _take_promoted(self, pending: deque) -> Optional[Dict[str, Any]]:
+        if not self._promoted:
+            return None
+        for i, m in enumerate(pending):
+            if int(m["message"].id) in self._promoted:
+                self._promoted.discard(int(m["message"].id))
+                del pending[i]
+                return m
+        self._promoted.clear()  # không còn mục nào trong hàng đợi này
+        return None
+
+    # ===================== WATCH (DAEMON) =====================
+
+    async def _resolve_watch_targets(self, source: str, dialogs: Optional[List[str]] = None) -> List[Any]:
+        if source == "saved":
+            return ["me"]
+        if source == "all":
+            return [row["entity"] for row in await self.list_dialogs(print_to_cli=False)]
+        targets = []
+        for ref in dialogs or []:
+            ref = int(ref) if re.fullmatch(r"-?\d+", str(ref)) else ref
+            targets.append(await self.client.get_entity(ref))
+        return targets
+
+    async def watch(self, source: str, dialogs: Optional[List[str]] = None, filter_choice: str = "3",
+                    stop_flag: Optional[Callable[[], bool]] = None, check_interval: float = 10.0,
+                    catch_up_interval: float = 900.0) -> None:
+        """
+        Chế độ daemon: giữ client kết nối, nhận NewMessage của các dialog đã chọn và đẩy ảnh/video mới
+        thẳng vào hàng đợi tải. Lúc khởi động, sau mỗi lần kết nối lại và định kỳ (catch_up_interval),
+        quét bù các khoảng ID chưa có trong scan cache (tin đến lúc offline) vào cùng hàng đợi.
+        """
+        stop_flag = stop_flag or (lambda: False)
+        targets = await self._resolve_watch_targets(source, dialogs)
+        if not targets:
+            self._log_output(pad("No dialogs to watch.", WIDTH, "left"), "red")
+            return
+        wanted = {"1": {"photo"}, "2": {"video"}}.get(filter_choice, {"photo", "video"})
+        dialog_ids = ["me"] if source == "saved" else [int(getattr(t, "id", 0)) for t in targets]
+        self.state.set_source(source, dialog_ids, last_filter=filter_choice)
+        self._sweep_partials()
+
+        pending: "asyncio.Queue[Dict[str, Any]]" = asyncio.Queue()
+        queued: set = set()  # (chat_id, message_id) đang chờ / đang tải
+
+        def enqueue(item: Dict[str, Any]) -> bool:
+            msg = item['message']
+            key = (msg.chat_id, int(msg.id))
+            if item['type'] not in wanted or key in queued or \
+                    self.state.is_completed(key[1], self._dialog_id_of(msg)):
+                return False
+            queued.add(key)
+            pending.put_nowait(item)
+            self.metrics.queue_depth.set(pending.qsize())
+            return True
+
+        async def on_new_message(event):
+            mtype = self._classify_media(event.message)
+            if mtype and self.in_scan_window(event.message) and enqueue({'message': event.message, 'type': mtype, 'date': event.message.date}):
+                self.state.add_found(1)
+                self.events.emit("watch_new", msg_id=int(event.message.id), dialog=event.chat_id, type=mtype)
+
+        async def catch_up(reason: str):
+            self.events.emit("watch_catch_up", reason=reason, dialogs=len(targets))
+            found = await self.scan_media_in_dialogs(targets)
+            added = sum(1 for item in found if enqueue(item))
+            if added:
+                self.state.add_found(added)
+            self._log_output(pad(f"Catch-up ({reason}): {added} media queued.", WIDTH, "left"), "blue")
+
+        async def worker():
+            while True:
+                item = await pending.get()
+                try:
+                    if await self._download_item(item) == "stale":
+                        for fresh in await self._refresh_references([item]):
+                            await self._download_item(fresh)
+                finally:
+                    queued.discard((item['message'].chat_id, int(item['message'].id)))
+                    pending.task_done()
+                    self.metrics.queue_depth.set(pending.qsize())
+                    self.metrics.touch()
+
+        builder = events.NewMessage(chats=targets)
+        self.client.add_event_handler(on_new_message, builder)
+        worker_task = asyncio.create_task(worker())
+        self._log_output(pad(f"Watching {len(targets)} dialog(s) for new media. Press Ctrl+C to stop.",
+                             WIDTH, "left"), "green")
+        try:
+            await catch_up("startup")
+            last_catch_up = time.monotonic()
+            was_connected = True
+            while not stop_flag():
+                await asyncio.sleep(check_interval)
+                connected = self.client.is_connected()
+                if not connected:
+                    if was_connected:
+                        self._log_output(pad("Connection lost. Reconnecting...", WIDTH, "left"), "yellow")
+                    try:
+                        await self.client.connect()
+                        connected = self.client.is_connected()
+                    except Exception as e:
+                        self._log_output(pad(f"Reconnect failed: {e}", WIDTH, "left"), "red")
+                if connected and (not was_connected or time.monotonic() - last_catch_up >= catch_up_interval):
+                    await catch_up("reconnect" if not was_connected else "periodic")
+                    last_catch_up = time.monotonic()
+                was_connected = connected
+        finally:
+            self.client.remove_event_handler(on_new_message, builder)
+            worker_task.cancel()
+            try:
+                await worker_task
+            except asyncio.CancelledError:
+                pass
+            self._log_output(pad("Watch stopped.", WIDTH, "left"), "blue")
+
+    # ===================== MIRROR (SERVER-SIDE) =====================
+
+    @staticmethod
+    def _mirror_batches(messages: List[Any]) -> Iterator[List[Any]]:
+        """Cắt thành lô tối đa MIRROR_BATCH tin, không tách một album (grouped_id) ra hai lô."""
+        batch: List[Any] = []
+        for message in messages:
+            if len(batch) >= MIRROR_BATCH:
+                cut = len(batch)
+                group = getattr(message, "grouped_id", None)
+                while group and cut > 0 and getattr(batch[cut - 1], "grouped_id", None) == group:
+                    cut -= 1
+                cut = cut or len(batch)
+                yield batch[:cut]
+                batch = batch[cut:]
+            batch.append(message)
+        if batch:
+            yield batch
+
+    async def mirror_media(self, media_list: List[Dict[str, Any]], destination: Any, drop_author: bool = True,
+                           stop_flag: Optional[Callable[[], bool]] = None,
+                           progress_callback: Optional[Callable[[float, int, int, Dict[str, Any]], None]] = None
+                           ) -> Dict[str, int]:
+        """
+        Chuyển media sang `destination` bằng ForwardMessages: Telegram sao chép file phía server, không byte
+        nào đi qua máy này. drop_author=True gửi như bản sao (không có dòng "Forwarded from").
+        Mỗi dialog nguồn đi theo thứ tự cũ -> mới, MIRROR_BATCH tin mỗi request; FloodWait thì chờ rồi gửi lại
+        đúng lô đó. Tin đã chuyển được ghi vào MirrorManifest sau mỗi lô, nên chạy lại chỉ gửi phần còn thiếu.
+        """
+        stop_flag = stop_flag or (lambda: False)
+        dest = await self.client.get_entity(destination) if isinstance(destination, (int, str)) else destination
+        dest_key = str(await self.client.get_peer_id(dest))
+        manifest = MirrorManifest(self.account_index)
+
+        by_dialog: Dict[int, List[Any]] = {}
+        for m in media_list:
+            msg = m['message']
+            dialog_id = self._dialog_id_of(msg)
+            if not manifest.is_mirrored(dest_key, dialog_id, int(msg.id)):
+                by_dialog.setdefault(dialog_id, []).append(msg)
+        total = sum(len(v) for v in by_dialog.values())
+        result = {"mirrored": 0, "skipped": len(media_list) - total, "failed": 0}
+        processed = 0
+        self.metrics.queue_depth.set(total)
+        self._log_output(pad(f"Mirroring {total} media from {len(by_dialog)} dialog(s) "
+                             f"({result['skipped']} already mirrored).", WIDTH, "left"), "blue")
+
+        for dialog_id, messages in by_dialog.items():
+            messages.sort(key=lambda msg: int(msg.id))
+            peer = messages[0].peer_id
+            offset = 0  # số tin của dialog này đã xử lý ở các lô trước
+            for batch in self._mirror_batches(messages):
+                if stop_flag():
+                    self._log_output(pad("Mirror stopped by user.", WIDTH, "left"), "red")
+                    return result
+                ids = [int(msg.id) for msg in batch]
+                started = time.monotonic()
+                try:
+                    while True:
+                        try:
+                            sent = await self.client.forward_messages(dest, ids, from_peer=peer,
+                                                                      drop_author=drop_author)
+                            break
+                        except FloodWaitError as e:
+                            self.events.emit("flood_wait", op="mirror", msg_id=ids[0], seconds=e.seconds + 5)
+                            self.metrics.flood_wait_seconds.inc(e.seconds + 5)
+                            await asyncio.sleep(e.seconds + 5)
+                            self.metrics.retries.inc()
+                            self.events.emit("retry", op="mirror", msg_id=ids[0], dialog=dialog_id,
+                                             name=f"{len(ids)} message(s) from {dialog_id}", reason="flood wait")
+                except Exception as e:
+                    # Thường là kênh bật "restrict saving content": cả dialog không forward được
+                    remaining = len(messages) - offset
+                    result["failed"] += remaining
+                    processed += remaining
+                    self.metrics.errors.inc()
+                    self.events.emit("mirror_fail", dialog=dialog_id, msg_id=ids[0], count=remaining, error=str(e))
+                    self._log_output(pad(f"Cannot mirror dialog {dialog_id}: {e}", WIDTH, "left"), "red")
+                    break
+                sent = sent if isinstance(sent, list) else [sent]
+                done_ids = [i for i, out in zip(ids, sent) if out is not None]
+                manifest.mark_mirrored(dest_key, dialog_id, done_ids)
+                manifest.save()
+                result["mirrored"] += len(done_ids)
+                result["failed"] += len(ids) - len(done_ids)
+                processed += len(ids)
+                offset += len(ids)
+                self.metrics.queue_depth.set(total - processed)
+                self.metrics.touch()
+                self.events.emit("mirror_batch", dialog=dialog_id, first_id=ids[0], last_id=ids[-1],
+                                 sent=len(done_ids), duration=time.monotonic() - started)
+                if progress_callback:
+                    progress_callback(processed / total if total else 1.0, processed, total, dict(result))
+        self._log_output(pad(f"Mirrored {result['mirrored']} media ({manifest.count(dest_key)} in total to this "
+                             f"destination), {result['failed']} failed.", WIDTH, "left"), "green")
+        return result
+
+    async def run_mirror(self, source: str, dialogs: Optional[List[str]], destination: Any, filter_choice: str = "3",
+                         drop_author: bool = True, stop_flag: Optional[Callable[[], bool]] = None) -> Dict[str, int]:
+        """Quét nguồn bằng pipeline quét thường (scan cache, cửa sổ ngày/kích thước) rồi mirror_media."""
+        dest = await self.client.get_entity(destination) if isinstance(destination, (int, str)) else destination
+        dest_id = await self.client.get_peer_id(dest)
+        targets = [t for t in await self._resolve_watch_targets(source, dialogs)
+                   if t == "me" or await self.client.get_peer_id(t) != dest_id]  # không mirror đích vào chính nó
+        media_list = await self.scan_media_in_dialogs(targets) if targets else []
+        wanted = {"1": {"photo"}, "2": {"video"}}.get(filter_choice, {"photo", "video"})
+        media_list = [m for m in media_list if m['type'] in wanted]
+        return await self.mirror_media(media_list, dest, drop_author=drop_author, stop_flag=stop_flag)
+
+    # ===================== NEW UPLOAD METHODS =====================
+
+    async def _resolve_upload_peer(self, peer: Union[User, Chat, Channel, int, str]) -> Tuple[Any, str]:
+        """(entity, tên hiển thị) của một đích upload."""
+        try:
+            if isinstance(peer, (int, str)):
+                self._log_output(pad(f"Resolving destination '{peer}'...", WIDTH, "left"), "blue")
+                peer_entity = await self.client.get_entity(peer)
+            else:
+                peer_entity = peer
+
+            # Use entity's title or first_name for logging
+            peer_name = peer_entity.title if hasattr(peer_entity, 'title') else peer_entity.first_name if hasattr(
+                peer_entity, 'first_name') else str(peer)
+        except Exception as e:
+            self._log_output(pad(f"Error resolving destination '{peer}': {e}", WIDTH, "left"), "red")
+            raise ValueError(f"Invalid destination '{peer}'. Please check the ID or username.") from e
+        return peer_entity, peer_name
+
+    async def upload_media(
+            self,
+            peer: Union[User, Chat, Channel, int, str, List[Union[User, Chat, Channel, int, str]]],
+            file_path: Path,
+            caption: Optional[str] = None,
+            progress_callback: Optional[Callable[[float, int, int], None]] = None
+            # (progress_percentage, current_bytes, total_bytes)
+    ):
+        """
+        Uploads a single media file to a peer (user/chat/channel), or to a list of peers.
+        The file is uploaded once; every destination then receives the same uploaded handle concurrently.
+        Returns the sent message (one peer) or a list with a message or exception per peer (list of peers).
+        """
+        if not self.client.is_connected():
+            raise ConnectionError("Telegram client is not connected. Please ensure you are logged in.")
+
+        if not file_path.is_file():
+            self._log_output(pad(f"File not found at '{file_path}'.", WIDTH, "left"), "red")
+            raise FileNotFoundError(f"File not found: {file_path}")
+
+        many = isinstance(peer, (list, tuple))
+        targets = [await self._resolve_upload_peer(p) for p in (peer if many else [peer])]
+        results = await self._upload_fan_out(targets, file_path, caption, progress_callback)
+        if many:
+            return results
+        if isinstance(results[0], BaseException):
+            raise results[0]  # Re-raise for GUI/CLI to catch and display
+        return results[0]
+
+    @staticmethod
+    def _upload_handle_expired(error: BaseException) -> bool:
+        # FilePartMissingError, FilePartsInvalidError...: Telegram đã bỏ các phần file của handle cũ
+        return type(error).__name__.startswith("FilePart")
+
+    async def _upload_fan_out(self, targets: List[Tuple[Any, str]], file_path: Path, caption: Optional[str],
+                              progress_callback: Optional[Callable[[float, int, int], None]] = None) -> List[Any]:
+        """
+        Upload file một lần (hoặc lấy handle trong UploadCache theo SHA-256), rồi gửi handle tới mọi đích
+        cùng lúc. Handle trong cache đã hết hạn phía Telegram thì bị bỏ, upload lại một lần cho các đích lỗi.
+        """
+        size = file_path.stat().st_size
+        digest = await asyncio.to_thread(sha256_file, file_path)
+        as_image = telethon_utils.is_image(str(file_path))
+        attributes, mime_type = telethon_utils.get_attributes(str(file_path))
+
+        def telethon_progress_adapter(current, total):
+            if progress_callback:
+                progress = current / total if total > 0 else 0
+                progress_callback(progress, current, total)
+
+        results: List[Any] = [None] * len(targets)
+        todo = list(range(len(targets)))
+        handle = self.upload_cache.get(digest)
+        cached = handle is not None
+        while todo:
+            for i in todo:
+                self.events.emit("file_start", op="upload", name=file_path.name, path=str(file_path),
+                                 peer=targets[i][1])
+            if handle is None:
+                started = time.monotonic()
+                self.metrics.in_flight.inc()
+                try:
+                    with self._phase("upload"):
+                        # Ảnh được thu nhỏ như send_file(path) làm, để vẫn gửi được dạng photo
+                        source = str(file_path)
+                        if resize_photo_if_needed is not None:
+                            source = await asyncio.to_thread(resize_photo_if_needed, source, as_image)
+                        elif as_image and not self._resize_warned:
+                            self._resize_warned = True
+                            self._log_output(pad("Telethon photo resize unavailable; uploading images as-is.",
+                                                 WIDTH, "left"), "yellow")
+                        handle = await self.client.upload_file(
+                            source, file_size=size if isinstance(source, str) else None,
+                            progress_callback=telethon_progress_adapter)
+                except Exception as e:
+                    self.metrics.errors.inc()
+                    for i in todo:
+                        results[i] = e
+                        self.events.emit("file_fail", op="upload", name=file_path.name, peer=targets[i][1],
+                                         reason="error", error=str(e), duration=time.monotonic() - started)
+                    break
+                finally:
+                    self.metrics.in_flight.dec()
+                self.metrics.upload_seconds.observe(time.monotonic() - started)
+                self.metrics.bytes_uploaded.inc(size)
+                self.upload_cache.put(digest, handle, size)
+            else:
+                self.events.emit("upload_cache_hit", name=file_path.name, sha256=digest, destinations=len(todo))
+                telethon_progress_adapter(size, size)
+
+            sent = await asyncio.gather(*(self._send_uploaded(targets[i], handle, file_path, size, caption,
+                                                              attributes, mime_type) for i in todo),
+                                        return_exceptions=True)
+            retry = []
+            for i, outcome in zip(todo, sent):
+                if isinstance(outcome, Exception) and self._upload_handle_expired(outcome):
+                    if cached:
+                        retry.append(i)
+                        continue
+                    self.metrics.errors.inc()  # handle vừa upload mà vẫn lỗi: không thử lại
+                    self.events.emit("file_fail", op="upload", name=file_path.name, peer=targets[i][1],
+                                     reason="error", error=str(outcome))
+                results[i] = outcome
+            if retry:
+                self.upload_cache.drop(digest)
+                self.metrics.retries.inc(len(retry))
+                for i in retry:
+                    self.events.emit("retry", op="upload", name=file_path.name, peer=targets[i][1],
+                                     reason="cached upload expired")
+            handle, cached, todo = None, False, retry
+        return results
+
+    async def _send_uploaded(self, target: Tuple[Any, str], handle: Any, file_path: Path, size: int,
+                             caption: Optional[str], attributes: List[Any], mime_type: str):
+        """
+        Gửi handle đã upload tới một đích với cùng force_document/attributes như send_file(path): handle mang tên
+        file gốc (hoặc a.jpg sau khi thu nhỏ) nên ảnh vẫn thành photo. FloodWait thì chờ rồi gửi lại.
+        """
+        peer_entity, peer_name = target
+        started = time.monotonic()
+        try:
+            while True:
+                try:
+                    with self._phase("send"):
+                        message = await self.client.send_file(peer_entity, file=handle, caption=caption,
+                                                              force_document=False,
+                                                              attributes=attributes, mime_type=mime_type)
+                    break
+                except FloodWaitError as e:
+                    wait = e.seconds + 5
+                    self.metrics.flood_wait_seconds.inc(wait)
+                    self.events.emit("flood_wait", op="upload", name=file_path.name, seconds=wait)
+                    await asyncio.sleep(wait)
+                    self.metrics.retries.inc()
+        except Exception as e:
+            if not self._upload_handle_expired(e):
+                self.metrics.errors.inc()
+                self.events.emit("file_fail", op="upload", name=file_path.name, peer=peer_name, reason="error",
+                                 error=str(e), duration=time.monotonic() - started)
+            raise
+        self.metrics.files_uploaded.inc()
+        self.metrics.touch()
+        self.events.emit("file_finish", op="upload", name=file_path.name, peer=peer_name, msg_id=message.id,
+                         size=size, duration=time.monotonic() - started)
+        return message
+
+    def is_media_file(self, file_path: Path) -> bool:
+        """Checks if a file has a common media extension."""
+        if not file_path.is_file():
+            return False
+
+        # Common image and video extensions
+        media_extensions = {
+            '.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff', '.webp',  # Images
+            '.mp4', '.mov', '.avi', '.mkv', '.webm', '.flv', '.wmv', '.gifv'  # Videos
+        }
+        return file_path.suffix.lower() in media_extensions
+
+    async def upload_folder_media(
+            self,
+            peer: Union[User, Chat, Channel, int, str, List[Union[User, Chat, Channel, int, str]]],
+            folder_path: Path,
+            caption: Optional[str] = None,
+            progress_callback: Optional[Callable[[float, int, int, int, int], None]] = None,
+            # (overall_progress, current_file_index, total_files, current_file_bytes, total_file_bytes)
+            stop_flag: Optional[Callable[[], bool]] = None
+    ):
+        """
+        Uploads all media files from a specified folder to a peer, or to a list of peers
+        (each file is uploaded once and sent to every destination, see upload_media).
+        """
+        if not self.client.is_connected():
+            raise ConnectionError("Telegram client is not connected. Please ensure you are logged in.")
+        if not folder_path.is_dir():
+            self._log_output(pad(f"Folder not found at '{folder_path}'.", WIDTH, "left"), "red")
+            raise FileNotFoundError(f"Folder not found: {folder_path}")
+
+        media_files = [f for f in folder_path.iterdir() if self.is_media_file(f)]
+        if not media_files:
+            self._log_output(pad(f"No media files found in '{folder_path}'.", WIDTH, "left"), "yellow")
+            return
+
+        total_files = len(media_files)
+        uploaded_count = 0
+        failed_count = 0
+        self.metrics.queue_depth.set(total_files)
+
+        self._log_output(
+            pad(f"Starting batch upload of {total_files} media files from '{folder_path.name}'...", WIDTH, "left"),
+            "blue")
+
+        # Resolve peer entities once
+        targets = [await self._resolve_upload_peer(p) for p in (peer if isinstance(peer, (list, tuple)) else [peer])]
+        for _, peer_name in targets:
+            self._log_output(pad(f"Resolved destination: '{peer_name}'", WIDTH, "left"), "blue")
+        peer_entities = [entity for entity, _ in targets]
+
+        for i, file_path in enumerate(media_files):
+            if stop_flag and stop_flag():
+                self._log_output(pad("Upload stopped by user.", WIDTH, "left"), "red")
+                break
+
+            self._log_output(pad(f"[{i + 1}/{total_files}] Uploading '{file_path.name}'...", WIDTH, "left"), "blue")
+
+            # Inner progress callback for the single file being uploaded
+            def file_progress_adapter(progress_percentage, current_bytes, total_bytes):
+                if progress_callback:
+                    overall_progress = (uploaded_count + progress_percentage) / total_files
+                    progress_callback(overall_progress, i + 1, total_files, current_bytes, total_bytes)
+
+            try:
+                results = await self.upload_media(
+                    peer_entities,  # Use the already resolved entities
+                    file_path,
+                    caption,
+                    progress_callback=file_progress_adapter
+                )
+                failed = [(name, r) for (_, name), r in zip(targets, results) if isinstance(r, BaseException)]
+                if failed:
+                    failed_count += 1
+                    for name, error in failed:
+                        self._log_output(pad(f"Failed to send '{file_path.name}' to '{name}': {error}", WIDTH,
+                                             "left"), "red")
+                else:
+                    uploaded_count += 1
+            except Exception as e:
+                failed_count += 1
+                self._log_output(pad(f"Failed to upload '{file_path.name}': {e}", WIDTH, "left"), "red")
+            self.metrics.queue_depth.set(total_files - i - 1)
+
+            # Ensure overall progress is updated even if a file fails or finishes without final callback from Telethon
+            if progress_callback:
+                overall_progress = (
+                                               uploaded_count + failed_count) / total_files  # This assumes 1.0 for each completed file
+                progress_callback(overall_progress, i + 1, total_files, 0,
+                                  0)  # Current file bytes/total file bytes not available here
+
+        self._log_output(
+            pad(f"Batch upload finished. Uploaded {uploaded_count}/{total_files} files. Failed: {failed_count}", WIDTH,
+                "left"), "green")
+
+    # ===================== CHẠY THEO NGUỒN =======================
+
+    async def _run_with_source(self, src_type: str, chosen_entities: Optional[List[Any]] = None,
+                               confirm_callback: Optional[Callable[[str, str], bool]] = None,
+                               # For GUI confirmation dialog
+                               progress_callback_scan: Optional[Callable[[int, Optional[int]], None]] = None,
+                               # For GUI scan progress
+                               progress_callback_download: Optional[
+                                   Callable[[float, int, int, Dict[str, Any]], None]] = None,
+                               # For GUI download progress
+                               stop_flag: Optional[Callable[[], bool]] = None  # For GUI to stop scan
+                               ) -> bool:
+        """
+        Thực thi chu trình quét + tải theo nguồn đã biết.
+        src_type: "saved" | "dialogs" | "all"
+        chosen_entities: danh sách entity (nếu dialogs/all), có thể None nếu saved
+        confirm_callback: a callable (title, message) -> bool or an awaitable of bool, for user confirmation
+        progress_callback_scan: a callable (current_messages_scanned, total_messages_in_dialog) for scan updates.
+        progress_callback_download: a callable (progress, current_items_processed, total_items_to_process, current_stats) for UI updates.
+        stop_flag: a callable that returns True if the scan/download should stop.
+        """
+        if stop_flag is None:  # Default to always continue for CLI without external stop
+            stop_flag = lambda: False
+
+        # 1) Scan theo nguồn; media lấy từ cache được tải lại theo ID để digest bắt được tin bị xoá/sửa
+        if src_type != "saved" and chosen_entities is None:
+            self._log_output(pad("Không có entities để quét.", WIDTH, "left"), "red")
+            return False
+        self.revalidate_scan_cache = True
+        try:
+            if src_type == "saved":
+                media_list = await self.scan_saved_messages(progress_callback_scan)
+            else:
+                media_list = await self.scan_media_in_dialogs(chosen_entities, progress_callback_scan)
+        finally:
+            self.revalidate_scan_cache = False
+        if src_type == "saved":
+            dialog_ids = ["me"]
+        else:
+            # rút id entity (int)
+            dialog_ids = []
+            for ent in chosen_entities:
+                try:
+                    dialog_ids.append(int(getattr(ent, "id", 0)))
+                except Exception:
+                    pass
+
+        if not media_list:
+            self._log_output(pad("No media found.", WIDTH, "left"), "yellow")
+            return False
+
+        # 2) + 3) Digest theo dialog / khối ID của danh sách vừa quét, so với lần quét trước:
+        # chỉ những khoảng ID có khối digest khác (media bị xoá/sửa) mới cần xem lại
+        digests, changes = self._media_changes(media_list)
+
+        # 4) Lưu source + total + digest (và giữ last_filter cũ)
+        # Note: self.state.set_source will save the state automatically
+        self.state.set_source(src_type, dialog_ids, total_found=len(media_list), digests=digests)
+
+        # 5) Có khoảng đổi -> hỏi kiểm tra lại riêng các khoảng đó (tiến độ phần còn lại giữ nguyên)
+        if changes:
+            n_ranges = sum(len(r) for r in changes.values())
+            summary = f"Media changed in {n_ranges} ID range(s) across {len(changes)} dialog(s) since last session."
+            self._log_output(c(pad(summary, WIDTH, "left"), Fore.YELLOW))
+            for dialog, ranges in changes.items():
+                spans = ", ".join(f"{lo}-{hi}" for lo, hi in ranges[:5]) + (" ..." if len(ranges) > 5 else "")
+                self._log_output(pad(f"  dialog {dialog}: {spans}", WIDTH, "left"))
+            if confirm_callback:
+                recheck = await _maybe_await(confirm_callback(
+                    "Re-check Changed Ranges", summary + " Re-check only those ranges? Other progress is kept."))
+            else:  # Fallback to console input if no GUI callback
+                answer = await _maybe_await(self._get_input(pad("Re-check those ranges? (yes/no) [yes]", WIDTH, "left"),
+                                                            "yes", hide_input=False))
+                recheck = answer.strip().lower() != "no"
+                self._log_output(line("-"))
+            if recheck:
+                forgotten = self._recheck_changed(changes)
+                self._log_output(c(pad(f"{forgotten} completed item(s) will be re-checked.", WIDTH, "left"),
+                                   Fore.CYAN))
+            else:
+                self._log_output(c(pad("Continuing with existing progress.", WIDTH, "left"), Fore.YELLOW))
+
+        # 6) In stats + chọn filter (mặc định lấy last_filter)
+        if self._log_output == console_log_func:  # Only print for CLI
+            self.print_stats()
+            choice = self.prompt_download_choice(default=self.state.get_last_filter())
+        else:  # GUI will set filter directly, or use last filter
+            choice = self.state.get_last_filter()
+
+        if choice not in {"1", "2", "3"}:  # This check is more relevant for CLI prompt. GUI should ensure valid choice.
+            self._log_output(pad("Canceled by user choice.", WIDTH, "left"), "yellow")
+            return False
+        # lưu bộ lọc vào state
+        self.state.set_source(src_type, dialog_ids, total_found=len(media_list), last_filter=choice)
+
+        # 7) Lọc theo loại
+        if choice == "1":  # Photos only
+            filtered = [m for m in media_list if m['type'] == 'photo']
+        elif choice == "2":  # Videos only
+            filtered = [m for m in media_list if m['type'] == 'video']
+        else:  # Both photos & videos or invalid filter (default to both)
+            filtered = media_list
+
+        # Store filtered media list for GUI to use in download screen
+        self.media_list = filtered  # Added this line for GUI to access filtered list
+
+        # 8) Áp dụng resume: bỏ completed + file tồn tại
+        resumable = []
+        with self._phase("resume_check"):
+            for m in filtered:
+                # Bỏ qua media đã có trong backend lưu trữ với đúng kích thước
+                if self._stored_intact(m, self._relative_path_for(m))[0]:
+                    self.stats['skipped'] += 1
+                    continue
+                resumable.append(m)
+
+        if not resumable:
+            self._log_output(pad("No items left to download (all completed).", WIDTH, "left"), "green")
+            if self._log_output == console_log_func: self.print_stats()  # Only print for CLI
+            return True
+
+        # If this is called from GUI scan, we don't start download yet.
+        # GUI will transition to filter screen, then start download.
+        if self._log_output != console_log_func:  # If not CLI, just return, GUI handles next step
+            return True
+
+        # 9) Tải (CLI only from here, GUI branches off)
+        start_time = time.time()
+        # Pass the stop_flag and progress_callback_download directly
+        with self._phase("download"):
+            await self.download_all_media(resumable, stop_flag=stop_flag,
+                                          progress_callback=progress_callback_download)  # CLI does not typically have an external stop_flag or UI progress, unless passed.
+        elapsed = time.time() - start_time
+        self._log_output(pad("Download finished.", WIDTH, "left"), "blue")
+        self._log_output(pad(f"Elapsed: {humanize.naturaldelta(elapsed)}", WIDTH, "left"), "blue")
+        if self.stats['downloaded'] > 0 and elapsed > 0:
+            avg_speed = self.stats['total_size'] / elapsed
+            self._log_output(pad(f"Average speed: {humanize.naturalsize(avg_speed)}/s", WIDTH, "left"), "blue")
+        return True
+
+    async def run_download_job(self, source: str, dialogs: Optional[List[str]] = None, filter_choice: str = "3",
+                               stop_flag: Optional[Callable[[], bool]] = None,
+                               progress_callback: Optional[Callable[[float, int, int, Dict[str, Any]], None]] = None
+                               ) -> Dict[str, Any]:
+        """
+        Chu trình quét + tải không tương tác (cho scheduler / API): khoảng ID đổi digest được kiểm tra lại
+        tự động, không hỏi bộ lọc. Trả về bản sao stats.
+        """
+        stop_flag = stop_flag or (lambda: False)
+        targets = await self._resolve_watch_targets(source, dialogs)
+        self.revalidate_scan_cache = True  # media từ cache được tải lại theo ID để digest bắt được xoá/sửa
+        try:
+            media_list = await self.scan_media_in_dialogs(targets) if targets else []
+        finally:
+            self.revalidate_scan_cache = False
+        dialog_ids = ["me"] if source == "saved" else [int(getattr(t, "id", 0)) for t in targets]
+        digests, changes = self._media_changes(media_list)
+        self.state.set_source(source, dialog_ids, total_found=len(media_list), digests=digests,
+                              last_filter=filter_choice)
+        self._recheck_changed(changes)
+        wanted = {"1": {"photo"}, "2": {"video"}}.get(filter_choice, {"photo", "video"})
+        filtered = [m for m in media_list if m['type'] in wanted]
+        if filtered and not stop_flag():
+            with self._phase("download"):
+                await self.download_all_media(filtered, stop_flag=stop_flag, progress_callback=progress_callback)
+        return self.stats.copy()
+
+
+# ============================ JOB QUEUE & SCHEDULER =============================
+
+class CronSchedule:
+    """
+    Biểu thức cron 5 trường (phút giờ ngày tháng thứ), hỗ trợ *, */n, a-b, a-b/n và danh sách a,b.
+    Thứ: 0-6 với 0 = Chủ nhật (7 cũng là Chủ nhật). Tính theo giờ máy.
+    """
+
+    FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expr: str):
+        parts = expr.split()
+        if len(parts) != 5:
+            raise ValueError(f"Cron expression needs 5 fields, got '{expr}'")
+        self.expr = expr
+        self.minutes, self.hours, self.days, self.months, weekdays = (
+            self._parse(part, lo, hi) for part, (lo, hi) in zip(parts, self.FIELDS))
+        self.weekdays = {d % 7 for d in weekdays}
+        self._any_day = parts[2] == "*"
+        self._any_weekday = parts[4] == "*"
+
+    @staticmethod
+    def _parse(part: str, lo: int, hi: int) -> set:
+        values = set()
+        for item in part.split(","):
+            rng, _, step = item.partition("/")
+            step_n = int(step) if step else 1
+            if rng == "*":
+                a, b = lo, hi
+            elif "-" in rng:
+                a, b = (int(x) for x in rng.split("-", 1))
+            else:
+                a = b = int(rng)
+                if step:
+                    b = hi
+            if not (lo <= a <= hi and lo <= b <= hi) or step_n < 1:
+                raise ValueError(f"Invalid cron field '{part}'")
+            values.update(range(a, b + 1, step_n))
+        return values
+
+    def _day_matches(self, dt: datetime) -> bool:
+        dom = dt.day in self.days
+        dow = (dt.isoweekday() % 7) in self.weekdays
+        if self._any_day or self._any_weekday:
+            return dom and dow
+        return dom or dow  # như cron chuẩn: cả hai trường bị giới hạn -> khớp một trong hai
+
+    def next_after(self, after: float) -> float:
+        """Unix time của lần chạy kế tiếp sau `after` (giờ địa phương)."""
+        dt = datetime.fromtimestamp(after).replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = dt + timedelta(days=5 * 366)
+        while dt < limit:
+            if dt.month not in self.months or not self._day_matches(dt):
+                dt = dt.replace(hour=0, minute=0) + timedelta(days=1)
+            elif dt.hour not in self.hours:
+                dt = dt.replace(minute=0) + timedelta(hours=1)
+            elif dt.minute not in self.minutes:
+                dt += timedelta(minutes=1)
+            else:
+                return dt.timestamp()
+        raise ValueError(f"Cron expression '{self.expr}' never fires")
+
+
+class JobQueue:
+    """
+    Hàng đợi job bền vững (sessions/jobs.sqlite), dùng chung cho mọi tài khoản.
+    status: queued -> running -> done | failed | queued (job có cron); paused / cancelled do người dùng đặt.
+    """
+
+    KINDS = ("download", "upload")
+    STATUSES = ("queued", "running", "paused", "done", "failed", "cancelled")
+
+    def __init__(self, db_file: Union[str, Path] = Path("sessions") / "jobs.sqlite"):
+        self.db_file = Path(db_file)
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self.db_file.parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(str(self.db_file), check_same_thread=False, timeout=10)
+            self._conn.row_factory = sqlite3.Row
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, account INTEGER NOT NULL,
+                    params TEXT NOT NULL DEFAULT '{}', priority INTEGER NOT NULL DEFAULT 0, schedule TEXT,
+                    status TEXT NOT NULL DEFAULT 'queued', next_run REAL NOT NULL DEFAULT 0,
+                    created_at REAL, started_at REAL, finished_at REAL, runs INTEGER NOT NULL DEFAULT 0,
+                    last_error TEXT, result TEXT);
+                CREATE INDEX IF NOT EXISTS idx_jobs_due ON jobs (status, next_run);
+            """)
+        return self._conn
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def add(self, kind: str, account: int, params: Dict[str, Any], priority: int = 0,
+            schedule: Optional[str] = None, start_at: Optional[float] = None) -> int:
+        if kind not in self.KINDS:
+            raise ValueError(f"Unknown job kind '{kind}'")
+        now = time.time()
+        next_run = start_at if start_at is not None else (CronSchedule(schedule).next_after(now) if schedule else now)
+        db = self._db()
+        with db:
+            cur = db.execute(
+                "INSERT INTO jobs (kind, account, params, priority, schedule, next_run, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (kind, int(account), json.dumps(params), int(priority), schedule, next_run, now))
+        return int(cur.lastrowid)
+
+    def get(self, job_id: int) -> Optional[sqlite3.Row]:
+        return self._db().execute("SELECT * FROM jobs WHERE id = ?", (int(job_id),)).fetchone()
+
+    def list(self, statuses: Optional[List[str]] = None) -> List[sqlite3.Row]:
+        sql, params = "SELECT * FROM jobs", []
+        if statuses:
+            sql += f" WHERE status IN ({', '.join('?' for _ in statuses)})"
+            params = list(statuses)
+        return self._db().execute(sql + " ORDER BY priority DESC, next_run, id", params).fetchall()
+
+    def due(self, now: Optional[float] = None) -> List[sqlite3.Row]:
+        return self._db().execute(
+            "SELECT * FROM jobs WHERE status = 'queued' AND next_run <= ? ORDER BY priority DESC, next_run, id",
+            (now if now is not None else time.time(),)).fetchall()
+
+    def _set(self, job_id: int, **fields):
+        cols = ", ".join(f"{k} = ?" for k in fields)
+        db = self._db()
+        with db:
+            db.execute(f"UPDATE jobs SET {cols} WHERE id = ?", [*fields.values(), int(job_id)])
+
+    def mark_running(self, job_id: int):
+        db = self._db()
+        with db:
+            db.execute("UPDATE jobs SET status = 'running', started_at = ?, runs = runs + 1 WHERE id = ?",
+                       (time.time(), int(job_id)))
+
+    def finish(self, job_id: int, error: Optional[str] = None, result: Optional[Dict[str, Any]] = None,
+               requeue: bool = False):
+        """
+        Kết thúc một lượt chạy; job có cron quay lại hàng đợi với next_run kế tiếp.
+        requeue=True (scheduler dừng giữa chừng) -> chạy lại ngay lần sau.
+        """
+        job = self.get(job_id)
+        if job is None:
+            return
+        now = time.time()
+        fields: Dict[str, Any] = {"finished_at": now, "last_error": error,
+                                  "result": json.dumps(result) if result is not None else job["result"]}
+        if job["status"] == "running":  # pause/cancel đặt trong lúc chạy thì giữ nguyên
+            if requeue:
+                fields.update(status="queued", next_run=now)
+            elif job["schedule"]:
+                fields.update(status="queued", next_run=CronSchedule(job["schedule"]).next_after(now))
+            else:
+                fields["status"] = "failed" if error else "done"
+        self._set(job_id, **fields)
+
+    def pause(self, job_id: int) -> bool:
+        return self._transition(job_id, ("queued", "running"), "paused")
+
+    def resume(self, job_id: int) -> bool:
+        ok = self._transition(job_id, ("paused", "failed"), "queued")
+        if ok:
+            self._set(job_id, next_run=time.time())
+        return ok
+
+    def cancel(self, job_id: int) -> bool:
+        return self._transition(job_id, ("queued", "running", "paused", "failed"), "cancelled")
+
+    def _transition(self, job_id: int, from_statuses: Tuple[str, ...], to_status: str) -> bool:
+        db = self._db()
+        with db:
+            cur = db.execute(f"UPDATE jobs SET status = ? WHERE id = ? AND status IN "
+                             f"({', '.join('?' for _ in from_statuses)})", (to_status, int(job_id), *from_statuses))
+        return cur.rowcount > 0
+
+    def recover(self):
+        """Job còn 'running' từ tiến trình trước (bị kill) -> chạy lại; resume state bỏ qua phần đã tải."""
+        db = self._db()
+        with db:
+            db.execute("UPDATE jobs SET status = 'queued', next_run = ? WHERE status = 'running'", (time.time(),))
+
+
+class JobScheduler:
+    """
+    Chạy job trong hàng đợi song song trên nhiều tài khoản: ưu tiên cao trước, tối đa max_concurrency
+    job cùng lúc, mỗi tài khoản một job. Các job cùng tài khoản dùng chung một client và các thuộc tính
+    của TelegramDownloader (cache, thứ tự, cửa sổ quét, media_list, stats) nên chạy lần lượt.
+    Trạng thái pause/cancel được đọc lại từ DB mỗi poll_interval nên có thể điều khiển từ tiến trình khác.
+    """
+
+    def __init__(self, queue: JobQueue,
+                 downloader_factory: Callable[[int], Any],
+                 max_concurrency: int = 4, poll_interval: float = 5.0,
+                 log_func: Callable[[str, Optional[str]], None] = None):
+        self.queue = queue
+        self.downloader_factory = downloader_factory  # async (account_index) -> Optional[TelegramDownloader]
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.poll_interval = poll_interval
+        self._log = log_func or console_log_func
+        self.downloaders: Dict[int, TelegramDownloader] = {}
+        self._account_locks: Dict[int, asyncio.Lock] = {}  # giữ suốt một job: tạo client + chạy lần lượt
+        self.running: Dict[int, Tuple[int, asyncio.Task]] = {}  # job_id -> (account, task)
+        self._stop_requested: set = set()
+        self._stopping = False
+
+    def stop(self):
+        self._stopping = True
+
+    async def _downloader_for(self, account: int) -> Optional[TelegramDownloader]:
+        downloader = self.downloaders.get(account)
+        if downloader is None:
+            downloader = await self.downloader_factory(account)
+            if downloader is not None:
+                self.downloaders[account] = downloader
+        return downloader
+
+    async def _execute(self, job: sqlite3.Row):
+        job_id, account = int(job["id"]), int(job["account"])
+        params = json.loads(job["params"] or "{}")
+        stop_flag = lambda: job_id in self._stop_requested or self._stopping
+        error, result = None, None
+        try:
+            async with self._account_locks.setdefault(account, asyncio.Lock()):
+                downloader = await self._downloader_for(account)
+                if downloader is None:
+                    raise RuntimeError(f"Could not connect account #{account}")
+                downloader.events.emit("job_start", job=job_id, kind=job["kind"])
+                if job["kind"] == "download":
+                    downloader.use_scan_cache = not params.get("rescan", False)
+                    downloader.stream_pipeline = bool(params.get("stream", False))
+                    downloader.download_order = params.get("order", "scan")
+                    downloader.scan_shards = int(params.get("scan_shards", SCAN_SHARDS))
+                    downloader.set_scan_window(**scan_window_from_params(params))
+                    result = await downloader.run_download_job(params.get("source", "all"), params.get("dialogs"),
+                                                               params.get("filter", "3"), stop_flag=stop_flag)
+                else:
+                    path = Path(params["path"])
+                    if path.is_dir():
+                        await downloader.upload_folder_media(params["to"], path, params.get("caption"),
+                                                             stop_flag=stop_flag)
+                    else:
+                        # "to" là chuỗi (job cũ) hoặc danh sách đích; lỗi ở bất kỳ đích nào làm job thất bại
+                        sent = await downloader.upload_media(params["to"], path, params.get("caption"))
+                        for outcome in (sent if isinstance(sent, list) else []):
+                            if isinstance(outcome, BaseException):
+                                raise outcome
+                downloader.events.emit("job_finish", job=job_id, kind=job["kind"])
+        except asyncio.CancelledError:
+            error = "interrupted"
+            raise
+        except Exception as e:
+            error = str(e)
+            self._log(pad(f"Job #{job_id} failed: {e}", WIDTH, "left"), "red")
+        finally:
+            self.queue.finish(job_id, error=error, result=result, requeue=self._stopping)
+            self._stop_requested.discard(job_id)
+            self.running.pop(job_id, None)
+
+    def _sync_control_state(self):
+        """Job đang chạy bị đặt paused/cancelled từ bên ngoài -> yêu cầu dừng (sau file hiện tại)."""
+        for job_id in list(self.running):
+            job = self.queue.get(job_id)
+            if job is None or job["status"] in ("paused", "cancelled"):
+                self._stop_requested.add(job_id)
+
+    def _start_due_jobs(self):
+        busy = {account for account, _task in self.running.values()}  # mỗi tài khoản một job tại một thời điểm
+        for job in self.queue.due():
+            if len(self.running) >= self.max_concurrency:
+                break
+            account = int(job["account"])
+            if account in busy:
+                continue
+            self.queue.mark_running(job["id"])
+            busy.add(account)
+            self._log(pad(f"Starting job #{job['id']} ({job['kind']}, account #{account}, "
+                          f"priority {job['priority']})", WIDTH, "left"), "blue")
+            task = asyncio.create_task(self._execute(job))
+            self.running[int(job["id"])] = (account, task)
+
+    async def run(self):
+        self.queue.recover()
+        try:
+            while not self._stopping:
+                self._sync_control_state()
+                self._start_due_jobs()
+                await asyncio.sleep(self.poll_interval)
+            # Dừng: đợi các job đang chạy kết thúc file hiện tại
+            tasks = [task for _account, task in self.running.values()]
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            for task in [task for _account, task in self.running.values()]:
+                task.cancel()
+            for downloader in self.downloaders.values():
+                downloader.events.close()
+                if downloader.client.is_connected():
+                    await downloader.client.disconnect()
+            self.downloaders.clear()
+
+
+# ============================ CONTROL API =============================
+
+class ApiError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+def _no_interactive_input(prompt: str, default: Optional[str] = None, hide_input: bool = False) -> str:
+    raise RuntimeError("Interactive input is not available through the control API; run 'login' first.")
+
+
+def _quiet_log(message: str, color_tag: Optional[str] = None):
+    """Log của downloader chạy sau API: tiến độ đã đi qua SSE (/events), không in ra console."""
+
+
+class ControlServer:
+    """
+    API HTTP/JSON cục bộ để điều khiển nhiều tài khoản từ một tiến trình sống lâu: kết nối một lần,
+    rồi quét/tải/upload, liệt kê dialog (có cache), quản lý job và nhận tiến độ qua SSE (GET /events).
+    Lắng nghe TCP (mặc định 127.0.0.1) hoặc Unix socket; tuỳ chọn yêu cầu "Authorization: Bearer <token>".
+    """
+
+    HTTP_REASONS = {200: "OK", 202: "Accepted", 400: "Bad Request", 401: "Unauthorized", 404: "Not Found",
+                    405: "Method Not Allowed", 409: "Conflict", 500: "Internal Server Error"}
+
+    def __init__(self, env_path: Path = Path(".env"), token: Optional[str] = None,
+                 job_queue: Optional[JobQueue] = None):
+        self.env_path = env_path
+        self.token = token
+        self.job_queue = job_queue or JobQueue()
+        self.downloaders: Dict[int, TelegramDownloader] = {}
+        self.dialog_cache: Dict[int, List[Dict[str, Any]]] = {}
+        self.tasks: Dict[int, Dict[str, Any]] = {}
+        self._task_handles: Dict[int, asyncio.Task] = {}
+        self._next_task_id = 1
+        self._subscribers: List[asyncio.Queue] = []
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._routes = [
+            ("GET", r"/health", self._health),
+            ("GET", r"/accounts", self._list_accounts),
+            ("POST", r"/accounts/(\d+)/connect", self._connect),
+            ("POST", r"/accounts/(\d+)/disconnect", self._disconnect),
+            ("GET", r"/accounts/(\d+)/status", self._account_status),
+            ("GET", r"/accounts/(\d+)/dialogs", self._dialogs),
+            ("POST", r"/accounts/(\d+)/scan", self._start_scan),
+            ("POST", r"/accounts/(\d+)/download", self._start_download),
+            ("POST", r"/accounts/(\d+)/upload", self._start_upload),
+            ("GET", r"/tasks", self._list_tasks),
+            ("GET", r"/tasks/(\d+)", self._get_task),
+            ("POST", r"/tasks/(\d+)/stop", self._stop_task),
+            ("POST", r"/tasks/(\d+)/prioritize", self._prioritize_task),
+            ("GET", r"/jobs", self._list_jobs),
+            ("POST", r"/jobs", self._add_job),
+            ("POST", r"/jobs/(\d+)/(pause|resume|cancel)", self._control_job),
+        ]
+
+    # -- server lifecycle --
+    async def start(self, host: str = "127.0.0.1", port: int = 8765, unix_path: Optional[str] = None):
+        if unix_path:
+            self._server = await asyncio.start_unix_server(self._handle, path=unix_path)
+        else:
+            self._server = await asyncio.start_server(self._handle, host, port)
+
+    async def close(self):
+        for handle in self._task_handles.values():
+            handle.cancel()
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        for idx in list(self.downloaders):
+            await self._drop_downloader(idx)
+        self.job_queue.close()
+
+    # -- events --
+    def broadcast(self, event: Dict[str, Any]):
+        for q in self._subscribers:
+            if q.full():  # client chậm: bỏ event cũ nhất thay vì chặn vòng tải
+                q.get_nowait()
+            q.put_nowait(event)
+
+    async def _serve_events(self, writer: asyncio.StreamWriter):
+        q: asyncio.Queue = asyncio.Queue(maxsize=1000)
+        self._subscribers.append(q)
+        try:
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n"
+                         b"Connection: keep-alive\r\n\r\n")
+            await writer.drain()
+            while True:
+                try:
+                    event = await asyncio.wait_for(q.get(), timeout=15)
+                    writer.write(f"event: {event.get('event', 'message')}\n"
+                                 f"data: {json.dumps(event, default=str)}\n\n".encode("utf-8"))
+                except asyncio.TimeoutError:
+                    writer.write(b": keep-alive\n\n")
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self._subscribers.remove(q)
+
+    # -- HTTP --
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            head = (await reader.readuntil(b"\r\n\r\n")).decode("latin-1").split("\r\n")
+            method, target = head[0].split(" ")[:2]
+            headers = {k.strip().lower(): v.strip() for k, _, v in (h.partition(":") for h in head[1:] if h)}
+            length = int(headers.get("content-length", 0) or 0)
+            raw_body = await reader.readexactly(length) if length else b""
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError, ConnectionError):
+            writer.close()
+            return
+
+        url = urlparse.urlsplit(target)
+        try:
+            if self.token and headers.get("authorization") != f"Bearer {self.token}":
+                raise ApiError(401, "Missing or invalid bearer token")
+            if url.path == "/events" and method == "GET":
+                await self._serve_events(writer)
+                return
+            if url.path == "/metrics" and method == "GET":
+                text = render_metrics([d.metrics for d in self.downloaders.values()])
+                self._respond(writer, 200, text.encode("utf-8"), "text/plain; version=0.0.4; charset=utf-8")
+            else:
+                try:
+                    body = json.loads(raw_body) if raw_body else {}
+                except json.JSONDecodeError:
+                    raise ApiError(400, "Body must be JSON")
+                query = {k: v[-1] for k, v in urlparse.parse_qs(url.query).items()}
+                status, payload = await self._dispatch(method, url.path, query, body)
+                self._respond(writer, status, json.dumps(payload, default=str).encode("utf-8"), "application/json")
+        except ApiError as e:
+            self._respond(writer, e.status, json.dumps({"error": str(e)}).encode("utf-8"), "application/json")
+        except Exception as e:
+            self._respond(writer, 500, json.dumps({"error": str(e)}).encode("utf-8"), "application/json")
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
+
+    def _respond(self, writer: asyncio.StreamWriter, status: int, body: bytes, ctype: str):
+        writer.write(f"HTTP/1.1 {status} {self.HTTP_REASONS.get(status, '')}\r\nContent-Type: {ctype}\r\n"
+                     f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body)
+
+    async def _dispatch(self, method: str, path: str, query: Dict[str, str], body: Dict[str, Any]):
+        path_matched = False
+        for route_method, pattern, handler in self._routes:
+            m = re.fullmatch(pattern, path.rstrip("/") or "/")
+            if not m:
+                continue
+            path_matched = True
+            if route_method == method:
+                return await handler(*m.groups(), query=query, body=body)
+        raise ApiError(405 if path_matched else 404, f"No route for {method} {path}")
+
+    # -- accounts --
+    def _account_cfg(self, idx: int) -> Dict[str, str]:
+        cfg = get_account_config(load_env(self.env_path), idx)
+        if not all([cfg["PHONE"], cfg["API_ID"], cfg["API_HASH"]]):
+            raise ApiError(404, f"Account #{idx} is not configured")
+        return cfg
+
+    async def _get_downloader(self, idx: int) -> TelegramDownloader:
+        downloader = self.downloaders.get(idx)
+        if downloader is not None and downloader.client.is_connected():
+            return downloader
+        cfg = self._account_cfg(idx)
+        if downloader is None:
+            downloader = TelegramDownloader(int(cfg["API_ID"]), cfg["API_HASH"], cfg["PHONE"], cfg["DOWNLOAD_DIR"],
+                                            idx, _quiet_log, _no_interactive_input,
+                                            storage=storage_from_config(cfg))
+            downloader.events.subscribe(self.broadcast)
+        await downloader.client.connect()
+        if not await downloader.client.is_user_authorized():
+            await downloader.client.disconnect()
+            raise ApiError(409, f"Account #{idx} is not logged in; run 'login' first")
+        self.downloaders[idx] = downloader
+        return downloader
+
+    async def _drop_downloader(self, idx: int):
+        downloader = self.downloaders.pop(idx, None)
+        if downloader is not None:
+            downloader.events.close()
+            if downloader.client.is_connected():
+                await downloader.client.disconnect()
+            downloader.scan_cache.close()
+            downloader.catalog.close()
+
+    async def _health(self, query, body):
+        return 200, {"ok": True, "accounts_connected": sorted(self.downloaders)}
+
+    async def _list_accounts(self, query, body):
+        envd = load_env(self.env_path)
+        idxs = sorted({int(k.split("_")[1]) for k in envd if re.fullmatch(r"ACCOUNT_\d+_PHONE", k)})
+        out = []
+        for idx in idxs:
+            cfg = get_account_config(envd, idx)
+            downloader = self.downloaders.get(idx)
+            out.append({"index": idx, "phone": cfg["PHONE"][:3] + "****" + cfg["PHONE"][-4:],
+                        "download_dir": cfg["DOWNLOAD_DIR"], "storage": cfg["STORAGE"],
+                        "connected": bool(downloader and downloader.client.is_connected()),
+                        "busy_task": self._busy_task(idx)})
+        return 200, {"current": get_current_account_index(envd), "accounts": out}
+
+    async def _connect(self, idx, query, body):
+        await self._get_downloader(int(idx))
+        return 200, {"connected": True}
+
+    async def _disconnect(self, idx, query, body):
+        if self._busy_task(int(idx)):
+            raise ApiError(409, "Account has a running task")
+        await self._drop_downloader(int(idx))
+        return 200, {"connected": False}
+
+    async def _account_status(self, idx, query, body):
+        idx = int(idx)
+        state = self.downloaders[idx].state if idx in self.downloaders else StateManager(idx)
+        return 200, {"state": state.state,
+                     "stats": self.downloaders[idx].stats if idx in self.downloaders else None,
+                     "busy_task": self._busy_task(idx)}
+
+    async def _dialogs(self, idx, query, body):
+        idx = int(idx)
+        if query.get("refresh") in ("1", "true") or idx not in self.dialog_cache:
+            downloader = await self._get_downloader(idx)
+            rows = await downloader.list_dialogs(print_to_cli=False)
+            self.dialog_cache[idx] = [{"id": r["id"], "title": r["title"], "username": r["username"],
+                                       "type": r["etype"]} for r in rows]
+        return 200, {"cached": query.get("refresh") not in ("1", "true"), "dialogs": self.dialog_cache[idx]}
+
+    # -- tasks --
+    def _busy_task(self, idx: int) -> Optional[int]:
+        for task in self.tasks.values():
+            if task["account"] == idx and task["status"] == "running":
+                return task["id"]
+        return None
+
+    async def _spawn(self, idx: int, kind: str, params: Dict[str, Any], runner: Callable[..., Any]):
+        """Một tài khoản chỉ chạy một tác vụ tại một thời điểm (stats/state dùng chung)."""
+        busy = self._busy_task(idx)
+        if busy:
+            raise ApiError(409, f"Account #{idx} is busy with task {busy}")
+        downloader = await self._get_downloader(idx)
+        task_id = self._next_task_id
+        self._next_task_id += 1
+        task = {"id": task_id, "account": idx, "kind": kind, "params": params, "status": "running",
+                "started": time.time(), "finished": None, "error": None, "result": None, "stop": False}
+        self.tasks[task_id] = task
+        stop_flag = lambda: task["stop"]
+
+        def progress(p, done, total, stats):
+            self.broadcast({"event": "progress", "task": task_id, "account": idx, "done": done, "total": total,
+                            "stats": stats, "t": time.monotonic(), "ts": time.time()})
+
+        async def run():
+            self.broadcast({"event": "task_start", "task": task_id, "account": idx, "kind": kind})
+            try:
+                task["result"] = await runner(downloader, stop_flag, progress)
+                task["status"] = "stopped" if task["stop"] else "done"
+            except asyncio.CancelledError:
+                task["status"] = "stopped"
+                raise
+            except Exception as e:
+                task["status"], task["error"] = "failed", str(e)
+            finally:
+                task["finished"] = time.time()
+                self._task_handles.pop(task_id, None)
+                self.broadcast({"event": "task_finish", "task": task_id, "account": idx, "kind": kind,
+                                "status": task["status"], "error": task["error"]})
+
+        self._task_handles[task_id] = asyncio.create_task(run())
+        return 202, {"task": self._public_task(task)}
+
+    @staticmethod
+    def _public_task(task: Dict[str, Any]) -> Dict[str, Any]:
+        return {k: v for k, v in task.items() if k != "stop"}
+
+    async def _start_scan(self, idx, query, body):
+        source, dialogs = body.get("source", "all"), body.get("dialogs")
+
+        async def runner(downloader, stop_flag, progress):
+            targets = await downloader._resolve_watch_targets(source, dialogs)
+            found = await downloader.scan_media_in_dialogs(targets)
+            return {"media": len(found), "photos": sum(1 for m in found if m["type"] == "photo"),
+                    "videos": sum(1 for m in found if m["type"] == "video"),
+                    "estimated_size": sum(downloader._media_size(m["message"]) for m in found)}
+        return await self._spawn(int(idx), "scan", body, runner)
+
+    async def _start_download(self, idx, query, body):
+        try:
+            window = scan_window_from_params(body)
+        except argparse.ArgumentTypeError as e:
+            raise ApiError(400, str(e))
+
+        async def runner(downloader, stop_flag, progress):
+            downloader.use_scan_cache = not body.get("rescan", False)
+            downloader.stream_pipeline = bool(body.get("stream", False))
+            downloader.download_order = body.get("order", "scan")
+            downloader.scan_shards = int(body.get("scan_shards", SCAN_SHARDS))
+            downloader.set_scan_window(**window)
+            return await downloader.run_download_job(body.get("source", "all"), body.get("dialogs"),
+                                                     str(body.get("filter", "3")), stop_flag=stop_flag,
+                                                     progress_callback=progress)
+        return await self._spawn(int(idx), "download", body, runner)
+
+    async def _start_upload(self, idx, query, body):
+        if not body.get("path") or not body.get("to"):
+            raise ApiError(400, "'path' and 'to' are required")
+        path = Path(body["path"])
+
+        async def runner(downloader, stop_flag, progress):
+            if path.is_dir():
+                await downloader.upload_folder_media(body["to"], path, body.get("caption"), stop_flag=stop_flag)
+            else:
+                sent = await downloader.upload_media(body["to"], path, body.get("caption"))  # "to": chuỗi hoặc danh sách
+                for outcome in (sent if isinstance(sent, list) else []):
+                    if isinstance(outcome, BaseException):
+                        raise outcome
+            return {"uploaded": str(path)}
+        return await self._spawn(int(idx), "upload", body, runner)
+
+    async def _list_tasks(self, query, body):
+        return 200, {"tasks": [self._public_task(t) for t in self.tasks.values()]}
+
+    async def _get_task(self, task_id, query, body):
+        task = self.tasks.get(int(task_id))
+        if task is None:
+            raise ApiError(404, f"No task {task_id}")
+        return 200, {"task": self._public_task(task)}
+
+    async def _stop_task(self, task_id, query, body):
+        task = self.tasks.get(int(task_id))
+        if task is None:
+            raise ApiError(404, f"No task {task_id}")
+        task["stop"] = True  # dừng sau file hiện tại
+        if task["kind"] == "scan" and int(task_id) in self._task_handles:
+            self._task_handles[int(task_id)].cancel()
+        return 202, {"task": self._public_task(task)}
+
+    async def _prioritize_task(self, task_id, query, body):
+        task = self.tasks.get(int(task_id))
+        if task is None or task["status"] != "running" or task["kind"] != "download":
+            raise ApiError(409, f"Task {task_id} is not a running download")
+        ids = body.get("message_ids") or []
+        self.downloaders[task["account"]].promote(ids)
+        return 202, {"promoted": len(ids)}
+
+    # -- jobs (hàng đợi bền vững, chạy bởi 'jobs run') --
+    async def _list_jobs(self, query, body):
+        statuses = query.get("status", "").split(",") if query.get("status") else None
+        return 200, {"jobs": [self._job_dict(row) for row in self.job_queue.list(statuses)]}
+
+    async def _add_job(self, query, body):
+        try:
+            job_id = self.job_queue.add(body.get("kind", "download"), int(body["account"]), body.get("params", {}),
+                                        priority=int(body.get("priority", 0)), schedule=body.get("cron"))
+        except (KeyError, ValueError) as e:
+            raise ApiError(400, f"Invalid job: {e}")
+        return 200, {"job": self._job_dict(self.job_queue.get(job_id))}
+
+    async def _control_job(self, job_id, action, query, body):
+        ok = getattr(self.job_queue, action)(int(job_id))
+        return (200 if ok else 409), {"ok": ok, "job": self._job_dict(self.job_queue.get(int(job_id)))}
+
+    @staticmethod
+    def _job_dict(row: Optional[sqlite3.Row]) -> Optional[Dict[str, Any]]:
+        if row is None:
+            return None
+        job = dict(row)
+        for key in ("params", "result"):
+            if job.get(key):
+                job[key] = json.loads(job[key])
+        return job
+
+
+# ============================ CLI-SPECIFIC FUNCTIONS AND MAIN ENTRY =============================
+
+# CLI progress callback for download and upload
+def cli_progress_callback(
+        progress: float,
+        current: int,
+        # For download: current_files_processed; for upload: current_bytes_of_file (for single file) or current_file_index (for folder upload)
+        total: int,
+        # For download: total_files_to_process; for upload: total_bytes_of_file (for single file) or total_files (for folder upload)
+        stats: Optional[Dict[str, Any]] = None,  # Present for download, None for single file upload
+        current_file_bytes: Optional[int] = None,  # For folder upload, current bytes of current file
+        total_file_bytes: Optional[int] = None  # For folder upload, total bytes of current file
+):
+    bar_length = 50
+    filled_length = int(bar_length * progress)
+    bar = '#' * filled_length + '-' * (bar_length - filled_length)
+    percent = f"{progress * 100:.1f}"
+
+    if stats:  # It's a download progress callback (from download_all_media)
+        downloaded_size = stats.get('total_size', 0)
+        sys.stdout.write(
+            f'\rDownload: |{bar}| {percent}% ({current}/{total} files, {humanize.naturalsize(downloaded_size)} total)')
+    elif current_file_bytes is not None and total_file_bytes is not None:  # It's a folder upload progress callback
+        # 'progress' here is overall_progress for folder, 'current' is current_file_index, 'total' is total_files
+        sys.stdout.write(
+            f'\rFolder Upload: [{current}/{total}] |{bar}| {percent}% (File: {humanize.naturalsize(current_file_bytes)}/{humanize.naturalsize(total_file_bytes)})')
+    else:  # It's a single file upload progress callback (current=current_bytes, total=total_bytes)
+        sys.stdout.write(
+            f'\rSingle Upload: |{bar}| {percent}% ({humanize.naturalsize(current)}/{humanize.naturalsize(total)})')
+
+    sys.stdout.flush()
+    if progress >= 1.0:
+        sys.stdout.write('\n')
+
+
+# Dummy callback for scan progress in CLI, as total messages isn't known
+def cli_scan_progress_callback(current_messages_scanned: int, total_messages: Optional[int]):
+    sys.stdout.write(
+        f'\rScanning... Scanned {current_messages_scanned} messages. Found {current_messages_scanned if total_messages is None else current_messages_scanned} media items.')  # Total media is from downloader.stats, not passed directly
+    sys.stdout.flush()
+
+
+def storage_from_config(cfg: Dict[str, str]) -> StorageBackend:
+    """Dựng backend lưu trữ từ cấu hình tài khoản (ACCOUNT_n_STORAGE, ACCOUNT_n_S3_*)."""
+    return make_storage(cfg.get("STORAGE"), cfg["DOWNLOAD_DIR"], bucket=cfg.get("S3_BUCKET"),
+                        prefix=cfg.get("S3_PREFIX"), endpoint_url=cfg.get("S3_ENDPOINT"))
+
+
+async def initialize_downloader(envd: Dict[str, str], account_index: int,
+                                storage_overrides: Optional[Dict[str, str]] = None) -> Optional[TelegramDownloader]:
+    """Helper to initialize and connect the downloader for CLI commands."""
+    cfg = get_account_config(envd, account_index)
+    cfg.update({k: v for k, v in (storage_overrides or {}).items() if v})
+
+    if not all([cfg["PHONE"], cfg["API_ID"], cfg["API_HASH"]]):
+        console_log_func(
+            pad(f"Account configuration for index {account_index} is incomplete. Please ensure PHONE, API_ID, API_HASH are set.",
+                WIDTH, "left"), "red")
+        return None
+
+    try:
+        api_id_int = int(cfg["API_ID"])
+    except ValueError:
+        console_log_func(
+            pad(f"Invalid API_ID '{cfg['API_ID']}' for account #{account_index}. Must be a number.", WIDTH, "left"),
+            "red")
+        return None
+
+    try:
+        storage = storage_from_config(cfg)
+    except (ValueError, RuntimeError) as e:
+        console_log_func(pad(f"Storage backend error: {e}", WIDTH, "left"), "red")
+        return None
+
+    downloader = TelegramDownloader(
+        api_id=api_id_int,
+        api_hash=cfg["API_HASH"],
+        phone=cfg["PHONE"],
+        download_dir=cfg["DOWNLOAD_DIR"],
+        account_index=account_index,
+        log_func=console_log_func,
+        input_func=console_input_func,
+        storage=storage
+    )
+
+    if not await downloader.connect_client():
+        return None
+    return downloader
+
+
+async def run_cli_login(args):
+    env_path = Path(".env")
+    envd = load_env(env_path)
+
+    _envd, _idx = await do_login_flow(envd, console_log_func, console_input_func,
+                                      phone=args.phone, api_id=args.api_id,
+                                      api_hash=args.api_hash, download_dir=args.download_dir,
+                                      account_idx_to_use=None)  # Pass None to allow interactive pick/new logic
+    save_env(env_path, _envd)
+    if _idx > 0:
+        console_log_func(pad(f"Login command finished. Active account set to #{_idx}.", WIDTH, "left"), "green")
+    else:
+        console_log_func(pad("Login command failed.", WIDTH, "left"), "red")
+
+
+async def run_cli_logout(args):
+    env_path = Path(".env")
+    envd = load_env(env_path)
+
+    _envd = await do_logout_flow(envd, console_log_func, args.account_index)
+    save_env(env_path, _envd)
+    console_log_func(pad("Logout command finished.", WIDTH, "left"), "green")
+
+
+async def run_cli_reset(args):
+    env_path = Path(".env")
+    envd = load_env(env_path)
+
+    confirm_reset = console_input_func("Are you sure you want to reset all config and delete session files? (yes/no)",
+                                       hide_input=False).lower() == 'yes'
+    _envd = await do_reset_flow(envd, console_log_func, confirm=confirm_reset)
+    save_env(env_path, _envd)
+    console_log_func(pad("Reset command finished.", WIDTH, "left"), "green")
+
+
+async def start_metrics_server(downloader: TelegramDownloader, args) -> Optional[MetricsServer]:
+    """Mở endpoint /metrics nếu có --metrics-port; lỗi bind chỉ cảnh báo, không dừng job."""
+    if not getattr(args, "metrics_port", None):
+        return None
+    server = MetricsServer(downloader.metrics.render, args.metrics_host, args.metrics_port)
+    try:
+        await server.start()
+    except OSError as e:
+        console_log_func(pad(f"Metrics endpoint disabled: {e}", WIDTH, "left"), "yellow")
+        return None
+    console_log_func(pad(f"Metrics: http://{args.metrics_host}:{args.metrics_port}/metrics", WIDTH, "left"), "cyan")
+    return server
+
+
+def start_cli_profiler(downloader: TelegramDownloader, args):
+    if getattr(args, "profile", False) or getattr(args, "profile_sample_ms", 0):
+        downloader.profiler = RunProfiler(sample_interval=(args.profile_sample_ms or 0) / 1000.0)
+        downloader.profiler.start()
+
+
+def finish_cli_profiler(downloader: TelegramDownloader, args):
+    """Dừng profiler, in bảng phân tích và ghi file folded stacks."""
+    profiler = downloader.profiler
+    if profiler is None:
+        return
+    profiler.stop()
+    downloader.profiler = None
+    lines = ["PROFILE", ""] + [pad(s, WIDTH - 2) for s in profiler.report_lines()]
+    console_log_func(c(box(lines), Fore.CYAN))
+    out = profiler.write_folded(args.profile_output or f"profile_{args.command}_{int(time.time())}.folded")
+    console_log_func(pad(f"Flamegraph input (folded stacks): {out}", WIDTH, "left"), "cyan")
+
+
+async def run_cli_upload(args):
+    env_path = Path(".env")
+    envd = load_env(env_path)
+    current_account_idx = get_current_account_index(envd)
+
+    if current_account_idx == 0:
+        console_log_func(pad("No active account found. Please login first using 'cli_app.py login'.", WIDTH, "left"),
+                         "red")
+        return
+
+    downloader = await initialize_downloader(envd, current_account_idx)
+    if not downloader:
+        return
+    metrics_server = await start_metrics_server(downloader, args)
+    if args.events_file:
+        downloader.events.open_file(args.events_file)
+    start_cli_profiler(downloader, args)
+
+    try:
+        file_or_folder_path = Path(args.path)
+        # Một đích giữ nguyên kiểu cũ; nhiều đích -> upload một lần rồi gửi tới tất cả
+        destination = args.to[0] if len(args.to) == 1 else list(args.to)
+        caption = args.caption
+
+        if file_or_folder_path.is_file():
+            console_log_func(
+                pad(f"Starting upload of '{file_or_folder_path.name}' to '{', '.join(args.to)}'...", WIDTH, "left"),
+                "blue")
+            results = await downloader.upload_media(
+                peer=destination,
+                file_path=file_or_folder_path,
+                caption=caption,
+                progress_callback=lambda p, c_bytes, t_bytes: cli_progress_callback(p, c_bytes, t_bytes)
+            )
+            failed = [(to, r) for to, r in zip(args.to, results if isinstance(results, list) else [results])
+                      if isinstance(r, BaseException)]
+            for to, error in failed:
+                console_log_func(pad(f"Failed to send to '{to}': {error}", WIDTH, "left"), "red")
+            if not failed:
+                console_log_func(pad(f"Upload completed successfully for '{file_or_folder_path.name}'.", WIDTH,
+                                     "left"), "green")
+        elif file_or_folder_path.is_dir():
+            console_log_func(
+                pad(f"Starting batch upload from folder '{file_or_folder_path.name}' to '{', '.join(args.to)}'...",
+                    WIDTH, "left"), "blue")
+            await downloader.upload_folder_media(
+                peer=destination,
+                folder_path=file_or_folder_path,
+                caption=caption,
+                progress_callback=lambda overall_p, f_idx, total_f, c_bytes, t_bytes: cli_progress_callback(overall_p,
+                                                                                                            f_idx,
+                                                                                                            total_f,
+                                                                                                            None,
+                                                                                                            c_bytes,
+                                                                                                            t_bytes)
+            )
+            console_log_func(pad(f"Batch upload from '{file_or_folder_path.name}' completed.", WIDTH, "left"), "green")
+        else:
+            console_log_func(
+                pad(f"Error: Path '{file_or_folder_path}' is neither a file nor a directory.", WIDTH, "left"), "red")
+
+
+    except Exception as e:
+        console_log_func(pad(f"Error during upload: {e}", WIDTH, "left"), "red")
+    finally:
+        if metrics_server:
+            await metrics_server.stop()
+        downloader.events.close()
+        finish_cli_profiler(downloader, args)
+        if downloader and downloader.client.is_connected():
+            await downloader.client.disconnect()
+
+
+async def run_cli_download(args):
+    env_path = Path(".env")
+    envd = load_env(env_path)
+    current_account_idx = get_current_account_index(envd)
+
+    if current_account_idx == 0:
+        console_log_func(pad("No active account found. Please login first using 'cli_app.py login'.", WIDTH, "left"),
+                         "red")
+        return
+
+    downloader = await initialize_downloader(envd, current_account_idx, storage_overrides={
+        "STORAGE": args.storage, "S3_BUCKET": args.s3_bucket,
+        "S3_PREFIX": args.s3_prefix, "S3_ENDPOINT": args.s3_endpoint,
+    })
+    if not downloader:
+        return
+    console_log_func(pad(f"Storage: {downloader.storage.describe()}", WIDTH, "left"), "cyan")
+    metrics_server = await start_metrics_server(downloader, args)
+    if args.events_file:
+        downloader.events.open_file(args.events_file)
+    start_cli_profiler(downloader, args)
+
+    try:
+        source_type = args.source
+        filter_type = args.filter
+        dialog_selection = args.dialogs
+        downloader.use_scan_cache = not args.rescan
+        downloader.stream_pipeline = args.stream
+        downloader.download_order = args.order
+        downloader.scan_shards = args.scan_shards
+        downloader.set_scan_window(args.since, args.until, args.min_size, args.max_size)
+
+        # The _run_with_source method now handles the full scan/filter/download flow including state management
+        # It takes callbacks for progress and confirmation.
+        await downloader._run_with_source(
+            src_type=source_type,
+            chosen_entities=dialog_selection,
+            # For CLI, dialog_selection directly passed. _run_with_source will resolve to entities internally.
+            confirm_callback=lambda t, m: console_input_func(m + " (yes/no)", "no", False).lower() == 'yes',
+            progress_callback_scan=cli_scan_progress_callback,
+            progress_callback_download=cli_progress_callback
+        )
+
+        console_log_func(pad("Download command finished.", WIDTH, "left"), "green")
+
+    except Exception as e:
+        console_log_func(pad(f"Error during download: {e}", WIDTH, "left"), "red")
+    finally:
+        if metrics_server:
+            await metrics_server.stop()
+        downloader.events.close()
+        finish_cli_profiler(downloader, args)
+        if downloader and downloader.client.is_connected():
+            await downloader.client.disconnect()
+
+
+async def run_cli_watch(args):
+    env_path = Path(".env")
+    envd = load_env(env_path)
+    current_account_idx = get_current_account_index(envd)
+
+    if current_account_idx == 0:
+        console_log_func(pad("No active account found. Please login first using 'cli_app.py login'.", WIDTH, "left"),
+                         "red")
+        return
+    if args.source == "dialogs" and not args.dialogs:
+        console_log_func(pad("--source dialogs requires --dialogs.", WIDTH, "left"), "red")
+        return
+
+    downloader = await initialize_downloader(envd, current_account_idx, storage_overrides={
+        "STORAGE": args.storage, "S3_BUCKET": args.s3_bucket,
+        "S3_PREFIX": args.s3_prefix, "S3_ENDPOINT": args.s3_endpoint,
+    })
+    if not downloader:
+        return
+    metrics_server = await start_metrics_server(downloader, args)
+    if args.events_file:
+        downloader.events.open_file(args.events_file)
+
+    # SIGTERM (systemd, docker stop) -> dừng êm như Ctrl+C
+    stopping = False
+
+    def request_stop():
+        nonlocal stopping
+        stopping = True
+
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, request_stop)
+    except (NotImplementedError, RuntimeError):
+        pass  # Windows
+
+    try:
+        downloader.stream_pipeline = args.stream
+        await downloader.watch(args.source, args.dialogs, filter_choice=args.filter, stop_flag=lambda: stopping,
+                               check_interval=args.check_interval, catch_up_interval=args.catch_up_interval)
+    except Exception as e:
+        console_log_func(pad(f"Error during watch: {e}", WIDTH, "left"), "red")
+    finally:
+        if metrics_server:
+            await metrics_server.stop()
+        downloader.events.close()
+        if downloader.client.is_connected():
+            await downloader.client.disconnect()
+
+
+async def run_cli_mirror(args):
+    envd = load_env(Path(".env"))
+    current_account_idx = get_current_account_index(envd)
+    if current_account_idx == 0:
+        console_log_func(pad("No active account found. Please login first using 'cli_app.py login'.", WIDTH, "left"),
+                         "red")
+        return
+    if args.source == "dialogs" and not args.dialogs:
+        console_log_func(pad("--source dialogs requires --dialogs.", WIDTH, "left"), "red")
+        return
+
+    downloader = await initialize_downloader(envd, current_account_idx)
+    if not downloader:
+        return
+    metrics_server = await start_metrics_server(downloader, args)
+    if args.events_file:
+        downloader.events.open_file(args.events_file)
+
+    try:
+        downloader.use_scan_cache = not args.rescan
+        downloader.set_scan_window(args.since, args.until, args.min_size, args.max_size)
+        destination = int(args.to) if re.fullmatch(r"-?\d+", args.to) else args.to
+        result = await downloader.run_mirror(args.source, args.dialogs, destination, filter_choice=args.filter,
+                                             drop_author=not args.keep_author)
+        console_log_func(pad(f"Mirror finished: {result['mirrored']} sent, {result['skipped']} already there, "
+                             f"{result['failed']} failed.", WIDTH, "left"),
+                         "green" if not result["failed"] else "yellow")
+    except Exception as e:
+        console_log_func(pad(f"Error during mirror: {e}", WIDTH, "left"), "red")
+    finally:
+        if metrics_server:
+            await metrics_server.stop()
+        downloader.events.close()
+        if downloader.client.is_connected():
+            await downloader.client.disconnect()
+
+
+async def run_cli_jobs(args):
+    queue = JobQueue()
+    try:
+        action = args.jobs_command
+        if action in ("add-download", "add-upload"):
+            envd = load_env(Path(".env"))
+            account = args.account_index or get_current_account_index(envd)
+            if account == 0:
+                console_log_func(pad("No account given and no active account.", WIDTH, "left"), "red")
+                return
+            if action == "add-download":
+                kind = "download"
+                params = {"source": args.source, "dialogs": args.dialogs, "filter": args.filter,
+                          "rescan": args.rescan, "stream": args.stream, "order": args.order,
+                          "scan_shards": args.scan_shards,
+                          "since": args.since.isoformat() if args.since else None,
+                          "until": args.until.isoformat() if args.until else None,
+                          "min_size": args.min_size, "max_size": args.max_size}
+            else:
+                kind = "upload"
+                params = {"path": str(Path(args.path).resolve()), "to": args.to, "caption": args.caption}
+            try:
+                job_id = queue.add(kind, account, params, priority=args.priority, schedule=args.cron)
+            except ValueError as e:
+                console_log_func(pad(str(e), WIDTH, "left"), "red")
+                return
+            console_log_func(pad(f"Job #{job_id} queued ({kind}, account #{account}).", WIDTH, "left"), "green")
+        elif action in ("pause", "resume", "cancel"):
+            ok = getattr(queue, action)(args.job_id)
+            console_log_func(pad(f"Job #{args.job_id}: {action} {'ok' if ok else 'not applicable'}.", WIDTH, "left"),
+                             "green" if ok else "yellow")
+        elif action == "run":
+            async def factory(account: int) -> Optional[TelegramDownloader]:
+                return await initialize_downloader(load_env(Path(".env")), account)
+
+            scheduler = JobScheduler(queue, factory, max_concurrency=args.max_concurrency,
+                                     poll_interval=args.poll_interval)
+            try:
+                asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, scheduler.stop)
+            except (NotImplementedError, RuntimeError):
+                pass
+            console_log_func(pad(f"Scheduler running (max {scheduler.max_concurrency} jobs, one per account). "
+                                 f"Ctrl+C to stop.", WIDTH, "left"), "green")
+            await scheduler.run()
+        else:
+            rows = queue.list(getattr(args, "status", None))
+            if not rows:
+                console_log_func(pad("No jobs.", WIDTH, "left"), "yellow")
+                return
+            print(f"{'ID':>4}  {'KIND':<8}  {'ACC':>3}  {'PRI':>3}  {'STATUS':<9}  {'NEXT RUN':<16}  {'RUNS':>4}  SCHEDULE")
+            for job in rows:
+                next_run = datetime.fromtimestamp(job["next_run"]).strftime("%Y-%m-%d %H:%M") \
+                    if job["status"] == "queued" else "-"
+                print(f"{job['id']:>4}  {job['kind']:<8}  {job['account']:>3}  {job['priority']:>3}  "
+                      f"{job['status']:<9}  {next_run:<16}  {job['runs']:>4}  {job['schedule'] or '-'}"
+                      + (f"  ! {job['last_error']}" if job['last_error'] else ""))
+    finally:
+        queue.close()
+
+
+async def run_cli_serve(args):
+    server = ControlServer(token=args.token or os.environ.get("TELE_API_TOKEN") or None)
+    await server.start(args.host, args.port, unix_path=args.unix)
+    where = args.unix if args.unix else f"http://{args.host}:{args.port}"
+    console_log_func(pad(f"Control API listening on {where} (Ctrl+C to stop).", WIDTH, "left"), "green")
+    stopped = asyncio.Event()
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stopped.set)
+    except (NotImplementedError, RuntimeError):
+        pass
+    try:
+        await stopped.wait()
+    finally:
+        await server.close()
+
+
+async def run_cli_query(args):
+    env_path = Path(".env")
+    envd = load_env(env_path)
+    account_idx = args.account_index if args.account_index is not None else get_current_account_index(envd)
+    if account_idx == 0:
+        console_log_func(pad("No active account found. Please login first using 'cli_app.py login'.", WIDTH, "left"),
+                         "red")
+        return
+
+    cfg = get_account_config(envd, account_idx)
+    catalog = MediaCatalog(Path(cfg["DOWNLOAD_DIR"]))
+    if not catalog.db_file.exists():
+        console_log_func(pad(f"No catalog found at '{catalog.db_file}'. Download something first.", WIDTH, "left"),
+                         "yellow")
+        return
+
+    since, until = args.since, args.until
+    if args.year:
+        since = datetime(args.year, 1, 1, tzinfo=timezone.utc)
+        until = datetime(args.year + 1, 1, 1, tzinfo=timezone.utc)
+
+    start = time.perf_counter()
+    count = 0
+    total_size = 0
+    try:
+        for row in catalog.query(dialog=args.dialog, media_type=args.type, since=since, until=until,
+                                 min_size=args.min_size, max_size=args.max_size, limit=args.limit,
+                                 order=args.order):
+            count += 1
+            total_size += row["size"] or 0
+            if args.paths_only:
+                print(row["path"])
+                continue
+            day = datetime.fromtimestamp(row["date"], tz=timezone.utc).strftime("%Y-%m-%d")
+            title = row["dialog_title"] or str(row["dialog_id"])
+            print(f"{day}  {row['type']:<5}  {humanize.naturalsize(row['size'] or 0):>10}  {title[:24]:<24}  {row['path']}")
+    finally:
+        catalog.close()
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    if not args.paths_only:
+        console_log_func(line("-"))
+        console_log_func(pad(f"{count} file(s), {humanize.naturalsize(total_size)} total ({elapsed_ms:.1f} ms)",
+                             WIDTH, "left"), "blue")
+
+
+def _state_dialog_id(chat_id: int) -> int:
+    """chat_id có dấu của Telethon (cột dialog_id trong catalog) -> ID thô StateManager dùng làm khoá."""
+    if chat_id <= -1000000000000:
+        return -chat_id - 1000000000000
+    return abs(chat_id)
+
+
+def run_cli_verify(args):
+    """Kiểm tra kho đã tải với catalog; không cần client nên chạy đồng bộ."""
+    envd = load_env(Path(".env"))
+    account_idx = args.account_index if args.account_index is not None else get_current_account_index(envd)
+    if account_idx == 0:
+        console_log_func(pad("No active account found. Please login first using 'cli_app.py login'.", WIDTH, "left"),
+                         "red")
+        return
+
+    cfg = get_account_config(envd, account_idx)
+    catalog = MediaCatalog(Path(cfg["DOWNLOAD_DIR"]))
+    if not catalog.db_file.exists():
+        console_log_func(pad(f"No catalog found at '{catalog.db_file}'. Download something first.", WIDTH, "left"),
+                         "yellow")
+        return
+
+    state = StateManager(account_idx) if args.requeue else None
+    counts = {"ok": 0, "missing": 0, "corrupt": 0, "remote": 0}
+    checked_bytes = 0
+    requeued = 0
+    start = time.perf_counter()
+    try:
+        for status, row, detail in verify_catalog(catalog, workers=args.workers, check_hash=not args.size_only,
+                                                  dialog=args.dialog, since=args.since, until=args.until):
+            counts[status] += 1
+            if status == "ok":
+                checked_bytes += row["size"] or 0
+                continue
+            if status == "remote":
+                continue
+            console_log_func(pad(f"{status.upper():<8} {row['path']}" + (f"  ({detail})" if detail else ""),
+                                 WIDTH, "left"), "red" if status == "corrupt" else "yellow")
+            if state is not None:
+                # Xoá file hỏng (file sai nội dung nhưng đúng kích thước sẽ không bị resume tải lại) rồi bỏ đánh dấu
+                if status == "corrupt":
+                    try:
+                        os.remove(row["path"])
+                    except OSError:
+                        pass
+                mid = int(row["message_id"])
+                requeued += state.forget_completed(_state_dialog_id(int(row["dialog_id"])), mid, mid, save=False)
+    finally:
+        catalog.close()
+        if state is not None and requeued:
+            state.save()
+    elapsed = time.perf_counter() - start
+
+    console_log_func(line("-"))
+    summary = (f"{counts['ok']} ok, {counts['missing']} missing, {counts['corrupt']} corrupt"
+               + (f", {counts['remote']} remote (not checked)" if counts['remote'] else "")
+               + f" - {humanize.naturalsize(checked_bytes)} in {elapsed:.1f}s"
+               + (f" ({humanize.naturalsize(checked_bytes / elapsed)}/s)" if elapsed > 0 else ""))
+    console_log_func(pad(summary, WIDTH, "left"), "green" if not counts["missing"] + counts["corrupt"] else "yellow")
+    if args.requeue and counts["missing"] + counts["corrupt"]:
+        console_log_func(pad(f"{requeued} item(s) unmarked; the next 'download' of the same source fetches them again.",
+                             WIDTH, "left"), "blue")
+
+
+def add_profile_arguments(subparser: argparse.ArgumentParser):
+    subparser.add_argument("--profile", action="store_true",
+                           help="Profile the run: per-phase wall/CPU time and asyncio task timings.")
+    subparser.add_argument("--profile-sample-ms", type=float, default=0,
+                           help="Also sample all thread stacks every N ms (implies --profile).")
+    subparser.add_argument("--profile-output", help="Folded-stack output file for flamegraph tools "
+                                                    "(default: profile_<command>_<time>.folded).")
+
+
+def add_metrics_arguments(subparser: argparse.ArgumentParser):
+    subparser.add_argument("--events-file", help="Append a JSON-lines event log (one event per file/page) to this file.")
+    subparser.add_argument("--metrics-port", type=int, default=None,
+                           help="Serve Prometheus metrics on this port while the job runs (e.g. 9464).")
+    subparser.add_argument("--metrics-host", default="127.0.0.1", help="Bind address for --metrics-port.")
+
+
+def add_scan_window_arguments(subparser: argparse.ArgumentParser):
+    subparser.add_argument("--since", type=parse_date,
+                           help="Only media posted on/after this date (YYYY-MM-DD); older history is not walked.")
+    subparser.add_argument("--until", type=parse_date,
+                           help="Only media posted before this date (YYYY-MM-DD); scanning starts there.")
+    subparser.add_argument("--min-size", type=parse_size, help="Skip media smaller than this (e.g. 500K).")
+    subparser.add_argument("--max-size", type=parse_size, help="Skip media larger than this (e.g. 2GB).")
+
+
+def build_cli_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="Telegram Media Downloader and Uploader CLI",
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+
+    subparsers = parser.add_subparsers(dest="command", help="Available commands")
+
+    # --- Login/Auth Command ---
+    login_parser = subparsers.add_parser("login", help="Log in to a Telegram account or manage accounts.")
+    login_parser.add_argument("--phone", help="Phone number for login (e.g., +84123456789)")
+    login_parser.add_argument("--api-id", type=int, help="Telegram API ID")
+    login_parser.add_argument("--api-hash", help="Telegram API Hash")
+    login_parser.add_argument("--download-dir", default="downloads",
+                              help="Default download directory for this account.")
+
+    # --- Logout Command ---
+    logout_parser = subparsers.add_parser("logout", help="Logout the current active account or a specific one.")
+    logout_parser.add_argument("--account-index", type=int, default=None,
+                               help="Optional: Logout a specific account index instead of the current active one.")
+
+    # --- Reset Command ---
+    reset_parser = subparsers.add_parser("reset", help="Reset all configurations and delete session files.")
+
+    # --- Upload Command ---
+    upload_parser = subparsers.add_parser("upload", help="Upload a file or all media from a folder to Telegram.")
+    upload_parser.add_argument("-p", "--path", required=True,
+                               help="Path to the file or folder to upload.")  # Changed from --file
+    upload_parser.add_argument("-t", "--to", required=True, nargs="+",
+                               help="One or more destinations (chat ID, @username, or phone number). Each file is "
+                                    "uploaded once and sent to all of them.")
+    upload_parser.add_argument("-c", "--caption", default="", help="Optional caption for the file(s).")
+    add_metrics_arguments(upload_parser)
+    add_profile_arguments(upload_parser)
+
+    # --- Download Command ---
+    download_parser = subparsers.add_parser("download", help="Download media from Telegram.")
+    download_parser.add_argument("-s", "--source", choices=["saved", "dialogs", "all", "continue"], default="all",
+                                 help=(
+                                     "Source to download from:\n"
+                                     "  - saved: Your 'Saved Messages'\n"
+                                     "  - dialogs: Specific chats/channels (requires --dialogs)\n"
+                                     "  - all: All chats/channels you are part of\n"
+                                     "  - continue: Continue last download session"
+                                 ))
+    download_parser.add_argument("--dialogs", nargs='*', help="List of dialog IDs or @usernames to download from "
+                                                              "(required for --source dialogs, e.g., --dialogs 12345 @mychannel)")
+    download_parser.add_argument("-F", "--filter", choices=["1", "2", "3"], default="3",
+                                 help=(
+                                     "Media type filter:\n"
+                                     "  - 1: Photos only\n"
+                                     "  - 2: Videos only\n"
+                                     "  - 3: Both photos and videos (default)"
+                                 ))
+    download_parser.add_argument("--rescan", action="store_true",
+                                 help="Ignore the local scan cache and walk the full message history again.")
+    download_parser.add_argument("--stream", action="store_true",
+                                 help="Stream each file through the chunk pipeline (SHA-256 into the catalog, "
+                                      "size check, format sniffing) while it is being written.")
+    download_parser.add_argument("--order", choices=DOWNLOAD_ORDERS, default="scan",
+                                 help="Queue order: scan (default), smallest, largest, newest, oldest, "
+                                      "or fair (round-robin between dialogs).")
+    download_parser.add_argument("--scan-shards", type=int, default=SCAN_SHARDS,
+                                 help=f"Parallel message-ID ranges per large dialog while scanning "
+                                      f"(default: {SCAN_SHARDS}; 1 = one sequential cursor).")
+    add_scan_window_arguments(download_parser)
+    download_parser.add_argument("--storage", choices=STORAGE_CHOICES,
+                                 help="Storage backend (default: ACCOUNT_n_STORAGE from .env, else 'local').")
+    download_parser.add_argument("--s3-bucket", help="Bucket for --storage s3.")
+    download_parser.add_argument("--s3-prefix", help="Key prefix inside the bucket for --storage s3.")
+    download_parser.add_argument("--s3-endpoint", help="Custom S3 endpoint URL (e.g. MinIO: http://localhost:9000).")
+    add_metrics_arguments(download_parser)
+    add_profile_arguments(download_parser)
+
+    # --- Watch Command ---
+    watch_parser = subparsers.add_parser("watch", help="Stay connected and download new media as it arrives.")
+    watch_parser.add_argument("-s", "--source", choices=["saved", "dialogs", "all"], default="all",
+                              help="Dialogs to watch (same meaning as for download).")
+    watch_parser.add_argument("--dialogs", nargs='*', help="Dialog IDs or @usernames for --source dialogs.")
+    watch_parser.add_argument("-F", "--filter", choices=["1", "2", "3"], default="3",
+                              help="1: photos only, 2: videos only, 3: both (default).")
+    watch_parser.add_argument("--check-interval", type=float, default=10.0,
+                              help="Seconds between connection checks (default: 10).")
+    watch_parser.add_argument("--catch-up-interval", type=float, default=900.0,
+                              help="Seconds between safety catch-up scans while connected (default: 900).")
+    watch_parser.add_argument("--stream", action="store_true", help="Stream files through the chunk pipeline.")
+    watch_parser.add_argument("--storage", choices=STORAGE_CHOICES, help="Storage backend.")
+    watch_parser.add_argument("--s3-bucket", help="Bucket for --storage s3.")
+    watch_parser.add_argument("--s3-prefix", help="Key prefix for --storage s3.")
+    watch_parser.add_argument("--s3-endpoint", help="Custom S3 endpoint URL.")
+    add_metrics_arguments(watch_parser)
+
+    # --- Jobs Command ---
+    jobs_parser = subparsers.add_parser("jobs", help="Persistent job queue and scheduler.")
+    jobs_sub = jobs_parser.add_subparsers(dest="jobs_command")
+    jobs_list = jobs_sub.add_parser("list", help="List jobs (default action).")
+    jobs_list.add_argument("--status", nargs="*", choices=JobQueue.STATUSES, help="Only these statuses.")
+    for name, helptext in (("add-download", "Queue a download job."), ("add-upload", "Queue an upload job.")):
+        p = jobs_sub.add_parser(name, help=helptext)
+        p.add_argument("--account-index", type=int, default=None, help="Account to run as (default: active).")
+        p.add_argument("--priority", type=int, default=0, help="Higher runs first (default: 0).")
+        p.add_argument("--cron", help="Repeat on a cron schedule, e.g. '0 3 * * *' (local time).")
+        if name == "add-download":
+            p.add_argument("-s", "--source", choices=["saved", "dialogs", "all"], default="all")
+            p.add_argument("--dialogs", nargs='*', help="Dialog IDs or @usernames for --source dialogs.")
+            p.add_argument("-F", "--filter", choices=["1", "2", "3"], default="3")
+            p.add_argument("--rescan", action="store_true")
+            p.add_argument("--stream", action="store_true")
+            p.add_argument("--order", choices=DOWNLOAD_ORDERS, default="scan")
+            p.add_argument("--scan-shards", type=int, default=SCAN_SHARDS)
+            add_scan_window_arguments(p)
+        else:
+            p.add_argument("-p", "--path", required=True, help="File or folder to upload.")
+            p.add_argument("-t", "--to", required=True, nargs="+", help="Destination(s) (chat ID or @username).")
+            p.add_argument("-c", "--caption", default="")
+    for name in ("pause", "resume", "cancel"):
+        p = jobs_sub.add_parser(name, help=f"{name.capitalize()} a job.")
+        p.add_argument("job_id", type=int)
+    jobs_run = jobs_sub.add_parser("run", help="Run the scheduler until Ctrl+C / SIGTERM.")
+    jobs_run.add_argument("--max-concurrency", type=int, default=4, help="Jobs running at once (default: 4).")
+    jobs_run.add_argument("--poll-interval", type=float, default=5.0, help="Seconds between queue polls.")
+
+    # --- Serve Command ---
+    serve_parser = subparsers.add_parser("serve", help="Run the local HTTP/JSON control API.")
+    serve_parser.add_argument("--host", default="127.0.0.1", help="Bind address (default: 127.0.0.1).")
+    serve_parser.add_argument("--port", type=int, default=8765, help="TCP port (default: 8765).")
+    serve_parser.add_argument("--unix", help="Listen on this Unix socket path instead of TCP.")
+    serve_parser.add_argument("--token", help="Require 'Authorization: Bearer <token>' (or set TELE_API_TOKEN).")
+
+    # --- Query Command ---
+    query_parser = subparsers.add_parser("query", help="Query the local catalog of downloaded media.")
+    query_parser.add_argument("--dialog", help="Dialog ID or (part of) its title/username.")
+    query_parser.add_argument("--type", choices=["photo", "video"], help="Media type.")
+    query_parser.add_argument("--year", type=int, help="Only media posted in this year.")
+    query_parser.add_argument("--since", type=parse_date, help="Only media posted on/after this date (YYYY-MM-DD).")
+    query_parser.add_argument("--until", type=parse_date, help="Only media posted before this date (YYYY-MM-DD).")
+    query_parser.add_argument("--min-size", type=parse_size, help="Minimum file size (e.g. 100MB).")
+    query_parser.add_argument("--max-size", type=parse_size, help="Maximum file size (e.g. 2GB).")
+    query_parser.add_argument("--order", choices=["date", "size"], default="date", help="Sort order (default: date).")
+    query_parser.add_argument("--limit", type=int, default=None, help="Maximum number of rows.")
+    query_parser.add_argument("--paths-only", action="store_true", help="Print only file paths (for scripting).")
+    query_parser.add_argument("--account-index", type=int, default=None,
+                              help="Optional: Query another account's catalog instead of the active one.")
+
+    # --- Mirror Command ---
+    mirror_parser = subparsers.add_parser(
+        "mirror", help="Copy media to another chat on Telegram's side (no download/upload).")
+    mirror_parser.add_argument("-s", "--source", choices=["saved", "dialogs", "all"], default="dialogs",
+                               help="Where to copy from (default: dialogs).")
+    mirror_parser.add_argument("--dialogs", nargs='*', help="Dialog IDs or @usernames for --source dialogs.")
+    mirror_parser.add_argument("-t", "--to", required=True, help="Destination (chat ID or @username).")
+    mirror_parser.add_argument("-F", "--filter", choices=["1", "2", "3"], default="3",
+                               help="1: photos, 2: videos, 3: both (default).")
+    mirror_parser.add_argument("--keep-author", action="store_true",
+                               help="Forward with the 'Forwarded from' header instead of sending copies.")
+    mirror_parser.add_argument("--rescan", action="store_true",
+                               help="Ignore the local scan cache and walk the full message history again.")
+    add_scan_window_arguments(mirror_parser)
+    add_metrics_arguments(mirror_parser)
+
+    # --- Verify Command ---
+    verify_parser = subparsers.add_parser(
+        "verify", help="Check downloaded files against the sizes and SHA-256 hashes in the catalog.")
+    verify_parser.add_argument("--dialog", help="Only this dialog (ID or part of its title/username).")
+    verify_parser.add_argument("--since", type=parse_date, help="Only media posted on/after this date (YYYY-MM-DD).")
+    verify_parser.add_argument("--until", type=parse_date, help="Only media posted before this date (YYYY-MM-DD).")
+    verify_parser.add_argument("--workers", type=int, default=min(4, os.cpu_count() or 1),
+                               help="Files hashed in parallel (default: up to 4).")
+    verify_parser.add_argument("--size-only", action="store_true", help="Compare sizes only, skip hashing.")
+    verify_parser.add_argument("--requeue", action="store_true",
+                               help="Delete corrupt files and unmark corrupt/missing items so the next "
+                                    "download fetches them again.")
+    verify_parser.add_argument("--account-index", type=int, default=None,
+                               help="Optional: Verify another account's download folder instead of the active one.")
+
+    # --- Status Command ---
+    status_parser = subparsers.add_parser("status", help="Show current account status and last session progress.")
+
+    return parser
+
+
+def run_cli_status(env_path: Path):
+    """Chỉ đọc .env và file state — không tạo client, không import Telethon/asyncio (được poll thường xuyên)."""
+    envd = load_env(env_path)
+    current_account_idx = get_current_account_index(envd)
+    if current_account_idx != 0:
+        cfg = get_account_config(envd, current_account_idx)
+        state = StateManager(current_account_idx)
+        lines = ["ACCOUNT STATUS", ""]
+        lines.extend([pad(s, WIDTH - 2) for s in state.get_status_lines(Path(cfg["DOWNLOAD_DIR"]))])
+        console_log_func(c(box(lines), Fore.CYAN))
+    else:
+        console_log_func(c(pad("No active account selected for status.", WIDTH, "left"), Fore.YELLOW))
+
+
+async def cli_main_entry(args: Optional[argparse.Namespace] = None):
+    parser = build_cli_parser()
+    if args is None:
+        args = parser.parse_args()
+
+    env_path = Path(".env")
+    ensure_env_exists(env_path)
+
+    if args.command == "login":
+        await run_cli_login(args)
+    elif args.command == "logout":
+        await run_cli_logout(args)
+    elif args.command == "reset":
+        await run_cli_reset(args)
+    elif args.command == "upload":
+        await run_cli_upload(args)
+    elif args.command == "download":
+        await run_cli_download(args)
+    elif args.command == "serve":
+        await run_cli_serve(args)
+    elif args.command == "jobs":
+        await run_cli_jobs(args)
+    elif args.command == "watch":
+        await run_cli_watch(args)
+    elif args.command == "mirror":
+        await run_cli_mirror(args)
+    elif args.command == "query":
+        await run_cli_query(args)
+    elif args.command == "verify":
+        run_cli_verify(args)
+    elif args.command == "status":
+        run_cli_status(env_path)
+    else:
+        parser.print_help()
+
+
+def cli_main():
+    args = build_cli_parser().parse_args()
+    if args.command in (None, "status", "verify"):  # lệnh không cần mạng: chạy đồng bộ, khỏi khởi tạo asyncio
+        env_path = Path(".env")
+        ensure_env_exists(env_path)
+        if args.command == "status":
+            run_cli_status(env_path)
+        elif args.command == "verify":
+            run_cli_verify(args)
+        else:
+            build_cli_parser().print_help()
+        return
+    asyncio.run(cli_main_entry(args))
+
+
+def main():
+    """Điểm vào của `python downloader.py` / `python -m downloader` (xem downloader.py)."""
+    try:
+        cli_main()
+    except KeyboardInterrupt:
+        console_log_func(pad("CLI operation interrupted. Goodbye!", WIDTH, "left"), "red")
+    except Exception as e:
+        console_log_func(pad(f"Fatal CLI error: {e}", WIDTH, "left"), "red")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
+
+
@@ -6,8 +6,10 @@ import asyncio
 from pathlib import Path
 from typing import Optional, Dict, List, Tuple, Any, Callable, Union
 import threading
+import concurrent.futures
 import sys
 import os
+import time
 import humanize
 
 
@@ -19,11 +21,15 @@ from downloader import (
     ensure_env_exists,
     get_current_account_index,
     get_account_config,
+    storage_from_config,
     set_current_account_index,
     do_login_flow,
     do_reset_flow,
     do_logout_flow,
     find_next_account_index,  # New import for account management
+    RunProfiler,
+    DOWNLOAD_ORDERS,
+    scan_window_from_params,
     
 )
 
@@ -37,6 +43,35 @@ from telethon.errors import (
 )
 
 
+class AsyncLoopThread:
+    """Một event loop asyncio duy nhất chạy trong luồng nền suốt vòng đời ứng dụng.
+
+    Mọi coroutine của Telethon được đưa vào loop này qua submit(), nhờ vậy các client
+    giữ nguyên kết nối giữa các thao tác thay vì phải kết nối lại trên loop mới.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run, name="telethon-loop", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coro) -> concurrent.futures.Future:
+        """Lên lịch coroutine trên loop nền, trả về Future an toàn luồng."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def stop(self, timeout: float = 5.0):
+        if self.loop.is_closed():
+            return
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout=timeout)
+        if not self._thread.is_alive():
+            self.loop.close()
+
+
 class TelegramDownloaderGUI:
     def __init__(self):
         # Cấu hình theme
@@ -71,15 +106,21 @@ class TelegramDownloaderGUI:
         self.envd = load_env(self.env_path)
         self.current_account_idx = get_current_account_index(self.envd)
         self.downloader: Optional[TelegramDownloader] = None
-        self.download_thread = None
-        self.upload_thread = None
+        # Một client đã kết nối cho mỗi tài khoản, sống suốt phiên làm việc
+        self.downloaders: Dict[int, TelegramDownloader] = {}
+        self.download_future: Optional[concurrent.futures.Future] = None
+        self.upload_future: Optional[concurrent.futures.Future] = None
         self.is_downloading = False
         self.is_uploading = False
         self.stop_flag = False
-        self.active_loop: Optional[asyncio.AbstractEventLoop] = None
+        self.profile_enabled = False  # Bật ở màn hình nguồn/bộ lọc: đo phase/task của lần quét + tải tiếp theo
+        self.run_profiler: Optional[RunProfiler] = None  # Profile của lần chạy hiện tại, giữ qua màn hình bộ lọc
+        self.download_order = "scan"  # Thứ tự hàng đợi tải, chọn ở màn hình bộ lọc (DOWNLOAD_ORDERS)
+        # Cửa sổ ngày/kích thước (chuỗi người dùng nhập); cũng được đẩy xuống các lần quét sau
+        self.scan_window_text = {"since": "", "until": "", "min_size": "", "max_size": ""}
+        self.scan_window_entries: Dict[str, ctk.CTkEntry] = {}
+        self.async_runner = AsyncLoopThread()
 
-        self._gui_event = threading.Event()
-        self._gui_input_result: Any = None
 
         # Stats tracking (for download)
         self.stats = {
@@ -154,15 +195,92 @@ class TelegramDownloaderGUI:
                 })
         return accounts
 
+    # ==================== ASYNC BRIDGE ====================
+    def _run_async(self, coro, on_success: Optional[Callable[[Any], None]] = None,
+                   on_error: Optional[Callable[[Exception], None]] = None) -> concurrent.futures.Future:
+        """Chạy coroutine trên loop nền và chuyển kết quả về luồng Tk qua root.after."""
+        future = self.async_runner.submit(coro)
+
+        def _done(fut: concurrent.futures.Future):
+            if fut.cancelled():
+                return
+            exc = fut.exception()
+            if exc is not None:
+                if on_error:
+                    self.root.after(0, lambda e=exc: on_error(e))
+                else:
+                    self.root.after(0, lambda e=exc: self._show_error(str(e)))
+            elif on_success:
+                self.root.after(0, lambda r=fut.result(): on_success(r))
+
+        future.add_done_callback(_done)
+        return future
+
+    async def _get_connected_downloader(self, idx: int, cfg: Dict[str, str]) -> Optional[TelegramDownloader]:
+        """Trả về client đã kết nối của tài khoản, tạo mới chỉ khi chưa có hoặc cấu hình đã đổi."""
+        downloader = self.downloaders.get(idx)
+        if downloader is not None and (downloader.phone != cfg["PHONE"] or
+                                       str(downloader.download_dir) != str(Path(cfg["DOWNLOAD_DIR"]))):
+            await self._disconnect_account(idx)
+            downloader = None
+
+        if downloader is None:
+            downloader = TelegramDownloader(
+                api_id=int(cfg["API_ID"]),
+                api_hash=cfg["API_HASH"],
+                phone=cfg["PHONE"],
+                download_dir=cfg["DOWNLOAD_DIR"],
+                account_index=idx,
+                log_func=self.gui_log_output,
+                input_func=self.gui_get_input,
+                storage=storage_from_config(cfg)
+            )
+            self.downloaders[idx] = downloader
+        elif downloader.client.is_connected() and await downloader.client.is_user_authorized():
+            return downloader
+
+        if await downloader.connect_client():
+            return downloader
+        return None
+
+    async def _disconnect_account(self, idx: int):
+        downloader = self.downloaders.pop(idx, None)
+        if downloader and downloader.client.is_connected():
+            try:
+                await downloader.client.disconnect()
+            except Exception as e:
+                print(f"Error during Telethon client disconnect: {e}")
+        if downloader:
+            downloader.scan_cache.close()
+        if downloader is self.downloader:
+            self.downloader = None
+
+    async def _disconnect_all_accounts(self):
+        for idx in list(self.downloaders.keys()):
+            await self._disconnect_account(idx)
+
     # ==================== GUI-SPECIFIC I/O FUNCTIONS ====================
     def gui_log_output(self, message: str, color_tag: Optional[str] = None):
         """Custom log function to append messages to the GUI's log textbox."""
         self.root.after(0, lambda: self._append_log(message, color_tag))
 
-    def gui_get_input(self, prompt: str, default: Optional[str] = None, hide_input: bool = False) -> str:
-        """Custom input function to get user input via a CTkToplevel dialog."""
-        self._gui_input_result = None
-        self._gui_event.clear()
+    def _dialog_future(self) -> Tuple[asyncio.Future, Callable[[Any], None]]:
+        """
+        Future trên loop nền cho kết quả một hộp thoại, và hàm (gọi từ luồng Tk) để đặt kết quả đó.
+        Coroutine chờ future thay vì chặn luồng, nên trong lúc hộp thoại mở các tác vụ khác trên loop
+        (keep-alive, tải đang chạy, tài khoản khác) vẫn tiếp tục.
+        """
+        loop = self.async_runner.loop
+        future = loop.create_future()
+
+        def resolve(value: Any):
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(value))
+
+        return future, resolve
+
+    def gui_get_input(self, prompt: str, default: Optional[str] = None, hide_input: bool = False) -> asyncio.Future:
+        """Custom input function to get user input via a CTkToplevel dialog (awaitable; called on the async loop)."""
+        future, resolve = self._dialog_future()
 
         def show_input_dialog():
             dialog = ctk.CTkToplevel(self.root)
@@ -182,14 +300,13 @@ class TelegramDownloaderGUI:
                 entry.insert(0, default)
 
             def submit():
-                self._gui_input_result = entry.get() or default or ""
+                value = entry.get() or default or ""
                 dialog.destroy()
-                self._gui_event.set()
+                resolve(value)
 
             def cancel():
-                self._gui_input_result = ""
                 dialog.destroy()
-                self._gui_event.set()
+                resolve("")
 
             ctk.CTkButton(dialog, text="Submit", command=submit, fg_color=self.colors['accent'],
                           hover_color=self.colors['accent_hover']).pack(pady=(10, 5), padx=20, fill="x")
@@ -199,9 +316,7 @@ class TelegramDownloaderGUI:
             dialog.protocol("WM_DELETE_WINDOW", cancel)
 
         self.root.after(0, show_input_dialog)
-        self._gui_event.wait()
-
-        return self._gui_input_result
+        return future
 
     # ==================== LOGIN SCREEN ====================
     def show_login_screen(self):
@@ -476,6 +591,19 @@ class TelegramDownloaderGUI:
             btn.pack(fill="x", padx=15, pady=5)
             self.source_buttons[src_type] = btn
 
+        profile_var = ctk.IntVar(value=1 if self.profile_enabled else 0)
+        ctk.CTkCheckBox(
+            self.left_panel,
+            text="Profile scan + download",
+            variable=profile_var,
+            checkbox_width=20,
+            checkbox_height=20,
+            fg_color=self.colors['accent'],
+            hover_color=self.colors['accent_hover'],
+            text_color=self.colors['text_dim'],
+            command=lambda: setattr(self, 'profile_enabled', bool(profile_var.get()))
+        ).pack(anchor="w", padx=15, pady=(15, 5))
+
         # Right Panel - Dynamic Content
         self.right_panel = ctk.CTkScrollableFrame(content_frame, fg_color=self.colors['card'], corner_radius=10)
         self.right_panel.grid(row=0, column=1, sticky="nsew", padx=(10, 0), pady=0)
@@ -730,20 +858,16 @@ class TelegramDownloaderGUI:
             ctk.CTkLabel(dialog_selector_window, text="Fetching dialogs...", text_color=self.colors['text_dim']).pack(
                 pady=20)
 
-            def fetch_dialogs_for_selector():
-                try:
-                    loop = self.active_loop
-                    if loop is None or loop.is_closed():
-                        raise RuntimeError("Active event loop is not available.")
-                    asyncio.set_event_loop(loop)
-                    dialogs = loop.run_until_complete(
-                        self.downloader.list_dialogs(print_to_cli=False))  # Pass print_to_cli=False
-                    self.root.after(0, lambda: self._populate_dialog_selector(dialog_selector_window, dialogs))
-                except Exception as e:
-                    self.root.after(0, lambda: messagebox.showerror("Error", f"Failed to fetch dialogs: {e}"))
-                    self.root.after(0, dialog_selector_window.destroy)
-
-            threading.Thread(target=fetch_dialogs_for_selector, daemon=True).start()
+            def on_dialogs_fetched(dialogs):
+                self.all_dialogs_info = dialogs
+                self._populate_dialog_selector(dialog_selector_window, dialogs)
+
+            def on_fetch_error(e):
+                messagebox.showerror("Error", f"Failed to fetch dialogs: {e}")
+                dialog_selector_window.destroy()
+
+            self._run_async(self.downloader.list_dialogs(print_to_cli=False),
+                            on_success=on_dialogs_fetched, on_error=on_fetch_error)
         else:
             self.root.after(0, lambda: self._populate_dialog_selector(dialog_selector_window, self.all_dialogs_info))
 
@@ -831,22 +955,14 @@ class TelegramDownloaderGUI:
 
         self.upload_start_btn.configure(state="disabled", text="Uploading...")
 
-        self.upload_thread = threading.Thread(
-            target=self._upload_thread_run,
-            args=(destination_entity, source_path, caption, self.upload_is_folder_mode),
-            daemon=True
+        self.upload_future = self.async_runner.submit(
+            self._upload_run(destination_entity, source_path, caption, self.upload_is_folder_mode)
         )
-        self.upload_thread.start()
 
-    def _upload_thread_run(self, destination: Union[User, Chat, Channel, int, str], source_path: Path,
-                           caption: Optional[str], is_folder: bool):
-        """Executes the upload operation in a background thread."""
+    async def _upload_run(self, destination: Union[User, Chat, Channel, int, str], source_path: Path,
+                          caption: Optional[str], is_folder: bool):
+        """Executes the upload operation on the background event loop."""
         try:
-            loop = self.active_loop
-            if loop is None or loop.is_closed():
-                raise RuntimeError("Active event loop is not available for uploading.")
-            asyncio.set_event_loop(loop)
-
             self.root.after(0, lambda: self.upload_progress_bar.set(0))
             self.root.after(0, lambda: self.upload_progress_label.configure(text="Starting upload..."))
 
@@ -859,14 +975,12 @@ class TelegramDownloaderGUI:
                         text = f"Processing file {f_idx}/{total_f}..."
                     self.root.after(0, lambda: self.upload_progress_label.configure(text=text))
 
-                loop.run_until_complete(
-                    self.downloader.upload_folder_media(
-                        peer=destination,
-                        folder_path=source_path,
-                        caption=caption,
-                        progress_callback=update_ui_folder_progress,
-                        stop_flag=lambda: self.stop_flag
-                    )
+                await self.downloader.upload_folder_media(
+                    peer=destination,
+                    folder_path=source_path,
+                    caption=caption,
+                    progress_callback=update_ui_folder_progress,
+                    stop_flag=lambda: self.stop_flag
                 )
                 self.root.after(0, lambda: messagebox.showinfo("Upload Complete",
                                                                f"Successfully uploaded media from {source_path.name}."))
@@ -879,13 +993,11 @@ class TelegramDownloaderGUI:
                         text=f"Uploading... {humanize.naturalsize(current_bytes)} / {humanize.naturalsize(total_bytes)}"
                     ))
 
-                loop.run_until_complete(
-                    self.downloader.upload_media(
-                        peer=destination,
-                        file_path=source_path,
-                        caption=caption,
-                        progress_callback=update_ui_file_progress
-                    )
+                await self.downloader.upload_media(
+                    peer=destination,
+                    file_path=source_path,
+                    caption=caption,
+                    progress_callback=update_ui_file_progress
                 )
                 self.root.after(0, lambda: messagebox.showinfo("Upload Complete",
                                                                f"Successfully uploaded {source_path.name}."))
@@ -898,7 +1010,7 @@ class TelegramDownloaderGUI:
         except Exception as e:
             error_msg = f"Upload error: {str(e)}"
             self.root.after(0, lambda msg=error_msg: self._show_error(msg))
-            self.root.after(0, lambda: self.upload_progress_label.configure(text=f"Upload failed: {e}"))
+            self.root.after(0, lambda msg=error_msg: self.upload_progress_label.configure(text=msg))
             self.is_uploading = False
             self.root.after(0, lambda: self.upload_start_btn.configure(text="Start Upload", state="normal"))
 
@@ -920,24 +1032,19 @@ class TelegramDownloaderGUI:
             justify="center"
         ).pack(pady=50, expand=True)
 
-        threading.Thread(target=self._fetch_dialogs_thread_for_panel, daemon=True).start()
-
-    def _fetch_dialogs_thread_for_panel(self):
-        """Lấy hộp thoại trong luồng nền, sau đó hiển thị trong right_panel."""
-        try:
-            loop = self.active_loop
-            if loop is None or loop.is_closed():
-                raise RuntimeError("Active event loop is not available for fetching dialogs.")
+        self._run_async(self._fetch_dialogs_for_panel(),
+                        on_success=self._display_dialogs_in_panel,
+                        on_error=self._on_fetch_dialogs_error)
 
-            asyncio.set_event_loop(loop)
-            dialogs = loop.run_until_complete(self.downloader.list_dialogs(print_to_cli=False))
-            self.all_dialogs_info = dialogs
+    async def _fetch_dialogs_for_panel(self) -> List[Dict[str, Any]]:
+        """Lấy hộp thoại trên loop nền, sau đó hiển thị trong right_panel."""
+        dialogs = await self.downloader.list_dialogs(print_to_cli=False)
+        self.all_dialogs_info = dialogs
+        return dialogs
 
-            self.root.after(0, lambda d=dialogs: self._display_dialogs_in_panel(d))
-        except Exception as e:
-            error_msg = f"Failed to fetch dialogs: {str(e)}"
-            self.root.after(0, lambda msg=error_msg: self._show_error(msg))
-            self.root.after(0, self.show_source_screen)
+    def _on_fetch_dialogs_error(self, e: Exception):
+        self._show_error(f"Failed to fetch dialogs: {str(e)}")
+        self.show_source_screen()
 
     def _display_dialogs_in_panel(self, dialogs):
         """Hiển thị danh sách hộp thoại TRONG right_panel (để chọn tải xuống)"""
@@ -1143,6 +1250,52 @@ class TelegramDownloaderGUI:
             btn.pack(fill="x", padx=15, pady=5)
             self.filter_buttons[filter_choice] = btn
 
+        profile_var = ctk.IntVar(value=1 if self.profile_enabled else 0)
+        ctk.CTkCheckBox(
+            self.filter_left_panel,
+            text="Profile this download",
+            variable=profile_var,
+            checkbox_width=20,
+            checkbox_height=20,
+            fg_color=self.colors['accent'],
+            hover_color=self.colors['accent_hover'],
+            text_color=self.colors['text_dim'],
+            command=lambda: setattr(self, 'profile_enabled', bool(profile_var.get()))
+        ).pack(anchor="w", padx=15, pady=(15, 5))
+
+        order_labels = {
+            "scan": "Scan order",
+            "smallest": "Smallest first",
+            "largest": "Largest first",
+            "newest": "Newest first",
+            "oldest": "Oldest first",
+            "fair": "Fair share (per dialog)",
+        }
+        ctk.CTkLabel(self.filter_left_panel, text="Download order", text_color=self.colors['text_dim']
+                     ).pack(anchor="w", padx=15, pady=(15, 0))
+        ctk.CTkOptionMenu(
+            self.filter_left_panel,
+            values=[order_labels[o] for o in DOWNLOAD_ORDERS],
+            variable=ctk.StringVar(value=order_labels[self.download_order]),
+            fg_color=self.colors['card'],
+            button_color=self.colors['accent'],
+            button_hover_color=self.colors['accent_hover'],
+            command=lambda label: setattr(self, 'download_order',
+                                          next(o for o, text in order_labels.items() if text == label))
+        ).pack(fill="x", padx=15, pady=5)
+
+        ctk.CTkLabel(self.filter_left_panel, text="Date / size window", text_color=self.colors['text_dim']
+                     ).pack(anchor="w", padx=15, pady=(15, 0))
+        self.scan_window_entries = {}
+        for key, placeholder in (("since", "Since (YYYY-MM-DD)"), ("until", "Until (YYYY-MM-DD)"),
+                                 ("min_size", "Min size (e.g. 500K)"), ("max_size", "Max size (e.g. 2GB)")):
+            entry = ctk.CTkEntry(self.filter_left_panel, placeholder_text=placeholder, fg_color=self.colors['bg'],
+                                 border_color=self.colors['accent'])
+            if self.scan_window_text[key]:
+                entry.insert(0, self.scan_window_text[key])
+            entry.pack(fill="x", padx=15, pady=3)
+            self.scan_window_entries[key] = entry
+
         self.filter_right_panel = ctk.CTkFrame(content_frame, fg_color=self.colors['card'], corner_radius=10)
         self.filter_right_panel.grid(row=0, column=1, sticky="nsew", padx=(10, 0), pady=0)
         self.filter_right_panel.grid_columnconfigure(0, weight=1)
@@ -1436,32 +1589,37 @@ class TelegramDownloaderGUI:
 
         new_idx = find_next_account_index(self.envd)
 
-        def login_in_thread():
-            try:
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-                updated_envd, logged_in_idx = loop.run_until_complete(
-                    do_login_flow(
-                        self.envd,
-                        self.gui_log_output,
-                        self.gui_get_input,
-                        phone=phone,
-                        api_id=api_id_int,
-                        api_hash=api_hash,
-                        download_dir=download_dir,
-                        account_idx_to_use=new_idx
-                    )
-                )
-                self.root.after(0, lambda: self._post_login_process(updated_envd, logged_in_idx))
-            except Exception as e:
-                self.root.after(0, lambda: self._show_error(f"Login process failed: {e}"))
-                self.root.after(0, self.show_login_screen)
+        def keep_login_client(downloader: TelegramDownloader):
+            # Giữ client vừa xác thực để các thao tác sau dùng lại kết nối
+            self.downloaders[new_idx] = downloader
+
+        def on_login_done(result: Tuple[Dict[str, str], int]):
+            updated_envd, logged_in_idx = result
+            self._post_login_process(updated_envd, logged_in_idx)
+
+        def on_login_error(e: Exception):
+            self._show_error(f"Login process failed: {e}")
+            self.show_login_screen()
 
         self.clear_screen()
         ctk.CTkLabel(self.main_container, text="Logging in...", font=ctk.CTkFont(size=14),
                      text_color=self.colors['text_dim']).pack(pady=50)
 
-        threading.Thread(target=login_in_thread, daemon=True).start()
+        self._run_async(
+            do_login_flow(
+                self.envd,
+                self.gui_log_output,
+                self.gui_get_input,
+                phone=phone,
+                api_id=api_id_int,
+                api_hash=api_hash,
+                download_dir=download_dir,
+                account_idx_to_use=new_idx,
+                on_connected=keep_login_client
+            ),
+            on_success=on_login_done,
+            on_error=on_login_error
+        )
 
     def _post_login_process(self, updated_envd: Dict[str, str], logged_in_idx: int):
         if logged_in_idx > 0:
@@ -1473,7 +1631,7 @@ class TelegramDownloaderGUI:
             self.show_login_screen()
 
     def _init_downloader_and_connect(self):
-        """Khởi tạo trình tải xuống và kết nối trong nền"""
+        """Lấy (hoặc tạo) client của tài khoản hiện tại và kết nối trên loop nền"""
         cfg = get_account_config(self.envd, self.current_account_idx)
 
         if not cfg:
@@ -1481,11 +1639,6 @@ class TelegramDownloaderGUI:
             self.show_login_screen()
             return
 
-        if self.active_loop and not self.active_loop.is_closed():
-            self.active_loop.stop()
-            self.active_loop.close()
-        self.active_loop = asyncio.new_event_loop()
-
         self.clear_screen()
         loading = ctk.CTkLabel(
             self.main_container,
@@ -1495,36 +1648,20 @@ class TelegramDownloaderGUI:
         )
         loading.pack(pady=50)
 
-        threading.Thread(
-            target=self._connect_thread,
-            args=(cfg, self.active_loop),
-            daemon=True
-        ).start()
-
-    def _connect_thread(self, cfg: Dict[str, str], loop_to_use: asyncio.AbstractEventLoop):
-        """Kết nối với Telegram trong luồng nền"""
-        try:
-            asyncio.set_event_loop(loop_to_use)
-
-            self.downloader = TelegramDownloader(
-                api_id=int(cfg["API_ID"]),
-                api_hash=cfg["API_HASH"],
-                phone=cfg["PHONE"],
-                download_dir=cfg["DOWNLOAD_DIR"],
-                account_index=self.current_account_idx,
-                log_func=self.gui_log_output,
-                input_func=self.gui_get_input
-            )
-
-            if loop_to_use.run_until_complete(self.downloader.connect_client()):
-                self.root.after(0, self.show_source_screen)
+        def on_connected(downloader: Optional[TelegramDownloader]):
+            self.downloader = downloader
+            if downloader:
+                self.show_source_screen()
             else:
-                self.root.after(0, self.show_login_screen)
+                self.show_login_screen()
 
-        except Exception as e:
-            error_msg = f"Connection error: {str(e)}\n\nMake sure your API credentials are correct or check your network."
-            self.root.after(0, lambda msg=error_msg: self._show_error(msg))
-            self.root.after(0, self.show_login_screen)
+        def on_connect_error(e: Exception):
+            self._show_error(f"Connection error: {str(e)}\n\n"
+                             f"Make sure your API credentials are correct or check your network.")
+            self.show_login_screen()
+
+        self._run_async(self._get_connected_downloader(self.current_account_idx, cfg),
+                        on_success=on_connected, on_error=on_connect_error)
 
     def select_account(self, idx):
         """Chọn tài khoản có sẵn"""
@@ -1534,6 +1671,11 @@ class TelegramDownloaderGUI:
 
         self._init_downloader_and_connect()
 
+    async def _logout_account(self, envd: Dict[str, str], idx: int) -> Dict[str, str]:
+        # Ngắt client trước khi xoá file session mà nó đang giữ
+        await self._disconnect_account(idx)
+        return await do_logout_flow(envd, self.gui_log_output, idx)
+
     def handle_logout_current(self):
         """Đăng xuất tài khoản hiện tại"""
         if self.current_account_idx == 0 or not self.downloader:
@@ -1541,68 +1683,55 @@ class TelegramDownloaderGUI:
             return
 
         if messagebox.askyesno("Confirm Logout", f"Logout account #{self.current_account_idx}?"):
-            def logout_in_thread():
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-                updated_envd = loop.run_until_complete(
-                    do_logout_flow(self.envd.copy(), self.gui_log_output, self.current_account_idx))
-                self.root.after(0, lambda: self._post_logout_process(updated_envd))
-
-            threading.Thread(target=logout_in_thread, daemon=True).start()
+            self._run_async(self._logout_account(self.envd.copy(), self.current_account_idx),
+                            on_success=self._post_logout_process)
 
     def handle_logout_and_return(self):
         """Đăng xuất và quay về màn hình đăng nhập (từ màn hình nguồn)"""
         if messagebox.askyesno("Confirm", "Logout and return to login screen?"):
-            def logout_in_thread():
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-                if self.current_account_idx != 0 and self.downloader:
-                    updated_envd = loop.run_until_complete(
-                        do_logout_flow(self.envd.copy(), self.gui_log_output, self.current_account_idx))
-                else:
-                    updated_envd = self.envd.copy()
-                self.root.after(0, lambda: self._post_logout_process(updated_envd))
-
-            threading.Thread(target=logout_in_thread, daemon=True).start()
+            if self.current_account_idx != 0 and self.downloader:
+                self._run_async(self._logout_account(self.envd.copy(), self.current_account_idx),
+                                on_success=self._post_logout_process)
+            else:
+                self._post_logout_process(self.envd.copy())
 
     def _post_logout_process(self, updated_envd: Dict[str, str]):
         self.envd = updated_envd
         save_env(self.env_path, self.envd)
         self.current_account_idx = get_current_account_index(self.envd)
         messagebox.showinfo("Logged Out", "Session files deleted. You can login again.")
-        self._disconnect_and_close_loop()
+        self.downloader = None
         self.show_login_screen()
 
+    async def _reset_all(self, envd: Dict[str, str]) -> Dict[str, str]:
+        await self._disconnect_all_accounts()
+        return await do_reset_flow(envd, self.gui_log_output, confirm=True)
+
     def handle_reset(self):
         """Đặt lại file .env"""
         if messagebox.askyesno("Confirm Reset",
                                "Reset all config? This will delete all account info and saved sessions!"):
-            def reset_in_thread():
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-                updated_envd = loop.run_until_complete(
-                    do_reset_flow(self.envd.copy(), self.gui_log_output, confirm=True))
-                self.root.after(0, lambda: self._post_reset_process(updated_envd))
-
-            threading.Thread(target=reset_in_thread, daemon=True).start()
+            self._run_async(self._reset_all(self.envd.copy()), on_success=self._post_reset_process)
 
     def _post_reset_process(self, updated_envd: Dict[str, str]):
         self.envd = updated_envd
         save_env(self.env_path, self.envd)
         self.current_account_idx = get_current_account_index(self.envd)
         messagebox.showinfo("Reset", "Config and all session files have been reset!")
-        self._disconnect_and_close_loop()
+        self.downloader = None
         self.show_login_screen()
 
     def _update_scan_progress_callback(self, current_messages_scanned: int, total_messages: Optional[int]):
-        """Callback cho các cập nhật tiến độ quét."""
-        if self.current_screen == "source" and hasattr(self, '_scan_progress_label'):
-            scan_progress_label = getattr(self, '_scan_progress_label', None)
-            if scan_progress_label:
-                self.root.after(0, lambda: scan_progress_label.configure(
-                    text=f"Scanning... {current_messages_scanned} messages processed. Found {self.downloader.stats['total_found']} media."
-                ))
-        self.root.update_idletasks()
+        """Callback cho các cập nhật tiến độ quét (gọi từ loop nền)."""
+        # Chỉ đẩy cập nhật sang Tk theo từng lô để không làm ngập hàng đợi sự kiện
+        if total_messages is None and current_messages_scanned % 100 != 0:
+            return
+        if self.current_screen == "source" and getattr(self, '_scan_progress_label', None):
+            stats = self.downloader.stats if self.downloader else {}
+            found = stats.get('images_found', 0) + stats.get('videos_found', 0)
+            self.root.after(0, lambda: self._set_scan_progress_text(
+                f"Scanning... {current_messages_scanned} messages processed. Found {found} media."
+            ))
 
     def _initiate_scan(self, source_type: str):
         """Bắt đầu quét, hiển thị thông báo tải trong bảng điều khiển bên phải."""
@@ -1612,68 +1741,66 @@ class TelegramDownloaderGUI:
             return
 
         self.current_source_type = source_type
+        if source_type == "saved":
+            self.selected_dialogs = ['me']
 
         self._clear_right_panel()
-        ctk.CTkLabel(
+        self._scan_progress_label = ctk.CTkLabel(
             self.right_panel,
             text=f"Scanning media from {source_type}...",
             font=ctk.CTkFont(size=14),
             text_color=self.colors['text_dim'],
             justify="center"
-        ).pack(pady=50, expand=True)
-
-        threading.Thread(target=self._fetch_all_dialogs_and_scan_thread, daemon=True).start()
-
-    def _fetch_all_dialogs_and_scan_thread(self):
-        """Lấy tất cả các hộp thoại cho loại nguồn 'all' và sau đó bắt đầu quét."""
-        try:
-            loop = self.active_loop
-            if loop is None or loop.is_closed():
-                raise RuntimeError("Active event loop is not available.")
-            asyncio.set_event_loop(loop)
+        )
+        self._scan_progress_label.pack(pady=50, expand=True)
 
-            self.root.after(0, lambda: self._scan_progress_label.configure(text="Fetching all dialogs..."))
-            dialogs = loop.run_until_complete(self.downloader.list_dialogs(print_to_cli=False))
-            self.all_dialogs_info = dialogs
-            self.selected_dialogs = [d['entity'] for d in dialogs]
-            self.root.after(0, self._scan_media_thread_for_panel)
+        if source_type == "all":
+            self._run_async(self._fetch_all_dialogs_and_scan(), on_error=self._on_scan_error)
+        else:
+            self._run_async(self._scan_media_for_panel(), on_error=self._on_scan_error)
 
-        except Exception as e:
-            error_msg = f"Failed to fetch all dialogs: {str(e)}"
-            self.root.after(0, lambda msg=error_msg: self._show_error(msg))
-            self.root.after(0, self.show_source_screen)
+    def _set_scan_progress_text(self, text: str):
+        scan_progress_label = getattr(self, '_scan_progress_label', None)
+        if scan_progress_label:
+            scan_progress_label.configure(text=text)
 
-    def _scan_media_thread_for_panel(self):
-        """Quét media trong nền, sau đó hiển thị màn hình tùy chọn bộ lọc."""
+    async def _fetch_all_dialogs_and_scan(self):
+        """Lấy tất cả các hộp thoại cho loại nguồn 'all' và sau đó bắt đầu quét."""
+        self.root.after(0, lambda: self._set_scan_progress_text("Fetching all dialogs..."))
+        dialogs = await self.downloader.list_dialogs(print_to_cli=False)
+        self.all_dialogs_info = dialogs
+        self.selected_dialogs = [d['entity'] for d in dialogs]
+        await self._scan_media_for_panel()
+
+    async def _scan_media_for_panel(self):
+        """Quét media trên loop nền, sau đó hiển thị màn hình tùy chọn bộ lọc."""
+        downloader = self.downloader
+        await self._profile_resume(downloader, fresh=True)
         try:
-            loop = self.active_loop
-            if loop is None or loop.is_closed():
-                raise RuntimeError("Active event loop is not available for scanning media.")
-            asyncio.set_event_loop(loop)
-
-            success = loop.run_until_complete(
-                self.downloader._run_with_source(
-                    self.current_source_type,
-                    chosen_entities=self.selected_dialogs if self.selected_dialogs != ['me'] else None,
-                    confirm_callback=self._gui_confirm_callback,
-                    progress_callback_scan=self._update_scan_progress_callback,
-                    progress_callback_download=None,
-                    stop_flag=lambda: self.stop_flag
-                )
+            success = await downloader._run_with_source(
+                self.current_source_type,
+                chosen_entities=self.selected_dialogs if self.selected_dialogs != ['me'] else None,
+                confirm_callback=self._gui_confirm_callback,
+                progress_callback_scan=self._update_scan_progress_callback,
+                progress_callback_download=None,
+                stop_flag=lambda: self.stop_flag
             )
+        finally:
+            self._profile_pause(downloader)
 
-            if success and not self.stop_flag:
-                self.media_list = self.downloader.media_list
-                self.stats = self.downloader.stats.copy()
-                self.root.after(0, self.show_filter_screen)
-            else:
-                self.root.after(0, self.show_source_screen)
-
-        except Exception as e:
-            error_msg = f"Scan error: {str(e)}"
-            self.root.after(0, lambda msg=error_msg: self._show_error(msg))
+        if success and not self.stop_flag:
+            self.media_list = downloader.media_list
+            self.stats = downloader.stats.copy()
+            self.root.after(0, self.show_filter_screen)
+        else:
+            self.root.after(0, lambda: self._profile_finish(downloader))
             self.root.after(0, self.show_source_screen)
 
+    def _on_scan_error(self, e: Exception):
+        self._profile_finish(self.downloader)
+        self._show_error(f"Scan error: {str(e)}")
+        self.show_source_screen()
+
     def _initiate_continue_session(self):
         """Khôi phục và cố gắng tiếp tục phiên cuối cùng."""
         if not self.downloader:
@@ -1702,44 +1829,39 @@ class TelegramDownloaderGUI:
             justify="center"
         ).pack(pady=50, expand=True)
 
-        def _restore_dialogs_and_scan_thread():
-            try:
-                loop = self.active_loop
-                if loop is None or loop.is_closed():
-                    raise RuntimeError("Active event loop is not available for restoring dialogs.")
-                asyncio.set_event_loop(loop)
-
-                restored_entities = []
-                if typ == "saved":
-                    restored_entities = ['me']
-                else:
-                    want_ids = [int(x) for x in dialog_ids_from_state if str(x).isdigit() and int(x) != 0]
-                    if not want_ids:
-                        self.root.after(0, lambda: messagebox.showinfo("No Session",
-                                                                       "Could not restore dialogs from previous session."))
-                        self.root.after(0, self._show_default_right_panel)
-                        return
-
-                    all_dialogs = loop.run_until_complete(self.downloader.list_dialogs(print_to_cli=False))
-                    for d_info in all_dialogs:
-                        if hasattr(d_info["entity"], "id") and int(d_info["entity"].id) in want_ids:
-                            restored_entities.append(d_info["entity"])
-
-                    if not restored_entities:
-                        self.root.after(0, lambda: messagebox.showinfo("No Session",
-                                                                       "Could not restore dialogs from previous session."))
-                        self.root.after(0, self._show_default_right_panel)
-                        return
-
-                self.selected_dialogs = restored_entities
-                self.root.after(0, self._scan_media_thread_for_panel)
+        def no_session():
+            messagebox.showinfo("No Session", "Could not restore dialogs from previous session.")
+            self._show_default_right_panel()
 
-            except Exception as e:
-                self.root.after(0,
-                                lambda msg=f"Error restoring previous session: {e}": messagebox.showerror("Error", msg))
-                self.root.after(0, self._show_default_right_panel)
+        async def _restore_dialogs_and_scan():
+            restored_entities = []
+            if typ == "saved":
+                restored_entities = ['me']
+            else:
+                want_ids = [int(x) for x in dialog_ids_from_state if str(x).isdigit() and int(x) != 0]
+                if not want_ids:
+                    self.root.after(0, no_session)
+                    return
+
+                # Dùng lại danh sách dialogs đã lấy trong phiên nếu có
+                all_dialogs = self.all_dialogs_info or await self.downloader.list_dialogs(print_to_cli=False)
+                self.all_dialogs_info = all_dialogs
+                for d_info in all_dialogs:
+                    if hasattr(d_info["entity"], "id") and int(d_info["entity"].id) in want_ids:
+                        restored_entities.append(d_info["entity"])
+
+                if not restored_entities:
+                    self.root.after(0, no_session)
+                    return
+
+            self.selected_dialogs = restored_entities
+            await self._scan_media_for_panel()
+
+        def on_restore_error(e: Exception):
+            messagebox.showerror("Error", f"Error restoring previous session: {e}")
+            self._show_default_right_panel()
 
-        threading.Thread(target=_restore_dialogs_and_scan_thread, daemon=True).start()
+        self._run_async(_restore_dialogs_and_scan(), on_error=on_restore_error)
 
     def start_download(self, filter_choice):
         """Bắt đầu tải xuống với bộ lọc đã chọn"""
@@ -1756,6 +1878,16 @@ class TelegramDownloaderGUI:
         else:
             filtered = self.media_list
 
+        self.scan_window_text = {k: e.get().strip() for k, e in self.scan_window_entries.items()}
+        try:
+            window = scan_window_from_params(self.scan_window_text)
+        except Exception as e:
+            messagebox.showerror("Invalid Filter", str(e))
+            return
+        # Danh sách đã quét được lọc ngay; các lần quét sau dùng cửa sổ này để khỏi duyệt phần ngoài khoảng
+        self.downloader.set_scan_window(**window)
+        filtered = [m for m in filtered if self.downloader.in_scan_window(m['message'])]
+
         if not filtered:
             messagebox.showinfo("No Media", "No media files match the selected filter.")
             return
@@ -1785,34 +1917,70 @@ class TelegramDownloaderGUI:
         self.gui_log_output(f"Source: {source_label}, Filter: {filter_label}")
         self.gui_log_output(f"Download directory: {self.downloader.download_dir}")
 
-        self.download_thread = threading.Thread(target=self._download_thread, daemon=True)
-        self.download_thread.start()
+        def stop_check() -> bool:
+            return self.stop_flag or not self.is_downloading
 
-    def _download_thread(self):
-        """Luồng tải xuống"""
-        try:
-            loop = self.active_loop
-            if loop is None or loop.is_closed():
-                raise RuntimeError("Active event loop is not available for downloading.")
-            asyncio.set_event_loop(loop)
-
-            def stop_check() -> bool:
-                return self.stop_flag or not self.is_downloading
-
-            loop.run_until_complete(
-                self.downloader.download_all_media(
-                    self.filtered_media_list,
-                    stop_flag=stop_check,
-                    progress_callback=lambda p, c, t, s: self.root.after(0, self._update_download_progress, p, c, t, s)
-                )
-            )
+        downloader = self.downloader
 
-            self.root.after(0, self._download_complete)
+        def on_download_error(e: Exception):
+            # Lần chạy lỗi/chậm chính là lúc cần profile nhất, nên vẫn ghi báo cáo
+            self._profile_finish(downloader)
+            self._show_error(f"Download error: {str(e)}")
+            self.show_source_screen()
 
-        except Exception as e:
-            error_msg = f"Download thread error: {str(e)}"
-            self.root.after(0, lambda msg=error_msg: self._show_error(msg))
-            self.root.after(0, self.show_source_screen)
+        async def run_download():
+            downloader.download_order = self.download_order
+            await self._profile_resume(downloader)
+            try:
+                with downloader._phase("download"):
+                    await downloader.download_all_media(
+                        self.filtered_media_list,
+                        stop_flag=stop_check,
+                        progress_callback=lambda p, c, t, s: self.root.after(0, self._update_download_progress,
+                                                                             p, c, t, s)
+                    )
+            finally:
+                self._profile_pause(downloader)
+
+        def on_download_done(_):
+            self._profile_finish(downloader)
+            self._download_complete()
+
+        self.download_future = self._run_async(
+            run_download(),
+            on_success=on_download_done,
+            on_error=on_download_error
+        )
+
+    async def _profile_resume(self, downloader: TelegramDownloader, fresh: bool = False):
+        """Chạy trên loop nền: bật (hoặc đo tiếp) profiler của lần chạy; fresh=True bỏ profile cũ khi bắt đầu quét mới."""
+        if fresh:
+            self.run_profiler = None
+        if not self.profile_enabled:
+            return
+        if self.run_profiler is None:
+            self.run_profiler = RunProfiler(sample_interval=0.01)
+        downloader.profiler = self.run_profiler
+        self.run_profiler.start()
+
+    def _profile_pause(self, downloader: TelegramDownloader):
+        """Chạy trên loop nền: tạm dừng profiler giữa quét và tải (thời gian ngồi ở màn hình bộ lọc không bị tính)."""
+        if self.run_profiler is not None and downloader.profiler is self.run_profiler:
+            self.run_profiler.stop()
+            downloader.profiler = None
+
+    def _profile_finish(self, downloader: Optional[TelegramDownloader]):
+        """Luồng Tk: ghi báo cáo của lần chạy (thành công, lỗi hay bị dừng) rồi bỏ profiler."""
+        profiler, self.run_profiler = self.run_profiler, None
+        if profiler is not None and downloader is not None:
+            self._show_profile(profiler, downloader)
+
+    def _show_profile(self, profiler: RunProfiler, downloader: TelegramDownloader):
+        """Ghi bảng profile vào log và lưu file folded stacks cạnh thư mục tải."""
+        for row in profiler.report_lines():
+            self.gui_log_output(row)
+        out = profiler.write_folded(downloader.download_dir / f"profile_download_{int(time.time())}.folded")
+        self.gui_log_output(f"Profile (folded stacks) saved to {out}", "blue")
 
     def _update_download_progress(self, progress: float, current: int, total: int, stats: Dict[str, Any]):
         """Cập nhật tiến độ tải xuống trong giao diện người dùng (được gọi từ luồng nền thông qua root.after)."""
@@ -1880,51 +2048,25 @@ class TelegramDownloaderGUI:
     def on_closing(self):
         """Xử lý khi đóng cửa sổ"""
         if self.is_downloading or self.is_uploading:
-            if messagebox.askyesno("Confirm Exit", "Operation in progress. Exit anyway?"):
-                self.stop_flag = True
-                self._disconnect_and_close_loop()
-                self.root.destroy()
-        else:
-            self._disconnect_and_close_loop()
-            self.root.destroy()
-
-    def _disconnect_and_close_loop(self):
-        """Ngắt kết nối ứng dụng khách Telegram và đóng vòng lặp sự kiện đang hoạt động."""
-        if self.downloader and self.downloader.client and self.downloader.client.is_connected():
-            try:
-                def disconnect_sync():
-                    if self.active_loop and not self.active_loop.is_closed():
-                        try:
-                            asyncio.set_event_loop(self.active_loop)
-                            self.active_loop.run_until_complete(self.downloader.client.disconnect())
-                        except Exception as e:
-                            print(f"Error during Telethon client disconnect in thread: {e}")
-
-                disconnect_thread = threading.Thread(target=disconnect_sync, daemon=True)
-                disconnect_thread.start()
-                disconnect_thread.join(timeout=2)
-            except Exception as e:
-                print(f"Error attempting client disconnect: {e}")
-
-        if self.active_loop and not self.active_loop.is_closed():
-            self.active_loop.stop()
-            self.active_loop.close()
-        self.active_loop = None
-        self.downloader = None
-
-    def _gui_confirm_callback(self, title: str, message: str) -> bool:
-        """Trợ giúp để hiển thị hộp thoại xác nhận và chặn luồng gọi."""
-        self._gui_input_result = None
-        self._gui_event.clear()
-
-        def show_confirm_dialog():
-            result = messagebox.askyesno(title, message)
-            self._gui_input_result = result
-            self._gui_event.set()
+            if not messagebox.askyesno("Confirm Exit", "Operation in progress. Exit anyway?"):
+                return
+            self.stop_flag = True
+        self._shutdown_async_runner()
+        self.root.destroy()
 
-        self.root.after(0, show_confirm_dialog)
-        self._gui_event.wait()
-        return self._gui_input_result
+    def _shutdown_async_runner(self):
+        """Ngắt kết nối mọi client Telegram rồi dừng loop nền."""
+        try:
+            self.async_runner.submit(self._disconnect_all_accounts()).result(timeout=5)
+        except Exception as e:
+            print(f"Error attempting client disconnect: {e}")
+        self.async_runner.stop()
+
+    def _gui_confirm_callback(self, title: str, message: str) -> asyncio.Future:
+        """Hộp thoại xác nhận; trả về future (bool) để coroutine gọi await mà không chặn loop nền."""
+        future, resolve = self._dialog_future()
+        self.root.after(0, lambda: resolve(messagebox.askyesno(title, message)))
+        return future
 
     def run(self):
         """Chạy GUI"""